@@ -0,0 +1,144 @@
+"""
+Batch size policies for the calls to classifier_fn made while explaining
+images.
+"""
+import threading
+
+
+class FixedBatchSizer(object):
+    """Always uses the same batch size."""
+
+    def __init__(self, size):
+        self.size = max(1, int(size))
+        self.sizes = []
+
+    def next_size(self):
+        self.sizes.append(self.size)
+        return self.size
+
+    def record(self, size, seconds, nbytes=None):
+        pass
+
+
+class AdaptiveBatchSizer(object):
+    """Grows the batch size while it improves classifier throughput.
+
+    The first batches are used as probes: after each one the throughput
+    (samples per second of classifier_fn) is measured, and the size is
+    multiplied by growth as long as the throughput improves by more than
+    tolerance. As soon as a larger batch does not pay off, the size goes
+    back to the best one seen so far and stays there. The size never
+    exceeds max_size.
+
+    The size is halved, and never grows again, when a batch takes more than
+    max_memory_mb or when classifier_fn runs out of memory on it (see
+    shrink).
+    """
+
+    def __init__(self, initial=10, max_size=None, growth=2., tolerance=.05,
+                 max_memory_mb=None):
+        """Init function.
+
+        Args:
+            initial: size of the first batch
+            max_size: largest batch size allowed, e.g. the one that fits in
+                the memory budget. If None, batches are not bounded.
+            growth: factor applied to the batch size while probing
+            tolerance: relative throughput gain needed to keep growing
+            max_memory_mb: memory budget, in megabytes, of one batch,
+                checked against the measured size of every batch. If None,
+                only max_size bounds the batches.
+        """
+        self.max_size = max_size
+        self.max_memory_mb = max_memory_mb
+        self.growth = growth
+        self.tolerance = tolerance
+        self.size = self._clip(initial)
+        self.best_size = self.size
+        self.best_throughput = 0.
+        self.settled = False
+        self.sizes = []
+        self.throughputs = []
+        self.shrinks = []
+        self._lock = threading.Lock()
+
+    def _clip(self, size):
+        size = max(1, int(size))
+        if self.max_size is not None:
+            size = min(size, self.max_size)
+        return size
+
+    def next_size(self):
+        with self._lock:
+            self.sizes.append(self.size)
+            return self.size
+
+    def record(self, size, seconds, nbytes=None):
+        """Updates the policy with the time classifier_fn took on a batch
+        of the given size, and the bytes it took if known."""
+        with self._lock:
+            throughput = size / max(seconds, 1e-9)
+            self.throughputs.append(throughput)
+            if nbytes is not None and self.max_memory_mb is not None and \
+                    nbytes > self.max_memory_mb * 2 ** 20 and size > 1:
+                self._shrink(size)
+                return
+            if self.settled or size < self.best_size:
+                # Smaller batches (e.g. the last one) say nothing new
+                return
+            if throughput > self.best_throughput * (1 + self.tolerance):
+                self.best_size = size
+                self.best_throughput = throughput
+                self.size = self._clip(size * self.growth)
+                self.settled = self.size == size
+            else:
+                self.size = self.best_size
+                self.settled = True
+
+    def shrink(self, size):
+        """Halves the batch size after a batch of the given size did not
+        fit in memory.
+
+        Returns:
+            False if size is already 1, True otherwise.
+        """
+        with self._lock:
+            if size <= 1:
+                return False
+            self._shrink(size)
+            return True
+
+    def _shrink(self, size):
+        self.max_size = max(1, int(size) // 2)
+        self.size = self._clip(self.size)
+        self.best_size = min(self.best_size, self.max_size)
+        self.settled = True
+        self.shrinks.append(size)
+
+
+def make_batch_sizer(batch_size, sample_nbytes, max_memory_mb=None,
+                     live_batches=1):
+    """Builds the batch size policy of a neighborhood.
+
+    Args:
+        batch_size: an integer, or 'auto' for an AdaptiveBatchSizer
+        sample_nbytes: bytes taken by one perturbed image
+        max_memory_mb: memory budget, in megabytes, of the perturbed images
+            alive at the same time. If None, batches are not bounded.
+        live_batches: number of batches alive at the same time (more than
+            one when composition is pipelined)
+
+    Returns:
+        a FixedBatchSizer or an AdaptiveBatchSizer
+    """
+    max_size = None
+    batch_mb = None
+    if max_memory_mb is not None:
+        max_size = max(1, int(max_memory_mb * 2 ** 20 //
+                              (sample_nbytes * live_batches)))
+        batch_mb = float(max_memory_mb) / live_batches
+    if batch_size == 'auto':
+        return AdaptiveBatchSizer(max_size=max_size, max_memory_mb=batch_mb)
+    if max_size is not None:
+        batch_size = min(batch_size, max_size)
+    return FixedBatchSizer(batch_size)
@@ -1,8 +1,18 @@
 import itertools
+import warnings
+
 import numpy as np
-import lime_image
-import matplotlib.pyplot as plt
-from multiprocessing import Pool, cpu_count
+
+try:
+    from . import lime_image
+    from . import lime_trivial
+    from .image_pool import ClusterIndex
+    from .segment_stats import SegmentStatistics
+except:
+    import lime_image
+    import lime_trivial
+    from image_pool import ClusterIndex
+    from segment_stats import SegmentStatistics
 
 def evaluate_explanations(explainer_type,
                           model,
@@ -15,7 +25,11 @@ def evaluate_explanations(explainer_type,
                           image_pool=[], # For lime#R
                           clustering_labels=None, # For lime#C
                           shown_features=10000,
-                          draw_prob=0.5): 
+                          draw_prob=0.5,
+                          images_per_call=1,
+                          batch_size=10,
+                          segmentation_cache=None,
+                          segmentation_seed=None): 
     
     """
     Evaluates the quality of the explanations of the given explainer
@@ -34,16 +48,34 @@ def evaluate_explanations(explainer_type,
         segmentation_fun:  defines the shape of the explanation's features;
         hide_col:          when using basic versions of Lime, this is the
                            color corresponding to a turned-off feature;
+        image_pool:        images to draw patches from (just for LIME#R).
+                           An ImagePool shares them with the processes
+                           it is sent to instead of copying them;
         shown_features:    number of features shown in the explanation;
         draw_prob:         probability to extract an image of the same
                            cluster (just for LIME#RC)
+        images_per_call:   number of images explained together through
+                           explain_instances, so that the black box sees
+                           batches mixing their neighborhoods (not used by
+                           LIME#C and LIME#RC, whose pool changes for
+                           every image);
+        batch_size:        number of neighborhood images the black box
+                           is called on;
+        segmentation_cache: SegmentationCache the default quickshift
+                           segmentations (segmentation_fun None) are read
+                           from and stored in;
+        segmentation_seed: random seed of the default quickshift
+                           segmentations. None draws a new one for every
+                           image, which the cache never hits twice.
     
     """
     lime_sharp_clus = False
+    lime_sharp_rc = False
     
     if explainer_type == 'lime' or explainer_type == 'lime#' \
     or explainer_type == 'limecolor' or explainer_type == 'lime#color':
-        explainer = lime_image.LimeImageExplainer()
+        explainer = lime_image.LimeImageExplainer(
+                segmentation_cache=segmentation_cache)
     elif explainer_type == 'lime#R':
         if len(image_pool) == 0:
             raise "Given image pool is not properly defined"
@@ -55,6 +87,12 @@ def evaluate_explanations(explainer_type,
         #explainer = lime_image.LimeImageEnhancedPatchworkExplainer(image_pool=[])
     elif explainer_type == 'lime#RC':
         lime_sharp_rc = True
+        explainer = lime_image.LimeImageMixedPatchworkExplainer([], [],
+                                                                draw_prob)
+    elif explainer_type == 'occlusion':
+        # One black box call per feature plus one, neigh_size is not used
+        explainer = lime_trivial.LimeImageTrivialExplainer()
+        neigh_size = None
     else:
         print("Unsupported explainer type")
         return
@@ -64,106 +102,180 @@ def evaluate_explanations(explainer_type,
     # rel = relative quality of the image's explanation
     # abs = absolute quality of the image's explanation
     list_of_qualities = []
+    explanations = {}
+    
+    # The cluster pools are index views over images, so switching the
+    # explained image does not copy any image
+    if lime_sharp_clus or lime_sharp_rc:
+        clusters = ClusterIndex(images, clustering_labels)
     
     for i in range(len(images)):
         
         # Set the proper image pool to draw the images from
         # (only for Lime#C)
         if lime_sharp_clus:
-            img_pool = get_images_of_same_cluster(clustering_labels[i],
-                                              clustering_labels,
-                                              images)
-            #print "len of pool = %d" % len(pool)
-            explainer.image_pool = img_pool
+            explainer.image_pool = clusters.same_cluster(clustering_labels[i])
             
         elif lime_sharp_rc:
-            same_clus = get_images_of_same_cluster(clustering_labels[i], clustering_labels, images)
-            other_clus = get_images_of_other_clusters(clustering_labels[i],
-                                                      clustering_labels,
-                                                      images)
-            explainer = lime_image.LimeImageMixedPatchworkExplainer(same_clus, other_clus, draw_prob)
+            explainer.same_clus_images = \
+                clusters.same_cluster(clustering_labels[i])
+            explainer.all_other_images = \
+                clusters.other_clusters(clustering_labels[i])
         
         # Explanation of the i-th image, using the previously
         # instantiated explainer
-        explanation = explainer.explain_instance(images[i],
-                                                 model.predict,
-                                                 top_labels=1,
-                                                 hide_color=hide_col,
-                                                 num_samples=neigh_size,
-                                                 segmentation_fn=segmentation_fun)
+        if lime_sharp_clus or lime_sharp_rc or images_per_call <= 1:
+            explanation = explainer.explain_instance(images[i],
+                                                     model.predict,
+                                                     top_labels=1,
+                                                     hide_color=hide_col,
+                                                     num_samples=neigh_size,
+                                                     batch_size=batch_size,
+                                                     segmentation_fn=segmentation_fun,
+                                                     random_seed=segmentation_seed)
+        else:
+            # Explain the next images_per_call images at once
+            if i not in explanations:
+                chunk = range(i, min(i + images_per_call, len(images)))
+                explanations = dict(zip(chunk, explainer.explain_instances(
+                                                     [images[j] for j in chunk],
+                                                     model.predict,
+                                                     top_labels=1,
+                                                     hide_color=hide_col,
+                                                     num_samples=neigh_size,
+                                                     batch_size=batch_size,
+                                                     segmentation_fn=segmentation_fun,
+                                                     random_seed=segmentation_seed)))
+            explanation = explanations.pop(i)
         
         # Black box prediction of the i-th image
-        label_to_exp = bb_outcomes[i]
-        
-        try:
-            positive_features = \
-                    [area[0] for area in explanation.local_exp[label_to_exp] if area[1] > 0]
-        except:
-            print("KeyError: %s" % str(label_to_exp))
-            continue
-        
-        tot_num_features = len(positive_features)
-        current_img_scores = []
-        
-        pool = Pool(processes=cpu_count())
-        multiple_res = [pool.apply_async(loop_body, 
-                                         (positive_features, 
-                                          num_feat, 
-                                          ground_truths[i], 
-                                          explanation.segments)) 
-                        for num_feat in range(1, tot_num_features+1)]
-        pool.close()
-        current_img_scores = [res.get(timeout=100) for res in multiple_res]
-        pool.join()
-        del pool
-        
-        list_of_qualities.append(current_img_scores)
-        
-        if lime_sharp_clus:
-            del img_pool
-            
-        if lime_sharp_rc:
-            del same_clus
-            del other_clus
+        current_img_scores = explanation_scores(explanation, bb_outcomes[i],
+                                                ground_truths[i])
+        if current_img_scores is not None:
+            list_of_qualities.append(current_img_scores)
         
     return np.array(list_of_qualities)
 
-def loop_body(pos_feats, num_feats, gt, segments):
+def evaluate_explanations_multiscale(model,
+                                     bb_outcomes,
+                                     images,
+                                     ground_truths,
+                                     grid_sizes,
+                                     neigh_size=100,
+                                     hide_col=None,
+                                     batch_size=10,
+                                     max_condition=1e8):
+    """
+    Evaluates the explanations of Lime# on grids of several sizes, with one
+    neighborhood per image (see explain_instance_multiscale) instead of
+    one per image and grid size
+    
+    Args:
+        grid_sizes:        sizes of the grids given to gridSegmentation;
+        max_condition:     coarse explanations whose ridge system has a
+                           larger condition number are not scored;
+        the others:        see evaluate_explanations
+    
+    Returns:
+        dict mapping every grid size to an object array with one entry
+        per image: the qualities evaluate_explanations would return for
+        it, or NaN when the image was not scored on that grid (its fit was
+        ill-conditioned, with a warning, or its label was not explained).
+        Unlike the ones of evaluate_explanations, the arrays of all the
+        grid sizes are aligned on the images.
+    """
+    explainer = lime_image.LimeImageExplainer()
+    qualities = dict((g, np.full(len(images), np.nan, dtype=object))
+                     for g in grid_sizes)
+    for i in range(len(images)):
+        explanations = explainer.explain_instance_multiscale(
+                                                     images[i],
+                                                     model.predict,
+                                                     grid_sizes=grid_sizes,
+                                                     top_labels=1,
+                                                     hide_color=hide_col,
+                                                     num_samples=neigh_size,
+                                                     batch_size=batch_size,
+                                                     max_condition=max_condition)
+        for g in grid_sizes:
+            if getattr(explanations[g], 'condition', 1.) > max_condition:
+                warnings.warn('Ill-conditioned fit, grid size %d of image '
+                              '%d not scored' % (g, i))
+                continue
+            current_img_scores = explanation_scores(explanations[g],
+                                                    bb_outcomes[i],
+                                                    ground_truths[i])
+            if current_img_scores is not None:
+                qualities[g][i] = current_img_scores
+    return qualities
+
+def explanation_scores(explanation, label_to_exp, ground_truth):
+    """
+    (rel, abs, num_feats) of the explanation of label_to_exp when showing
+    its first 1, 2, ... positive features, or None if the label is not
+    explained
+    """
+    try:
+        positive_features = \
+                [area[0] for area in explanation.local_exp[label_to_exp] if area[1] > 0]
+    except:
+        print("KeyError: %s" % str(label_to_exp))
+        return None
+    
+    tot_num_features = len(positive_features)
+    if tot_num_features == 0:
+        return []
+    
+    # Every number of shown features is scored from the rank map of the
+    # positive features: a pixel is green with k features when its rank
+    # is between 1 and k
+    stats = explanation.segment_stats
+    ranks = explanation.get_masks(label_to_exp, cumulative=True)
+    in_gt = ground_truth_mask(ground_truth)
+    green_pixels_in_gt = np.cumsum(
+            np.bincount(ranks[in_gt], minlength=tot_num_features + 1)[1:])
+    absolute = green_pixels_in_gt / float(in_gt.sum())
+    
+    ratios = stats.means(in_gt)
+    positions = stats.positions(positive_features)
+    feat_ratios = np.where(positions >= 0, ratios[positions], 0.)
+    num_feats = np.arange(1, tot_num_features + 1)
+    relative = np.cumsum(feat_ratios > 0.5) / num_feats.astype(float)
+    return list(zip(relative, absolute, num_feats))
+
+def loop_body(pos_feats, num_feats, gt, segments, stats=None):
     highlighted = pos_feats[:num_feats]
-    rel = relative_quality_of_explanation(gt, highlighted, segments)
-    abso = absolute_quality_of_explanation(gt, highlighted, segments)
+    rel = relative_quality_of_explanation(gt, highlighted, segments, stats)
+    abso = absolute_quality_of_explanation(gt, highlighted, segments, stats)
     return (rel, abso, num_feats)
 
 def get_images_of_same_cluster(image_label, all_labels, all_images):
     
     all_labels = np.array(all_labels)
     indexes_of_images_in_the_same_cluster, = np.where(all_labels == image_label)
-    all_images = np.array(all_images)
-    result = all_images[indexes_of_images_in_the_same_cluster]
     
-    return list(result)
+    return [all_images[j] for j in indexes_of_images_in_the_same_cluster]
 
 def get_images_of_other_clusters(image_label, all_labels, all_images):
     all_labels = np.array(all_labels)
     indexes_of_images_in_other_clusters, = np.where(all_labels != image_label)
-    all_images = np.array(all_images)
-    result = all_images[indexes_of_images_in_other_clusters]
     
-    return list(result)
+    return [all_images[j] for j in indexes_of_images_in_other_clusters]
 
 def absolute_quality_of_explanation(ground_truth_image, 
                            highlighted_features,
-                           segments):
-    green_pixels_in_gt = 0.0
-    tot_pixels_in_gt = 0.0
+                           segments,
+                           stats=None):
+    if stats is None:
+        stats = SegmentStatistics(segments)
+    
+    # Pixels of the ground truth image, not considering white pixels. 
+    in_gt = ground_truth_mask(ground_truth_image)
+    tot_pixels_in_gt = float(in_gt.sum())
     
-    # Count the number of both pixels and GREEN pixels of the ground truth
-    # image, not considering white pixels. 
-    for i,j in itertools.product(range(segments.shape[0]), range(segments.shape[1])):
-        if not np.array_equal(ground_truth_image[i,j], [255,255,255]):
-            tot_pixels_in_gt = tot_pixels_in_gt + 1
-            if segments[i,j] in highlighted_features:
-                green_pixels_in_gt = green_pixels_in_gt + 1
+    # GREEN pixels of the ground truth, i.e. the ones in a highlighted
+    # feature
+    green_pixels_in_gt = float(in_gt[stats.label_mask(highlighted_features)].sum())
 
     # Then, return the ratio between the two values as a measure of quality                
     return green_pixels_in_gt / tot_pixels_in_gt
@@ -171,35 +283,36 @@ def absolute_quality_of_explanation(ground_truth_image,
 
 def relative_quality_of_explanation(ground_truth_image, 
                            highlighted_features,
-                           segments):
+                           segments,
+                           stats=None):
+    if stats is None:
+        stats = SegmentStatistics(segments)
+    
+    # For each feature (either a superpixel or a square block), compute 
+    # the percentage of pixels in the feature that intersect with the 
+    # ground truth image
+    ratios = stats.means(ground_truth_mask(ground_truth_image))
+    positions = stats.positions(highlighted_features)
+    feat_ratios = np.where(positions >= 0, ratios[positions], 0.)
+    
+    # if the percentage of pixels covered by the feature is
+    # higher than 50%, then we say the feature COVERS the 
+    # ground truth and count it for the final result.
     # Represents the green areas that cover (at least half) a part
     # of the ground truth image
-    good_features = 0.0
-    
-    for feat in highlighted_features:
-        # feat is a feature, so either a superpixel or
-        # a square block
-        feat_pixels_in_gt, feat_green_pixels_in_gt = 0.0, 0.0
-        
-        for i,j in itertools.product(range(segments.shape[0]), range(segments.shape[1])):
-            # compute the percentage of pixels in the feature
-            # that intersect with the ground truth image
-            if segments[i,j] == feat:
-                feat_pixels_in_gt = feat_pixels_in_gt + 1
-                if not np.array_equal(ground_truth_image[i,j], [255,255,255]):
-                    feat_green_pixels_in_gt = feat_green_pixels_in_gt + 1
-        if feat_pixels_in_gt > 0:
-            ratio = feat_green_pixels_in_gt / feat_pixels_in_gt
-        else:
-            ratio = 0
-        
-        # if the percentage of pixels covered by the feature is
-        # higher than 50%, then we say the feature COVERS the 
-        # ground truth and count it for the final result
-        if ratio > 0.5:
-            good_features = good_features + 1
+    good_features = float(np.sum(feat_ratios > 0.5))
     
     return good_features / len(highlighted_features)
+
+
+def ground_truth_mask(ground_truth_image):
+    """Pixels of the cut image that belong to the ground truth (i.e. that
+    are not white). The image is either grayscale (H, W) or has channels
+    (H, W, C), of which an alpha channel is ignored."""
+    ground_truth_image = np.asarray(ground_truth_image)
+    if ground_truth_image.ndim == 2:
+        return ground_truth_image != 255
+    return np.any(ground_truth_image[..., :3] != 255, axis=-1)
     
 
 def compare_explanations(normal_mask, grid_mask, blocks_coordinates):
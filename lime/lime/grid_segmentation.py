@@ -27,7 +27,7 @@ def gridSegmentation(parts, img):
     #print "image shape: " + str(img.shape)
     
     segments = np.zeros(img.shape[:2])
-    segments_per_row = img.shape[:2][0] / parts
+    segments_per_row = img.shape[:2][0] // parts
     #segments_per_row = math.ceil(float(img.shape[:2][0]) / parts)
     width = img.shape[:2][0]
     height = img.shape[:2][1]
@@ -49,6 +49,26 @@ def gridSegmentation(parts, img):
         
     return segments.astype(int)
 
+def refine_segments(segments, fine_segments, cells):
+    """Splits some segments of a segmentation along a finer one.
+
+    Args:
+        segments: 2d array of segment labels
+        fine_segments: 2d array of segment labels, e.g. a finer grid
+        cells: labels of segments to split
+
+    Returns:
+        2d array labelled 0 to n - 1: the pixels of the given cells take
+        the segment they have in fine_segments, the others keep their
+        segment.
+    """
+    segments = np.asarray(segments)
+    split = np.isin(segments, cells)
+    # Labels of the fine segments go after the ones of segments
+    offset = segments.max() + 1 - np.min(fine_segments)
+    merged = np.where(split, fine_segments + offset, segments)
+    return np.unique(merged, return_inverse=True)[1].reshape(segments.shape)
+
 def get_blocks_coordinates(segments):
     
     height = segments.shape[0]
@@ -0,0 +1,365 @@
+"""
+Vectorized composition of perturbed images for the image explainers.
+
+A perturbation row is a binary vector over the superpixels of an image:
+column z is 1 when superpixel z keeps the original pixels and 0 when it is
+replaced by the pixels of a fudged (donor) image. The functions in this module
+build whole batches of perturbed images from such rows, using a
+segment-to-pixel index computed once per image instead of one full-image
+`segments == z` comparison per turned-off superpixel.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+
+class GridSegments(object):
+    """Segmentation made of axis-aligned blocks, e.g. gridSegmentation's.
+
+    The image rows are split in consecutive bands of row_sizes rows, the
+    columns in bands of col_sizes columns, and every (row band, column band)
+    block has a single segment label. Masks over such a segmentation can be
+    built at block resolution and upsampled, instead of per pixel.
+    """
+
+    def __init__(self, row_sizes, col_sizes, labels):
+        """Init function.
+
+        Args:
+            row_sizes: number of rows of every row band
+            col_sizes: number of columns of every column band
+            labels: 2d integer array (n_row_bands, n_col_bands), the segment
+                label of every block
+        """
+        self.row_sizes = np.asarray(row_sizes, dtype=np.intp)
+        self.col_sizes = np.asarray(col_sizes, dtype=np.intp)
+        self.labels = np.asarray(labels)
+        if self.labels.shape != (len(self.row_sizes), len(self.col_sizes)):
+            raise ValueError('labels must have one entry per block')
+        self.shape = (int(self.row_sizes.sum()), int(self.col_sizes.sum()))
+        self.row_starts = np.concatenate(([0], np.cumsum(self.row_sizes)))
+        self.col_starts = np.concatenate(([0], np.cumsum(self.col_sizes)))
+
+    @classmethod
+    def from_segments(cls, segments, min_block_pixels=4):
+        """Returns the GridSegments of a segmentation array, or None if the
+        segmentation is not made of axis-aligned blocks.
+
+        Any segmentation is a grid of one-pixel blocks, so grids whose
+        blocks have less than min_block_pixels pixels on average are not
+        worth it and are also rejected."""
+        segments = np.asarray(segments)
+        if segments.ndim != 2 or segments.size == 0:
+            return None
+        row_starts = np.concatenate(
+            ([0], np.flatnonzero((segments[1:] != segments[:-1]).any(1)) + 1))
+        col_starts = np.concatenate(
+            ([0], np.flatnonzero((segments[:, 1:] !=
+                                  segments[:, :-1]).any(0)) + 1))
+        if len(row_starts) * len(col_starts) * min_block_pixels > \
+                segments.size:
+            return None
+        labels = segments[row_starts][:, col_starts]
+        grid = cls(np.diff(np.append(row_starts, segments.shape[0])),
+                   np.diff(np.append(col_starts, segments.shape[1])), labels)
+        if not (grid.segments == segments).all():
+            return None
+        return grid
+
+    @property
+    def uniform(self):
+        """Whether all the blocks have the same size."""
+        return (self.row_sizes == self.row_sizes[0]).all() and \
+            (self.col_sizes == self.col_sizes[0]).all()
+
+    def expand(self, blocks):
+        """Upsamples an array (..., n_row_bands, n_col_bands) of per-block
+        values to (..., H, W)."""
+        blocks = np.asarray(blocks)
+        return np.repeat(np.repeat(blocks, self.row_sizes, axis=-2),
+                         self.col_sizes, axis=-1)
+
+    @property
+    def segments(self):
+        """The segmentation as a 2d array of labels."""
+        return self.expand(self.labels)
+
+    def blocks_view(self, array, leading=0):
+        """View of array (leading dims..., H, W[, C]) shaped (leading dims...,
+        n_row_bands, block_height, n_col_bands, block_width, C). Only for
+        uniform grids. Returns None if no such view exists."""
+        shape = array.shape[:leading] + (
+            len(self.row_sizes), self.row_sizes[0],
+            len(self.col_sizes), self.col_sizes[0], -1)
+        view = array.view()
+        try:
+            view.shape = shape
+        except AttributeError:
+            return None
+        return view
+
+
+def neighborhood_buffer(n_samples, image, directory=None):
+    """Memory-mapped array (n_samples,) + image.shape, with the dtype of
+    image, to compose a whole neighborhood into.
+
+    The backing file is created in directory (the system temporary
+    directory by default) and removed right away where the platform allows
+    it, so the disk space is released with the array.
+    """
+    fd, path = tempfile.mkstemp(suffix='.npy', dir=directory)
+    os.close(fd)
+    buffer = np.lib.format.open_memmap(path, mode='w+', dtype=image.dtype,
+                                       shape=(n_samples,) + image.shape)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    return buffer
+
+
+def segments_array(segments):
+    """Segmentation as a 2d array, whether it is one or a GridSegments."""
+    if isinstance(segments, GridSegments):
+        return segments.segments
+    return segments
+
+
+class SegmentIndex(object):
+    """Maps every column of the perturbation matrix to the pixels it covers.
+
+    Column z of the perturbation matrix corresponds to the pixels where
+    `segments == z`. Segment values that do not correspond to a column
+    (e.g. negative values or values >= n_features) are never perturbed.
+
+    When the segmentation is a grid of blocks (see GridSegments), the grid
+    is kept in self.grid and the composition works block-wise.
+    """
+
+    def __init__(self, segments, n_features=None):
+        """Init function.
+
+        Args:
+            segments: 2d numpy array of integer segment labels, or a
+                GridSegments
+            n_features: number of columns of the perturbation matrix. If None,
+                defaults to the number of distinct labels in segments.
+        """
+        if isinstance(segments, GridSegments):
+            self.grid = segments
+            segments = segments.segments
+        else:
+            segments = np.asarray(segments)
+            self.grid = GridSegments.from_segments(segments)
+        if n_features is None:
+            n_features = np.unique(segments).shape[0]
+        self.shape = segments.shape
+        self.n_features = n_features
+
+        flat = segments.ravel().astype(np.int64)
+        # Pixels of unmapped segments point to an extra, always-on column
+        self.pixel_features = np.where((flat >= 0) & (flat < n_features),
+                                       flat, n_features)
+        counts = np.bincount(self.pixel_features, minlength=n_features + 1)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.order = np.argsort(self.pixel_features, kind='mergesort')
+        if self.grid is not None:
+            labels = self.grid.labels.astype(np.int64)
+            self.block_features = np.where(
+                (labels >= 0) & (labels < n_features), labels, n_features)
+
+    @property
+    def n_pixels(self):
+        return self.pixel_features.shape[0]
+
+    def pixels(self, feature):
+        """Returns the flat pixel indices covered by the given column."""
+        return self.order[self.offsets[feature]:self.offsets[feature + 1]]
+
+    def off_mask(self, rows):
+        """Expands perturbation rows to pixel level.
+
+        Args:
+            rows: 2d binary array, (batch, n_features)
+
+        Returns:
+            boolean array (batch, n_pixels), True where the pixel is turned
+            off.
+        """
+        rows = np.asarray(rows)
+        off = np.zeros((rows.shape[0], self.n_features + 1), dtype=bool)
+        off[:, :self.n_features] = rows == 0
+        return off[:, self.pixel_features]
+
+    def off_blocks(self, rows):
+        """Same as off_mask, at block resolution (batch, n_row_bands,
+        n_col_bands). Only for grid segmentations."""
+        rows = np.asarray(rows)
+        off = np.zeros((rows.shape[0], self.n_features + 1), dtype=bool)
+        off[:, :self.n_features] = rows == 0
+        return off[:, self.block_features]
+
+
+def coarsen_rows(rows, fine_index, coarse_index):
+    """Expresses perturbation rows over one segmentation as features of
+    another, usually coarser, one.
+
+    Every column of the result is the fraction of the pixels of its coarse
+    segment that the rows keep on. When the fine segments are nested in the
+    coarse ones, it is the fraction of child segments turned on, and a row
+    that turns whole coarse segments on or off gives the usual binary row.
+
+    Args:
+        rows: 2d binary array (batch, fine_index.n_features)
+        fine_index: SegmentIndex of the segmentation the rows perturb
+        coarse_index: SegmentIndex of the other segmentation, of the same
+            image. Columns without pixels are 1.
+
+    Returns:
+        float array (batch, coarse_index.n_features)
+    """
+    n_fine = fine_index.n_features
+    n_coarse = coarse_index.n_features
+    # Pixels shared by every (coarse column, fine column) pair, the extra
+    # columns standing for the segments no column perturbs
+    counts = np.bincount(coarse_index.pixel_features * (n_fine + 1) +
+                         fine_index.pixel_features,
+                         minlength=(n_coarse + 1) * (n_fine + 1))\
+        .reshape((n_coarse + 1, n_fine + 1))[:n_coarse].astype(float)
+    totals = counts.sum(1)
+    on = np.asarray(rows, dtype=float).dot(counts[:, :n_fine].T) + \
+        counts[:, n_fine]
+    return np.where(totals > 0, on / np.maximum(totals, 1), 1.)
+
+
+def compose_batch(image, fudged_image, index, rows, out=None):
+    """Builds the perturbed images for a batch of rows with one fudged image.
+
+    Args:
+        image: 3d numpy array (H, W, C), the image being explained
+        fudged_image: 3d numpy array, pixels shown where a superpixel is off
+        index: SegmentIndex of the image segmentation
+        rows: 2d binary array, (batch, n_features)
+        out: optional preallocated array (batch, H, W, C) with the dtype of
+            image. Allocated if None.
+
+    Returns:
+        array (batch, H, W, C) with the dtype of image.
+    """
+    n_rows = len(rows)
+    if out is None:
+        out = np.empty((n_rows,) + image.shape, dtype=image.dtype)
+    if index.grid is not None:
+        off = index.off_blocks(rows)
+        if index.grid.uniform:
+            out_blocks = index.grid.blocks_view(out, leading=1)
+            if out_blocks is not None:
+                np.copyto(out, image)
+                np.copyto(out_blocks,
+                          index.grid.blocks_view(
+                              np.ascontiguousarray(fudged_image)),
+                          where=off[:, :, np.newaxis, :, np.newaxis,
+                                    np.newaxis],
+                          casting='unsafe')
+                return out
+        off = index.grid.expand(off)
+    else:
+        off = index.off_mask(rows).reshape((n_rows,) + index.shape)
+    if image.ndim == 3:
+        off = off[..., np.newaxis]
+    np.copyto(out, image)
+    np.copyto(out, fudged_image, where=off, casting='unsafe')
+    return out
+
+
+def compose_batch_from_pool(image, pool, index, rows, donors, out=None):
+    """Builds the perturbed images for a batch of rows with one donor per
+    turned-off superpixel.
+
+    Only the pixels of the turned-off superpixels are touched, so the cost
+    does not depend on the size of the pool.
+
+    Args:
+        image: 3d numpy array (H, W, C), the image being explained
+        pool: sequence of 3d numpy arrays shaped like image
+        index: SegmentIndex of the image segmentation
+        rows: 2d binary array, (batch, n_features)
+        donors: 2d integer array, (batch, n_features), index in pool of the
+            image whose pixels replace each turned-off superpixel. Entries
+            where the row is 1 are ignored.
+        out: optional preallocated array (batch, H, W, C). Allocated if None.
+
+    Returns:
+        array (batch, H, W, C) with the dtype of image.
+    """
+    n_rows = len(rows)
+    if out is None:
+        out = np.empty((n_rows,) + image.shape, dtype=image.dtype)
+    np.copyto(out, image)
+    if index.grid is not None:
+        _compose_blocks_from_pool(pool, index, rows, donors, out)
+        return out
+    flat_out = out.reshape((n_rows, index.n_pixels, -1))
+    for b in range(n_rows):
+        for z in np.where(rows[b] == 0)[0]:
+            pixels = index.pixels(z)
+            donor = pool[donors[b, z]]
+            flat_out[b, pixels] = donor.reshape((index.n_pixels, -1))[pixels]
+    return out
+
+
+def _compose_blocks_from_pool(pool, index, rows, donors, out):
+    grid = index.grid
+    b, i, j = np.nonzero(index.off_blocks(rows))
+    block_donors = np.asarray(donors)[b, index.block_features[i, j]]
+    out_blocks = grid.blocks_view(out, leading=1) if grid.uniform else None
+    if out_blocks is None:
+        rs, cs = grid.row_starts, grid.col_starts
+        for bb, ii, jj, d in zip(b, i, j, block_donors):
+            block = (slice(rs[ii], rs[ii + 1]), slice(cs[jj], cs[jj + 1]))
+            out[(bb,) + block] = pool[d][block]
+        return
+    # One vectorized copy of all the blocks taken from each donor
+    order = np.argsort(block_donors, kind='mergesort')
+    used, starts = np.unique(block_donors[order], return_index=True)
+    for d, sel in zip(used, np.split(order, starts[1:])):
+        donor_blocks = grid.blocks_view(np.ascontiguousarray(pool[d]))
+        out_blocks[b[sel], i[sel], :, j[sel]] = donor_blocks[i[sel], :, j[sel]]
+
+
+class Composer(object):
+    """Composes the perturbed images of the rows of a neighborhood.
+
+    Holds everything the composition needs as arrays (no closure), so that
+    it can be rebuilt in another process, see parallel_compose.py.
+    """
+
+    def __init__(self, image, index, fudged_image=None, pool=None,
+                 donors=None):
+        """Init function.
+
+        Args:
+            image: 3d numpy array, the image being explained
+            index: SegmentIndex of the image segmentation
+            fudged_image: image shown where a superpixel is off, when there
+                is no pool
+            pool: sequence of donor images (list or ImagePool)
+            donors: 2d integer array with the index in pool of the donor of
+                every superpixel of every row of the neighborhood (see
+                compose_batch_from_pool)
+        """
+        self.image = image
+        self.index = index
+        self.fudged_image = fudged_image
+        self.pool = pool
+        self.donors = donors
+
+    def __call__(self, rows, rows_index, out=None):
+        """Perturbed images of rows = data[rows_index]."""
+        if self.pool is None:
+            return compose_batch(self.image, self.fudged_image, self.index,
+                                 rows, out=out)
+        return compose_batch_from_pool(self.image, self.pool, self.index,
+                                       rows, self.donors[rows_index],
+                                       out=out)
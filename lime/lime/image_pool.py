@@ -0,0 +1,231 @@
+"""
+Pool of same-sized images stored in a single memory-mapped .npy file.
+
+The patchwork explainers draw the pixels of turned-off superpixels from a
+pool of images. Kept as a list of arrays, the pool is copied into every
+worker process it is sent to. An ImagePool only pickles the path of its
+file and the indices of its images: every process maps the same file, so
+the pixels are shared through the page cache instead of being copied.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+try:
+    from .utils.generic_utils import array_digest
+except:
+    from utils.generic_utils import array_digest
+
+
+def images_digest(images):
+    """Hex digest of the content, shapes and dtypes of a sequence of
+    images, in order."""
+    digest = hashlib.sha1(repr(len(images)).encode('utf-8'))
+    for image in images:
+        digest.update(array_digest(image).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ImagePool(object):
+    """Sequence of images backed by a memory-mapped array.
+
+    Indexing with an integer returns a read-only view of one image. Indexing
+    with a slice, a list or an array of indices returns another ImagePool
+    over the same file (no pixels are copied).
+    """
+
+    def __init__(self, path, indices=None):
+        """Init function. See also ImagePool.create.
+
+        Args:
+            path: .npy file holding an array (n_images, H, W[, C])
+            indices: indices, in the file, of the images of this pool. If
+                None, all the images of the file, in order.
+        """
+        self.path = path
+        self.indices = None if indices is None else \
+            np.asarray(indices, dtype=np.intp).ravel()
+        self._owner = False
+        self._open()
+
+    def _open(self):
+        self.base = np.load(self.path, mmap_mode='r')
+
+    @classmethod
+    def create(cls, images, path=None):
+        """Writes images to a new .npy file and returns its pool.
+
+        Args:
+            images: sequence of numpy arrays with the same shape and dtype
+            path: file to write. If None, a temporary file is used, which is
+                deleted by close().
+        """
+        owner = path is None
+        if owner:
+            fd, path = tempfile.mkstemp(suffix='.npy')
+            os.close(fd)
+        first = np.asarray(images[0])
+        stored = np.lib.format.open_memmap(
+            path, mode='w+', dtype=first.dtype,
+            shape=(len(images),) + first.shape)
+        for i in range(len(images)):
+            stored[i] = images[i]
+        stored.flush()
+        del stored
+        pool = cls(path)
+        pool._owner = owner
+        return pool
+
+    def __len__(self):
+        if self.indices is None:
+            return self.base.shape[0]
+        return self.indices.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += len(self)
+            if not 0 <= item < len(self):
+                raise IndexError('image index out of range')
+            if self.indices is not None:
+                item = self.indices[item]
+            return self.base[item]
+        positions = np.arange(len(self))[item]
+        if self.indices is not None:
+            positions = self.indices[positions]
+        return ImagePool(self.path, positions)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def shape(self):
+        """Shape of the stacked pool, (n_images, H, W[, C])."""
+        return (len(self),) + self.base.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.base.dtype
+
+    def asarray(self):
+        """The stacked pool as an array. A view of the file when the pool
+        is a contiguous run of its images, a copy otherwise."""
+        if self.indices is None:
+            return self.base
+        if len(self.indices) and \
+                (np.diff(self.indices) == 1).all():
+            return self.base[self.indices[0]:self.indices[-1] + 1]
+        return self.base[self.indices]
+
+    def key(self):
+        """String identifying the images of the pool, for caches."""
+        st = os.stat(self.path)
+        indices = b'' if self.indices is None else self.indices.tobytes()
+        return hashlib.sha1(repr((os.path.abspath(self.path), st.st_mtime,
+                                  st.st_size)).encode('utf-8') +
+                            indices).hexdigest()
+
+    def __getstate__(self):
+        return {'path': self.path, 'indices': self.indices}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.indices = state['indices']
+        self._owner = False
+        self._open()
+
+    def close(self):
+        """Releases the mapping, and deletes the file if it is a temporary
+        one created by ImagePool.create."""
+        self.base = None
+        if self._owner and os.path.exists(self.path):
+            os.remove(self.path)
+            self._owner = False
+
+
+class ImageView(object):
+    """Sequence of some of the images of another sequence, given by their
+    indices. Nothing is copied: indexing with an integer returns the image
+    of the underlying sequence, with a slice or indices another view."""
+
+    def __init__(self, images, indices):
+        """Init function.
+
+        Args:
+            images: sequence of images (list, array, ImagePool...)
+            indices: indices in images of the images of the view
+        """
+        self.images = images
+        self.indices = np.asarray(indices, dtype=np.intp).ravel()
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self.images[self.indices[item]]
+        return ImageView(self.images, self.indices[item])
+
+    def __iter__(self):
+        for i in self.indices:
+            yield self.images[i]
+
+    def asarray(self):
+        """The images of the view stacked in an array (a copy)."""
+        if isinstance(self.images, np.ndarray):
+            return self.images[self.indices]
+        return np.stack([np.asarray(im) for im in self])
+
+    def key(self):
+        """String identifying the images of the view, for caches: the key of
+        the underlying pool and the indices for an ImagePool, a digest of
+        the content of the viewed images otherwise."""
+        if isinstance(self.images, (ImagePool, ImageView)):
+            return hashlib.sha1(self.images.key().encode('utf-8') +
+                                self.indices.tobytes()).hexdigest()
+        return images_digest(self)
+
+
+class ClusterIndex(object):
+    """Inverted index from cluster label to the images of that cluster.
+
+    Pools of the images of a cluster, or of all the other clusters, are
+    views over the same images: switching the explained image only swaps
+    indices.
+    """
+
+    def __init__(self, images, labels):
+        """Init function.
+
+        Args:
+            images: sequence of images, e.g. a list, an array or an
+                ImagePool
+            labels: cluster label of every image
+        """
+        self.images = images
+        self.labels = np.asarray(labels).ravel()
+        if len(self.labels) != len(images):
+            raise ValueError('%d cluster labels for %d images' %
+                             (len(self.labels), len(images)))
+        self.members = {}
+        for i, label in enumerate(self.labels):
+            self.members.setdefault(label, []).append(i)
+        self.members = dict((label, np.array(ids, dtype=np.intp))
+                            for label, ids in self.members.items())
+
+    def _view(self, indices):
+        if isinstance(self.images, ImagePool):
+            return self.images[indices]
+        return ImageView(self.images, indices)
+
+    def same_cluster(self, label):
+        """Images of the given cluster."""
+        return self._view(self.members.get(label,
+                                           np.zeros(0, dtype=np.intp)))
+
+    def other_clusters(self, label):
+        """Images of all the clusters but the given one."""
+        return self._view(np.flatnonzero(self.labels != label))
@@ -0,0 +1,78 @@
+"""
+Distances between the rows of a perturbation matrix and its first row.
+
+LIME neighborhoods of images and texts are binary masks whose first row,
+the original instance, is all ones. The distance of a row to it then only
+depends on how many ones the row has, so it can be computed from the row
+sums instead of with pairwise_distances.
+"""
+import numpy as np
+import scipy.sparse
+import sklearn.metrics
+
+
+def _cosine(ones, n_features):
+    # A row of zeros has no direction: pairwise_distances gives it 1
+    return 1. - np.sqrt(ones / float(n_features))
+
+
+def _hamming(ones, n_features):
+    return (n_features - ones) / float(n_features)
+
+
+def _euclidean(ones, n_features):
+    return np.sqrt(n_features - ones)
+
+
+BINARY_METRICS = {
+    'cosine': _cosine,
+    'hamming': _hamming,
+    'jaccard': _hamming,
+    'euclidean': _euclidean,
+}
+
+
+def _binary_row_sums(data):
+    """Returns the number of ones of every row if data is binary with an
+    all-ones first row, otherwise None."""
+    if scipy.sparse.issparse(data):
+        data = data.tocsr()
+        values = data.data
+    else:
+        data = np.asarray(data)
+        if data.ndim != 2:
+            return None
+        values = data
+    if data.shape[0] == 0 or data.shape[1] == 0:
+        return None
+    if values.dtype != bool and not ((values == 0) | (values == 1)).all():
+        return None
+    ones = np.asarray(data.sum(axis=1), dtype=float).ravel()
+    if ones[0] != data.shape[1]:
+        return None
+    return ones
+
+
+def distances_to_first(data, metric='cosine'):
+    """Distances of every row of data to data[0].
+
+    Equivalent to pairwise_distances(data, data[0], metric).ravel(), but
+    computed in O(rows) from the row sums when data is a binary matrix
+    (dense or sparse) whose first row is all ones and metric is one of
+    BINARY_METRICS. Other inputs fall back to pairwise_distances.
+
+    Args:
+        data: 2d array or sparse matrix, one sample per row
+        metric: distance metric, as in sklearn.metrics.pairwise_distances
+
+    Returns:
+        1d array of distances
+    """
+    if metric in BINARY_METRICS:
+        ones = _binary_row_sums(data)
+        if ones is not None:
+            return BINARY_METRICS[metric](ones, data.shape[1])
+    first = data[0] if scipy.sparse.issparse(data) else \
+        np.asarray(data)[0].reshape(1, -1)
+    return sklearn.metrics.pairwise_distances(data, first,
+                                              metric=metric).ravel()
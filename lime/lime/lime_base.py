@@ -3,10 +3,81 @@ Contains abstract functionality for learning locally linear sparse model.
 """
 from __future__ import print_function
 import numpy as np
+import scipy.linalg
 from sklearn.linear_model import Ridge, lars_path
 from sklearn.utils import check_random_state
 
 
+class IncrementalRidge(object):
+    """Weighted ridge regression with intercept, refitted as samples come in.
+
+    Keeps the weighted means and the centered Gram matrix of the data (and
+    its cross products with the labels) seen so far, merging every new block
+    of samples into them, so a refit costs a solve in the number of features
+    and does not depend on the number of samples. The fits are the ones
+    LimeBase.weighted_ridge returns on all the samples at once.
+    """
+
+    def __init__(self, n_features, n_targets):
+        self.total = 0.
+        self.data_mean = np.zeros(n_features)
+        self.labels_mean = np.zeros(n_targets)
+        self.gram = np.zeros((n_features, n_features))
+        self.cross = np.zeros((n_features, n_targets))
+        self.labels_ss = np.zeros(n_targets)
+
+    def update(self, data, labels, weights):
+        """Adds samples to the fit.
+
+        Args:
+            data: 2d array (n_samples, n_features)
+            labels: 2d array (n_samples, n_targets)
+            weights: 1d array of sample weights
+        """
+        data = np.asarray(data, dtype=float)
+        labels = np.asarray(labels, dtype=float)
+        weights = np.asarray(weights, dtype=float)
+        total = weights.sum()
+        if total == 0:
+            return
+        data_mean = weights.dot(data) / total
+        labels_mean = weights.dot(labels) / total
+        centered = data - data_mean
+        weighted = centered * weights[:, np.newaxis]
+        gram = weighted.T.dot(centered)
+        cross = weighted.T.dot(labels - labels_mean)
+        labels_ss = weights.dot((labels - labels_mean) ** 2)
+
+        # Merge of the centered moments of the two sets of samples
+        merged = self.total + total
+        factor = self.total * total / merged
+        data_delta = data_mean - self.data_mean
+        labels_delta = labels_mean - self.labels_mean
+        self.gram += gram + factor * np.outer(data_delta, data_delta)
+        self.cross += cross + factor * np.outer(data_delta, labels_delta)
+        self.labels_ss += labels_ss + factor * labels_delta ** 2
+        self.data_mean += data_delta * (total / merged)
+        self.labels_mean += labels_delta * (total / merged)
+        self.total = merged
+
+    def fit(self, alpha=1.):
+        """Returns (intercepts, coefs, scores) of the samples seen so far,
+        as LimeBase.weighted_ridge."""
+        gram = self.gram.copy()
+        gram.flat[::gram.shape[0] + 1] += alpha
+        coefs = scipy.linalg.cho_solve(scipy.linalg.cho_factor(gram),
+                                       self.cross).T
+        intercepts = self.labels_mean - coefs.dot(self.data_mean)
+
+        residual_ss = self.labels_ss - 2 * (coefs * self.cross.T).sum(1) + \
+            (coefs.dot(self.gram) * coefs).sum(1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(self.labels_ss > 0,
+                              1 - residual_ss / self.labels_ss,
+                              np.where(residual_ss > 0, 0., 1.))
+        return intercepts, coefs, scores
+
+
 class LimeBase(object):
     """Class for learning a locally linear sparse model from perturbed data"""
     def __init__(self,
@@ -105,6 +176,170 @@ class LimeBase(object):
             return self.feature_selection(data, labels, weights,
                                           num_features, n_method)
 
+    def feature_selection_multi(self, data, labels, weights, num_features,
+                                method):
+        """Selects features for every column of a 2d labels array.
+
+        Same as feature_selection applied to each column, but 'none' and
+        'highest_weights' (and 'auto' when it resolves to it) share their
+        work between the columns.
+
+        Returns:
+            list with the selected features of every column
+        """
+        if method == 'auto':
+            if num_features <= 6:
+                method = 'forward_selection'
+            else:
+                method = 'highest_weights'
+        if method == 'none':
+            return [np.array(range(data.shape[1]))] * labels.shape[1]
+        elif method == 'highest_weights':
+            clf = Ridge(alpha=0, fit_intercept=True,
+                        random_state=self.random_state)
+            clf.fit(data, labels, sample_weight=weights)
+            used = []
+            for coef in clf.coef_.reshape(labels.shape[1], -1):
+                feature_weights = sorted(zip(range(data.shape[0]),
+                                             coef * data[0]),
+                                         key=lambda x: np.abs(x[1]),
+                                         reverse=True)
+                used.append(np.array([x[0] for x in
+                                      feature_weights[:num_features]]))
+            return used
+        return [self.feature_selection(data, labels[:, i], weights,
+                                       num_features, method)
+                for i in range(labels.shape[1])]
+
+    @staticmethod
+    def weighted_ridge(data, labels, weights, alpha=1.):
+        """Fits a weighted ridge regression with intercept on every column of
+        labels at once.
+
+        Equivalent to sklearn's Ridge(alpha, fit_intercept=True) fitted on
+        each column with sample_weight=weights, but the weighted Gram matrix
+        is built and factored only once.
+
+        Args:
+            data: 2d array (n_samples, n_features)
+            labels: 2d array (n_samples, n_targets)
+            weights: 1d array of sample weights
+            alpha: regularization strength
+
+        Returns:
+            (intercepts, coefs, scores), where intercepts and scores (the
+            weighted R^2) are arrays (n_targets,) and coefs is an array
+            (n_targets, n_features).
+        """
+        data = np.asarray(data, dtype=float)
+        labels = np.asarray(labels, dtype=float)
+        weights = np.asarray(weights, dtype=float)
+        total = weights.sum()
+        data_mean = weights.dot(data) / total
+        labels_mean = weights.dot(labels) / total
+        centered = data - data_mean
+        weighted = centered * weights[:, np.newaxis]
+        gram = weighted.T.dot(centered)
+        gram.flat[::gram.shape[0] + 1] += alpha
+        rhs = weighted.T.dot(labels - labels_mean)
+        coefs = scipy.linalg.cho_solve(scipy.linalg.cho_factor(gram), rhs).T
+        intercepts = labels_mean - coefs.dot(data_mean)
+
+        residuals = labels - data.dot(coefs.T) - intercepts
+        residual_ss = weights.dot(residuals ** 2)
+        total_ss = weights.dot((labels - labels_mean) ** 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(total_ss > 0, 1 - residual_ss / total_ss,
+                              np.where(residual_ss > 0, 0., 1.))
+        return intercepts, coefs, scores
+
+    def explain_instance_with_data_multi(self,
+                                         neighborhood_data,
+                                         neighborhood_labels,
+                                         distances,
+                                         labels,
+                                         num_features,
+                                         feature_selection='auto',
+                                         model_regressor=None,
+                                         sample_weights=None):
+        """Explains several labels of the same neighborhood.
+
+        Same as calling explain_instance_with_data for each label, but the
+        kernel weights are computed once, feature selection is shared when
+        possible (see feature_selection_multi) and, with the default
+        regressor, the labels that end up with the same features are fitted
+        together with weighted_ridge.
+
+        Args:
+            labels: labels for which we want an explanation
+            the others: see explain_instance_with_data
+
+        Returns:
+            list with an (intercept, exp, score, local_pred) tuple per label,
+            as returned by explain_instance_with_data
+        """
+        labels = list(labels)
+        weights = self.kernel_fn(distances)
+        if sample_weights is not None:
+            weights = weights * sample_weights
+        labels_columns = neighborhood_labels[:, labels]
+        used = self.feature_selection_multi(neighborhood_data,
+                                            labels_columns,
+                                            weights,
+                                            num_features,
+                                            feature_selection)
+        if model_regressor is not None:
+            return [self._fit_label(neighborhood_data, labels_columns[:, i],
+                                    weights, used[i], model_regressor,
+                                    neighborhood_labels[0, label], label)
+                    for i, label in enumerate(labels)]
+
+        groups = {}
+        for i, used_features in enumerate(used):
+            groups.setdefault(tuple(sorted(used_features)), []).append(i)
+        results = [None] * len(labels)
+        for features, columns in groups.items():
+            features = np.array(features, dtype=int)
+            position = dict(zip(features, range(len(features))))
+            intercepts, coefs, scores = self.weighted_ridge(
+                neighborhood_data[:, features], labels_columns[:, columns],
+                weights)
+            for j, i in enumerate(columns):
+                coef = [coefs[j, position[f]] for f in used[i]]
+                local_pred = np.array([intercepts[j] + np.dot(
+                    neighborhood_data[0, used[i]], coef)])
+                if self.verbose:
+                    print('Intercept', intercepts[j])
+                    print('Prediction_local', local_pred,)
+                    print('Right:', neighborhood_labels[0, labels[i]])
+                    print(labels[i])
+                results[i] = (intercepts[j],
+                              sorted(zip(used[i], coef),
+                                     key=lambda x: np.abs(x[1]), reverse=True),
+                              scores[j], local_pred)
+        return results
+
+    def _fit_label(self, data, labels_column, weights, used_features,
+                   model_regressor, right, label):
+        easy_model = model_regressor
+        easy_model.fit(data[:, used_features],
+                       labels_column, sample_weight=weights)
+        prediction_score = easy_model.score(
+            data[:, used_features],
+            labels_column, sample_weight=weights)
+
+        local_pred = easy_model.predict(data[0, used_features].reshape(1, -1))
+
+        if self.verbose:
+            print('Intercept', easy_model.intercept_)
+            print('Prediction_local', local_pred,)
+            print('Right:', right)
+            print(label)
+        return (easy_model.intercept_,
+                sorted(zip(used_features, easy_model.coef_),
+                       key=lambda x: np.abs(x[1]), reverse=True),
+                prediction_score, local_pred)
+
     def explain_instance_with_data(self,
                                    neighborhood_data,
                                    neighborhood_labels,
@@ -112,7 +347,8 @@ class LimeBase(object):
                                    label,
                                    num_features,
                                    feature_selection='auto',
-                                   model_regressor=None):
+                                   model_regressor=None,
+                                   sample_weights=None):
         """Takes perturbed data, labels and distances, returns explanation.
 
         Args:
@@ -138,6 +374,9 @@ class LimeBase(object):
                 Defaults to Ridge regression if None. Must have
                 model_regressor.coef_ and 'sample_weight' as a parameter
                 to model_regressor.fit()
+            sample_weights: optional factors the kernel weights of the
+                samples are multiplied by, e.g. the importance weights of a
+                sampling design (see sampling_designs.py)
 
         Returns:
             (intercept, exp, score):
@@ -149,6 +388,8 @@ class LimeBase(object):
         """
 
         weights = self.kernel_fn(distances)
+        if sample_weights is not None:
+            weights = weights * sample_weights
         #print(neighborhood_labels)
         #print(label)
         labels_column = neighborhood_labels[:, label]
@@ -162,23 +403,6 @@ class LimeBase(object):
         if model_regressor is None:
             model_regressor = Ridge(alpha=1, fit_intercept=True,
                                     random_state=self.random_state)
-        easy_model = model_regressor
-        easy_model.fit(neighborhood_data[:, used_features],
-                       labels_column, sample_weight=weights)
-        prediction_score = easy_model.score(
-            neighborhood_data[:, used_features],
-            labels_column, sample_weight=weights)
-
-        local_pred = easy_model.predict(neighborhood_data[0, used_features].reshape(1, -1))
-
-        if self.verbose:
-            print('Intercept', easy_model.intercept_)
-            #print(easy_model.predict_prob(neighborhood_data[0, used_features].reshape(1, -1)))
-            print('Prediction_local', local_pred,)
-            #print(np.argsort())
-            print('Right:', neighborhood_labels[0, label])
-            print(label)
-        return (easy_model.intercept_,
-                sorted(zip(used_features, easy_model.coef_),
-                       key=lambda x: np.abs(x[1]), reverse=True),
-                prediction_score, local_pred)
+        return self._fit_label(neighborhood_data, labels_column, weights,
+                               used_features, model_regressor,
+                               neighborhood_labels[0, label], label)
@@ -1,7 +1,9 @@
 """
 Functions for explaining classifiers that use Image data.
 """
-import copy
+import json
+import os
+import warnings
 
 import numpy as np
 import sklearn
@@ -10,10 +12,36 @@ from sklearn.utils import check_random_state
 from skimage.color import gray2rgb
 
 try: 
+    from . import batching
+    from . import grid_segmentation
+    from . import image_composition
+    from . import kernel_distances
     from . import lime_base
+    from . import parallel_compose
+    from . import patch_search
+    from . import pipeline
+    from . import prediction_cache
+    from . import random_streams
+    from . import sampling_designs
+    from .image_pool import ImagePool, ImageView, images_digest
+    from .segment_stats import SegmentStatistics
+    from .utils.generic_utils import array_digest
     from .wrappers.scikit_image import SegmentationAlgorithm
 except:
+    import batching
+    import grid_segmentation
+    import image_composition
+    import kernel_distances
     import lime_base
+    import parallel_compose
+    import patch_search
+    import pipeline
+    import prediction_cache
+    import random_streams
+    import sampling_designs
+    from image_pool import ImagePool, ImageView, images_digest
+    from segment_stats import SegmentStatistics
+    from utils.generic_utils import array_digest
     from wrappers.scikit_image import SegmentationAlgorithm
 
 
@@ -25,11 +53,243 @@ class ImageExplanation(object):
             image: 3d numpy array
             segments: 2d numpy array, with the output from skimage.segmentation
         """
+        self._image_loader = None
+        self._segments_loader = None
         self.image = image
         self.segments = segments
         self.intercept = {}
         self.local_exp = {}
         self.local_pred = None
+        self.neighborhood = None
+
+    @property
+    def image(self):
+        """The explained image. Read on first use in explanations returned
+        by load."""
+        if self._image_loader is not None:
+            self._image = self._image_loader()
+            self._image_loader = None
+            if self._segment_stats is not None:
+                self._segment_stats.image = self._image
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self._image_loader = None
+
+    @property
+    def segments(self):
+        """The segment map. Memory-mapped or decompressed on first use in
+        explanations returned by load."""
+        if self._segments_loader is not None:
+            self._segments = self._segments_loader()
+            self._segments_loader = None
+        return self._segments
+
+    @segments.setter
+    def segments(self, segments):
+        self._segments = segments
+        self._segments_loader = None
+        self._segment_stats = None
+
+    @property
+    def segment_stats(self):
+        """SegmentStatistics of the segments, built on first use. It does
+        not read an image that load has not read yet."""
+        if self._segment_stats is None:
+            image = self._image if self._image_loader is not None \
+                else self.image
+            self._segment_stats = SegmentStatistics(self.segments, image)
+        return self._segment_stats
+
+    def save(self, path, image_path=None, store_image=False, compress=False):
+        """Saves the explanation in the directory path (created if needed).
+
+        The directory holds explanation.json (labels, intercepts, scores,
+        timings, and the shape, dtype and digest of the image), the segment
+        map as segments.npy, in uint16 when the labels fit, and the
+        features and float32 weights of all the labels concatenated in
+        features.npy and weights.npy. The levels of hierarchical
+        explanations are saved in levels/0, levels/1, ... (except the
+        explanation itself, the last level). The neighborhood
+        is not saved: loaded explanations cannot be extended.
+
+        Args:
+            path: directory to save into
+            image_path: file the image can be read back from, with np.load
+                for .npy files and skimage.io.imread otherwise. Only the
+                path is stored.
+            store_image: if True, also store the image as image.npy
+            compress: if True, store the segments compressed in
+                segments.npz, which is smaller but cannot be memory-mapped
+
+        Returns:
+            path
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        image = self.image
+        segments = np.asarray(self.segments)
+        if segments.size and segments.min() >= 0 and \
+                segments.max() <= np.iinfo(np.uint16).max:
+            segments = segments.astype(np.uint16)
+        if compress:
+            np.savez_compressed(os.path.join(path, 'segments.npz'),
+                                segments=segments)
+        else:
+            np.save(os.path.join(path, 'segments.npy'), segments)
+
+        labels = sorted(self.local_exp)
+        exps = [self.local_exp[label] for label in labels]
+        offsets = np.cumsum([0] + [len(exp) for exp in exps])
+        np.save(os.path.join(path, 'features.npy'),
+                np.array([f for exp in exps for f, _ in exp], dtype=np.int32))
+        np.save(os.path.join(path, 'weights.npy'),
+                np.array([w for exp in exps for _, w in exp],
+                         dtype=np.float32))
+
+        meta = {
+            'labels': [int(label) for label in labels],
+            'offsets': offsets.tolist(),
+            'intercept': [float(self.intercept[label])
+                          if label in self.intercept else None
+                          for label in labels],
+            'local_pred': _to_json(self.local_pred),
+            'segments': 'segments.npz' if compress else 'segments.npy',
+        }
+        for attr in ('score', 'top_labels', 'timings'):
+            if hasattr(self, attr):
+                meta[attr] = _to_json(getattr(self, attr))
+        if image is not None:
+            image = np.asarray(image)
+            meta['image'] = {'shape': list(image.shape),
+                             'dtype': image.dtype.str,
+                             'digest': array_digest(image)}
+            if image_path is not None:
+                meta['image']['path'] = os.path.abspath(image_path)
+            if store_image:
+                np.save(os.path.join(path, 'image.npy'), image)
+                meta['image']['stored'] = 'image.npy'
+        levels = getattr(self, 'levels', None)
+        if levels:
+            # The last level is usually the explanation itself
+            meta['levels'] = []
+            for i, level in enumerate(levels):
+                if level is self:
+                    meta['levels'].append('.')
+                    continue
+                meta['levels'].append(os.path.join('levels', str(i)))
+                level.save(os.path.join(path, meta['levels'][-1]), image_path,
+                           compress=compress)
+        with open(os.path.join(path, 'explanation.json'), 'w') as f:
+            json.dump(meta, f)
+        return path
+
+    @classmethod
+    def load(cls, path, image=None, mmap_mode='r'):
+        """Loads an explanation saved with save.
+
+        Only explanation.json and the weights are read: the image and the
+        segment map are read on first access, so many explanations can be
+        scanned without touching their pixels.
+
+        Args:
+            path: directory given to save
+            image: the explained image, or a function returning it, used
+                instead of the stored one or the image_path reference. It is
+                checked against the digest of the saved image on first
+                access.
+            mmap_mode: mode the .npy segment map is memory-mapped with, None
+                to read it into memory
+
+        Returns:
+            An ImageExplanation. Its image is None if it was saved without
+            one, or if no image is given and none was referenced or stored.
+        """
+        with open(os.path.join(path, 'explanation.json')) as f:
+            meta = json.load(f)
+        return cls._from_meta(path, meta, _image_loader(path, meta, image),
+                              mmap_mode)
+
+    @classmethod
+    def _from_meta(cls, path, meta, image_loader, mmap_mode):
+        exp = cls(None, None)
+        if image_loader is not None:
+            exp._image_loader = image_loader
+        segments_file = os.path.join(path, meta['segments'])
+        if segments_file.endswith('.npz'):
+            def load_segments():
+                with np.load(segments_file) as stored:
+                    return stored['segments']
+        else:
+            def load_segments():
+                return np.load(segments_file, mmap_mode=mmap_mode)
+        exp._segments_loader = load_segments
+
+        features = np.load(os.path.join(path, 'features.npy'))
+        weights = np.load(os.path.join(path, 'weights.npy'))
+        offsets = meta['offsets']
+        for i, label in enumerate(meta['labels']):
+            exp.local_exp[label] = list(zip(
+                features[offsets[i]:offsets[i + 1]].tolist(),
+                weights[offsets[i]:offsets[i + 1]].tolist()))
+            if meta['intercept'][i] is not None:
+                exp.intercept[label] = meta['intercept'][i]
+        if meta['local_pred'] is not None:
+            exp.local_pred = np.array(meta['local_pred'])
+        for attr in ('score', 'top_labels', 'timings'):
+            if attr in meta:
+                setattr(exp, attr, meta[attr])
+        if 'levels' in meta:
+            exp.levels = []
+            for level_dir in meta['levels']:
+                if level_dir == '.':
+                    exp.levels.append(exp)
+                    continue
+                level_path = os.path.join(path, level_dir)
+                with open(os.path.join(level_path, 'explanation.json')) as f:
+                    level_meta = json.load(f)
+                # The levels share the image of the last one
+                exp.levels.append(cls._from_meta(
+                    level_path, level_meta,
+                    None if image_loader is None else exp._shared_image,
+                    mmap_mode))
+        return exp
+
+    def _shared_image(self):
+        return self.image
+
+    def _shown_features(self, label, positive_only, num_features,
+                        min_weight):
+        """(rank, feature, weight) of the superpixels get_image_and_mask
+        shows with num_features (None for all of them). rank is 1-based:
+        a superpixel is shown with k features if its rank is at most k."""
+        if label not in self.local_exp:
+            raise KeyError('Label not in explanation')
+        exp = self.local_exp[label]
+        if positive_only:
+            exp = [x for x in exp if x[1] > 0 and x[1] > min_weight]
+        if num_features is not None:
+            exp = exp[:num_features]
+        return [(rank + 1, f, w) for rank, (f, w) in enumerate(exp)
+                if positive_only or np.abs(w) >= min_weight]
+
+    def _segment_lut(self, features, values, dtype):
+        """Lookup table from the positions of the segments in segment_stats
+        to values, with features[i] mapped to values[i] and every other
+        segment to 0. Its last entry, also 0, is where features missing from
+        the segmentation go."""
+        stats = self.segment_stats
+        lut = np.zeros(stats.n_segments + 1, dtype=dtype)
+        lut[stats.positions(np.asarray(features, dtype=np.int64))] = values
+        lut[-1] = 0
+        return lut
+
+    def _apply_lut(self, lut):
+        """Per-pixel values of a lookup table built by _segment_lut."""
+        return np.take(lut, self.segment_stats.inverse)\
+            .reshape(self.segments.shape)
 
     def get_image_and_mask(self, label, positive_only=True, hide_rest=False,
                            num_features=5, min_weight=0.):
@@ -51,43 +311,184 @@ class ImageExplanation(object):
             numpy array that can be used with
             skimage.segmentation.mark_boundaries
         """
-        if label not in self.local_exp:
-            raise KeyError('Label not in explanation')
-        segments = self.segments
+        shown = self._shown_features(label, positive_only, num_features,
+                                     min_weight)
         image = self.image
-        exp = self.local_exp[label]
-        mask = np.zeros(segments.shape, segments.dtype)
+        # Mask value of every segment: 1 if shown, or 1 for the negative
+        # and 2 for the positive ones. The channel lit up is mask - 1 (red
+        # or green), always green with positive_only.
+        values = [1 if positive_only or w < 0 else 2 for _, _, w in shown]
+        mask = self._apply_lut(self._segment_lut(
+            [f for _, f, _ in shown], values, self.segments.dtype))
         if hide_rest:
-            temp = np.zeros(self.image.shape)
+            temp = np.zeros(image.shape)
+            temp[mask > 0] = image[mask > 0]
         else:
-            temp = self.image.copy()
+            temp = image.copy()
+        max_value = np.max(image)
         if positive_only:
-            fs = [x[0] for x in exp
-                  if x[1] > 0 and x[1] > min_weight][:num_features]
-            for f in fs:
-                temp[segments == f] = image[segments == f].copy()
-                
-                # Light up the green channel (1) of the image
-                temp[segments == f, 1] = np.max(image)
-                
-                mask[segments == f] = 1
-            return temp, mask
+            temp[mask == 1, 1] = max_value
         else:
-            for f, w in exp[:num_features]:
-                if np.abs(w) < min_weight:
-                    continue
-                c = 0 if w < 0 else 1
-                mask[segments == f] = 1 if w < 0 else 2
-                temp[segments == f] = image[segments == f].copy()
-                
-                # Here is where the red and green areas are set
-                temp[segments == f, c] = np.max(image)
-                
-                for cp in [0, 1, 2]:
-                    if c == cp:
-                        continue
-                    # temp[segments == f, cp] *= 0.5
-            return temp, mask
+            # Here is where the red and green areas are set
+            temp[mask == 1, 0] = max_value
+            temp[mask == 2, 1] = max_value
+        return temp, mask
+
+    def get_masks(self, label, max_features=None, positive_only=True,
+                  min_weight=0., cumulative=False):
+        """Masks of get_image_and_mask for num_features = 1 to max_features,
+        rendered with a single lookup over the segments.
+
+        Args:
+            label: label to explain
+            max_features: largest number of superpixels shown. None for all
+                the ones in the explanation.
+            positive_only, min_weight: see get_image_and_mask
+            cumulative: if True, return the rank map instead of the stack
+
+        Returns:
+            A (max_features, H, W) array whose k - 1-th slice is the mask
+            get_image_and_mask returns with num_features=k or, if
+            cumulative, an (H, W) rank map: 0 for the pixels never shown,
+            otherwise the smallest num_features that shows them.
+        """
+        shown = self._shown_features(label, positive_only, max_features,
+                                     min_weight)
+        if max_features is None:
+            max_features = len(shown) if positive_only else \
+                len(self.local_exp[label])
+        features = [f for _, f, _ in shown]
+        ranks = self._apply_lut(self._segment_lut(
+            features, [rank for rank, _, _ in shown], np.intp))
+        if cumulative:
+            return ranks
+        values = self._apply_lut(self._segment_lut(
+            features, [1 if positive_only or w < 0 else 2
+                       for _, _, w in shown], self.segments.dtype))
+        k = np.arange(1, max_features + 1)[:, np.newaxis, np.newaxis]
+        return np.where((ranks > 0) & (ranks <= k), values,
+                        np.zeros((), self.segments.dtype))
+
+
+def _to_json(value):
+    """value with its numpy arrays and scalars turned into lists and
+    Python numbers, for json.dump."""
+    if isinstance(value, dict):
+        return dict((str(k), _to_json(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _image_loader(path, meta, image):
+    """Function reading the image of a saved explanation and checking it
+    against the saved digest, or None if there is no image to read."""
+    info = meta.get('image')
+    if info is None:
+        return None
+    if image is None:
+        if 'stored' in info:
+            stored = os.path.join(path, info['stored'])
+            image = lambda: np.load(stored)
+        elif 'path' in info:
+            image_path = info['path']
+            if image_path.endswith('.npy'):
+                image = lambda: np.load(image_path)
+            else:
+                def image():
+                    from skimage.io import imread
+                    return imread(image_path)
+        else:
+            return None
+
+    def load():
+        loaded = np.asarray(image() if callable(image) else image)
+        if array_digest(loaded) != info['digest']:
+            raise ValueError('The image does not match the explanation '
+                             'saved in %s' % path)
+        return loaded
+    return load
+
+
+class Neighborhood(object):
+    """Perturbation rows and predictions an explanation is fitted on.
+
+    Kept in the neighborhood attribute of the explanations that can be
+    extended with more samples (see LimeImageExplainer.extend_explanation),
+    together with what is needed to compose and predict more rows.
+    """
+
+    def __init__(self, image_id, data, compose, row_keys, distance_metric):
+        """Init function.
+
+        Args:
+            image_id: number of the explained image in the random streams
+            data: binary perturbation matrix drawn so far
+            compose: image_composition.Composer of the rows of data
+            row_keys: prediction cache keys of rows (see
+                LimeImageExplainer._neighborhood)
+            distance_metric: metric of the distances the kernel weights are
+                computed from
+        """
+        self.image_id = image_id
+        self.data = data
+        self.labels = None
+        self.compose = compose
+        self.row_keys = row_keys
+        self.distance_metric = distance_metric
+        self.explain_args = None
+        self.tracked = None
+        self.kernel_fn = None
+        self.sampling_design = None
+        self.ridge = None
+        self.history = []
+
+    def __len__(self):
+        return len(self.data)
+
+    def add_labels(self, labels):
+        """Appends the predictions of the rows of data not predicted yet."""
+        start = 0 if self.labels is None else len(self.labels)
+        labels = np.asarray(labels)
+        if self.labels is None:
+            self.labels = labels
+        else:
+            self.labels = np.concatenate((self.labels, labels))
+        if self.ridge is not None:
+            self._update_ridge(start)
+
+    def track(self, labels, kernel_fn, sampling_design=None):
+        """Starts fitting an IncrementalRidge on the given label columns,
+        refitted every time predictions are added."""
+        self.tracked = list(labels)
+        self.kernel_fn = kernel_fn
+        self.sampling_design = sampling_design
+        self.ridge = lime_base.IncrementalRidge(self.data.shape[1],
+                                                len(self.tracked))
+        self._update_ridge(0)
+
+    def _update_ridge(self, start):
+        rows = self.data[start:len(self.labels)]
+        with_first = np.concatenate((self.data[:1], rows))
+        weights = self.kernel_fn(kernel_distances.distances_to_first(
+            with_first, self.distance_metric))[1:]
+        if self.sampling_design is not None:
+            sample_weights = self.sampling_design.sample_weights(with_first)
+            if sample_weights is not None:
+                weights = weights * sample_weights[1:]
+        self.ridge.update(rows, self.labels[start:, self.tracked], weights)
+
+    def ranking(self, top_k):
+        """Returns (rankings, scores) of the tracked labels: the top_k
+        features by absolute ridge coefficient, in order, and the R^2 of the
+        fit on all the features. Also recorded in history."""
+        _, coefs, scores = self.ridge.fit()
+        rankings = [tuple(np.argsort(-np.abs(c), kind='mergesort')[:top_k])
+                    for c in coefs]
+        self.history.append((len(self.labels), scores))
+        return rankings, scores
 
 
 class LimeImageExplainer(object):
@@ -100,7 +501,9 @@ class LimeImageExplainer(object):
     explained."""
 
     def __init__(self, kernel_width=.25, verbose=False,
-                 feature_selection='auto', random_state=None):
+                 feature_selection='auto', random_state=None,
+                 prediction_cache=None, segmentation_cache=None,
+                 rng_seed=None, sampling_design=None):
         """Init function.
 
         Args:
@@ -114,6 +517,26 @@ class LimeImageExplainer(object):
             random_state: an integer or numpy.RandomState that will be used to
                 generate random numbers. If None, the random state will be
                 initialized using the internal numpy seed.
+            prediction_cache: a PredictionCache (see prediction_cache.py).
+                If given, perturbed images already predicted, within a
+                neighborhood or by an earlier explanation of the same image
+                with the same classifier_fn, are not predicted again. Not
+                used when the neighborhood images are returned.
+            segmentation_cache: a SegmentationCache (see
+                segmentation_cache.py). If given, the default quickshift
+                segmentations are read from and stored in it.
+            rng_seed: if not None, every random draw made to explain an
+                image (segmentation seed, perturbations, donor images) comes
+                from numpy Generators derived from this seed, the number of
+                the explained image and the chunk of neighborhood rows (see
+                random_streams.py), instead of random_state and Python's
+                global random module. The explanations of the n-th image
+                then only depend on rng_seed and n.
+            sampling_design: if not None, a sampling_designs.SamplingDesign,
+                or the name of one ('antithetic', 'balanced', 'sobol' or
+                'kernel', which follows kernel_width and the cosine
+                distance), drawing the perturbed rows instead of independent
+                coin flips. See sampling_designs.py.
         """
         kernel_width = float(kernel_width)
 
@@ -123,6 +546,21 @@ class LimeImageExplainer(object):
         self.random_state = check_random_state(random_state)
         self.feature_selection = feature_selection
         self.base = lime_base.LimeBase(kernel, verbose, random_state=self.random_state)
+        self.sampling_design = None
+        if sampling_design is not None:
+            self.sampling_design = sampling_designs.get_design(sampling_design,
+                                                               kernel)
+        self.prediction_cache = prediction_cache
+        self.segmentation_cache = segmentation_cache
+        self.random_streams = None
+        if rng_seed is not None:
+            self.random_streams = random_streams.RandomStreams(rng_seed)
+        self.image_counter = 0
+        self.image_id = 0
+        self._prepare_rng = None
+        self.timings = {}
+        # (pool, digest) of the pools of images keyed by content
+        self._pool_digests = []
 
     def explain_instance(self, image, classifier_fn, labels=(1,),
                          hide_color=None,
@@ -132,7 +570,12 @@ class LimeImageExplainer(object):
                          distance_metric='cosine',
                          model_regressor=None,
                          random_seed=None,
-                         return_sample_neighborhood_images=False):
+                         return_sample_neighborhood_images=False,
+                         pipelined=False,
+                         max_memory_mb=None,
+                         processes=None,
+                         preprocess_fn=None,
+                         keep_neighborhood=False):
         """Generates explanations for a prediction.
 
         First, we generate neighborhood data by randomly perturbing features
@@ -153,80 +596,694 @@ class LimeImageExplainer(object):
                 this parameter.
             num_features: maximum number of features present in explanation
             num_samples: size of the neighborhood to learn the linear model
-            batch_size: TODO
+            batch_size: number of perturbed images classifier_fn is called
+                on, or 'auto' to start from small batches and grow them while
+                the measured throughput of classifier_fn improves.
             distance_metric: the distance metric to use for weights.
             model_regressor: sklearn regressor to use in explanation. Defaults
             to Ridge regression in LimeBase. Must have model_regressor.coef_
             and 'sample_weight' as a parameter to model_regressor.fit()
             segmentation_fn: SegmentationAlgorithm, wrapped skimage
-            segmentation function
+            segmentation function. It may also return an
+            image_composition.GridSegments; grid segmentations, returned
+            either way, are composed block-wise.
             random_seed: integer used as random seed for the segmentation
                 algorithm. If None, a random integer, between 0 and 1000,
                 will be generated using the internal random number generator.
+            return_sample_neighborhood_images: if True, also return the
+                perturbed images (see data_labels).
+            pipelined: if True, the next batch of perturbed images is composed
+                in a background thread while classifier_fn runs on the
+                current one. The seconds spent in each stage are stored in
+                the timings attribute of the explanation.
+            max_memory_mb: memory budget, in megabytes, for the perturbed
+                images alive at the same time. Batches are never larger than
+                what fits in it. The batch sizes used and the measured
+                throughput of classifier_fn are stored in the timings
+                attribute of the explanation.
+            processes: if not None, the perturbed images are composed by
+                this many worker processes, or by the processes of a
+                parallel_compose.ComposeWorkers kept across calls (see
+                data_labels).
+            preprocess_fn: optional function applied to every batch of
+                perturbed images right before classifier_fn, e.g. to cast
+                uint8 images to the float input of a network. The
+                neighborhood itself stays in the dtype of image.
+            keep_neighborhood: if True, the perturbation rows and their
+                predictions are kept in the neighborhood attribute of the
+                explanation, which can then be extended with more samples
+                (see extend_explanation). Not compatible with
+                return_sample_neighborhood_images and processes.
 
         Returns:
             An Explanation object (see explanation.py) with the corresponding
             explanations.
         """
+        self._start_image()
+        image, segments, fudged_image, fudged_images_pool = \
+            self._prepare_instance(image, hide_color, segmentation_fn,
+                                   random_seed)
+
+        top = labels
+
+        if keep_neighborhood:
+            if return_sample_neighborhood_images or processes is not None:
+                raise ValueError('keep_neighborhood cannot be used with '
+                                 'return_sample_neighborhood_images or '
+                                 'processes')
+            neighborhood = self._new_neighborhood(
+                image, fudged_image, segments, fudged_images_pool,
+                num_samples, distance_metric)
+            self._predict_neighborhood(neighborhood, classifier_fn,
+                                       batch_size, pipelined, max_memory_mb,
+                                       preprocess_fn)
+            return self._explain_neighborhood(image, segments, neighborhood,
+                                              top, top_labels, num_features,
+                                              model_regressor)
+
+        if return_sample_neighborhood_images:
+            data, labels, sam = self.data_labels(
+                image, fudged_image, segments, classifier_fn, num_samples,
+                batch_size=batch_size,
+                return_sample_neighborhood_images=return_sample_neighborhood_images,
+                fudged_images_pool=fudged_images_pool,
+                pipelined=pipelined,
+                max_memory_mb=max_memory_mb,
+                processes=processes,
+                preprocess_fn=preprocess_fn)
+        else:
+            data, labels = self.data_labels(
+                image, fudged_image, segments, classifier_fn, num_samples,
+                batch_size=batch_size,
+                return_sample_neighborhood_images=return_sample_neighborhood_images,
+                fudged_images_pool=fudged_images_pool,
+                pipelined=pipelined,
+                max_memory_mb=max_memory_mb,
+                processes=processes,
+                preprocess_fn=preprocess_fn)
+
+        ret_exp = self._build_explanation(image, segments, data, labels, top,
+                                          top_labels, num_features,
+                                          distance_metric, model_regressor)
+        if(return_sample_neighborhood_images):
+            return ret_exp, sam
+        return ret_exp
+
+    def explain_instances(self, images, classifier_fn, labels=(1,),
+                          hide_color=None,
+                          top_labels=5, num_features=100000, num_samples=1000,
+                          batch_size=100,
+                          segmentation_fn=None,
+                          distance_metric='cosine',
+                          model_regressor=None,
+                          random_seed=None,
+                          pipelined=False,
+                          max_memory_mb=None,
+                          processes=None,
+                          preprocess_fn=None):
+        """Generates explanations for the predictions on several images.
+
+        The perturbed samples of all the images are packed together, so
+        classifier_fn is called on batches of batch_size samples regardless
+        of num_samples, and the predictions are routed back to the image
+        they were generated from. With the same random state, the result is
+        the same as calling explain_instance on each image in turn.
+
+        Args:
+            images: sequence of images with the same shape. See
+                explain_instance for the other arguments.
+            batch_size: number of perturbed samples, possibly taken from
+                different images, classifier_fn is called on, or 'auto'.
+            processes: if not None, the perturbed images are composed by
+                this many worker processes, started once for all the images,
+                or by the processes of a parallel_compose.ComposeWorkers
+                kept across calls.
+
+        Returns:
+            A list with one ImageExplanation per image.
+        """
+        workers = processes
+        if processes is not None and \
+                not isinstance(processes, parallel_compose.ComposeWorkers):
+            workers = parallel_compose.ComposeWorkers(processes)
+        instances = []
+        try:
+            for image in images:
+                self._start_image()
+                image, segments, fudged_image, fudged_images_pool = \
+                    self._prepare_instance(image, hide_color,
+                                           segmentation_fn, random_seed)
+                data, compose, row_keys = self._neighborhood(
+                    image, fudged_image, segments, num_samples,
+                    fudged_images_pool)
+                if workers is not None:
+                    compose = parallel_compose.ProcessComposer(compose, data,
+                                                               workers)
+                instances.append((image, segments, data, compose, row_keys))
+            predictions = self._predict_instances(
+                instances, classifier_fn, batch_size, pipelined,
+                max_memory_mb, preprocess_fn)
+        finally:
+            if workers is not None:
+                for inst in instances:
+                    inst[3].close()
+                if workers is not processes:
+                    workers.close()
+        if workers is not None:
+            self.timings['processes'] = workers.processes
+
+        offsets = np.cumsum([0] + [len(inst[2]) for inst in instances])
+        explanations = []
+        for i, (image, segments, data, _, _) in enumerate(instances):
+            explanations.append(self._build_explanation(
+                image, segments, data,
+                predictions[offsets[i]:offsets[i + 1]], labels, top_labels,
+                num_features, distance_metric, model_regressor))
+        return explanations
+
+    def _predict_instances(self, instances, classifier_fn, batch_size,
+                           pipelined, max_memory_mb, preprocess_fn):
+        """Predictions on the neighborhoods of several images, packed in
+        shared batches (see explain_instances)."""
+        offsets = np.cumsum([0] + [len(inst[2]) for inst in instances])
+
+        def compose(rows, index):
+            imgs = []
+            for i, (_, _, data, compose_rows, _) in enumerate(instances):
+                local = index[(index >= offsets[i]) &
+                              (index < offsets[i + 1])] - offsets[i]
+                if len(local):
+                    imgs.append(compose_rows(data[local], local))
+            return np.concatenate(imgs)
+
+        keys = None
+        if self.prediction_cache is not None and \
+                all(inst[4] is not None for inst in instances):
+            keys = []
+            for inst in instances:
+                keys.extend(self._cache_keys(classifier_fn, inst[4],
+                                             preprocess_fn))
+
+        sizer = self._batch_sizer(instances[0][0], batch_size, max_memory_mb,
+                                  pipelined)
+        predictions, _, self.timings = pipeline.predict_batches(
+            compose, self._classifier(classifier_fn, preprocess_fn),
+            np.arange(offsets[-1]), sizer,
+            pipelined=pipelined, keys=keys, cache=self.prediction_cache)
+        return np.array(predictions)
+
+    def explain_instance_adaptive(self, image, classifier_fn, labels=(1,),
+                                  hide_color=None,
+                                  top_labels=5, num_features=100000,
+                                  max_samples=1000, round_size=100,
+                                  min_samples=0, top_k=10, tolerance=0.01,
+                                  batch_size=10,
+                                  segmentation_fn=None,
+                                  distance_metric='cosine',
+                                  model_regressor=None,
+                                  random_seed=None,
+                                  pipelined=False,
+                                  max_memory_mb=None,
+                                  preprocess_fn=None):
+        """Generates explanations for a prediction, with as many samples as
+        the explanation needs to settle.
+
+        The neighborhood is drawn and predicted in rounds of round_size
+        samples. After every round, a weighted ridge regression on all the
+        superpixels is refitted for each explained label from running Gram
+        matrices (see lime_base.IncrementalRidge), so a round costs the same
+        whatever the number of samples before it. Sampling stops when, from
+        one round to the next, the top_k superpixels of every label by
+        absolute coefficient keep the same order and the R^2 of every label
+        moves by at most tolerance, or when max_samples samples are reached.
+        The explanation is then fitted on the whole neighborhood as in
+        explain_instance.
+
+        Args:
+            max_samples: maximum size of the neighborhood
+            round_size: number of samples drawn and predicted per round
+            min_samples: size of the neighborhood below which sampling does
+                not stop
+            top_k: number of top superpixels whose order must be stable
+            tolerance: maximum change of R^2 between rounds
+            the others: see explain_instance
+
+        Returns:
+            An ImageExplanation. Its neighborhood attribute holds the samples
+            and, in neighborhood.history, the number of samples and the R^2
+            of the explained labels after every round. It can be extended
+            with extend_explanation.
+        """
+        self._start_image()
+        image, segments, fudged_image, fudged_images_pool = \
+            self._prepare_instance(image, hide_color, segmentation_fn,
+                                   random_seed)
+        neighborhood = self._new_neighborhood(
+            image, fudged_image, segments, fudged_images_pool,
+            min(round_size, max_samples), distance_metric)
+        predict_args = (classifier_fn, batch_size, pipelined, max_memory_mb,
+                        preprocess_fn)
+        self._predict_neighborhood(neighborhood, *predict_args)
+
+        explained = labels
+        if top_labels:
+            explained = np.argsort(neighborhood.labels[0])[-top_labels:]
+        neighborhood.track(explained, self.base.kernel_fn,
+                           self.sampling_design)
+        rankings, scores = neighborhood.ranking(top_k)
+        while len(neighborhood) < max_samples:
+            self._add_samples(neighborhood,
+                              min(round_size, max_samples - len(neighborhood)),
+                              *predict_args)
+            previous, previous_scores = rankings, scores
+            rankings, scores = neighborhood.ranking(top_k)
+            if len(neighborhood) >= min_samples and rankings == previous and \
+                    (np.abs(scores - previous_scores) <= tolerance).all():
+                break
+        return self._explain_neighborhood(image, segments, neighborhood,
+                                          labels, top_labels, num_features,
+                                          model_regressor)
+
+    def explain_instance_hierarchical(self, image, classifier_fn,
+                                      grid_sizes=(4, 8, 16, 32, 64),
+                                      num_samples=100, refine=0.25,
+                                      labels=(1,), top_labels=5, **kwargs):
+        """Generates explanations on a grid refined where they matter.
+
+        The image is first explained on a grid_sizes[0] grid (see
+        grid_segmentation.gridSegmentation). At every next level, the
+        ceil(refine * n) top ranked of the n segments of the current map, by
+        absolute weight for the first explained label, are split along the
+        grid of the next size, and the image is explained again on the
+        merged map. Fine cells thus only cover the regions the coarser
+        levels found important, and each level has far fewer features than
+        the flat grid of the same size.
+
+        The segment maps are labelled 0 to n - 1, so unlike with a flat
+        gridSegmentation every cell is a feature.
+
+        Args:
+            grid_sizes: grid size of every level, from coarse to fine
+            num_samples: neighborhood size of every level, or a sequence
+                with the size of each level
+            refine: fraction of the segments split at every level
+            kwargs: the other arguments of explain_instance, except
+                segmentation_fn and return_sample_neighborhood_images
+
+        Returns:
+            The ImageExplanation of the last level, whose segments are the
+            merged map. Its levels attribute holds the ImageExplanations of
+            all the levels, and its timings attribute has the total number
+            of 'samples'.
+        """
+        grid_sizes = list(grid_sizes)
+        if np.ndim(num_samples) == 0:
+            num_samples = [num_samples] * len(grid_sizes)
+        if len(num_samples) != len(grid_sizes):
+            raise ValueError('num_samples must have one entry per level')
+
+        segments = np.unique(grid_segmentation.gridSegmentation(
+            grid_sizes[0], image), return_inverse=True)[1].reshape(
+                image.shape[:2])
+        levels = []
+        for level, (size, n) in enumerate(zip(grid_sizes, num_samples)):
+            if level > 0:
+                previous = levels[-1]
+                label = previous.top_labels[0] if top_labels else labels[0]
+                ranked = [f for f, _ in previous.local_exp[label]]
+                n_split = int(np.ceil(refine * len(np.unique(segments))))
+                segments = grid_segmentation.refine_segments(
+                    segments, grid_segmentation.gridSegmentation(size, image),
+                    ranked[:n_split])
+            levels.append(self.explain_instance(
+                image, classifier_fn, labels=labels, top_labels=top_labels,
+                num_samples=n,
+                segmentation_fn=lambda img, segments=segments: segments,
+                **kwargs))
+        ret_exp = levels[-1]
+        ret_exp.levels = levels
+        ret_exp.timings = dict(ret_exp.timings, samples=sum(num_samples))
+        return ret_exp
+
+    def explain_instance_multiscale(self, image, classifier_fn,
+                                    grid_sizes=(4, 8, 16, 32, 64),
+                                    labels=(1,),
+                                    hide_color=None,
+                                    top_labels=5, num_features=100000,
+                                    num_samples=1000,
+                                    batch_size=10,
+                                    distance_metric='cosine',
+                                    model_regressor=None,
+                                    random_seed=None,
+                                    pipelined=False,
+                                    max_memory_mb=None,
+                                    preprocess_fn=None,
+                                    max_condition=1e8):
+        """Generates explanations on several grids from one neighborhood.
+
+        The neighborhood is drawn and predicted once, on the finest grid
+        (see grid_segmentation.gridSegmentation). For every coarser grid,
+        each cell gets as feature the fraction of its pixels the perturbed
+        sample keeps (see image_composition.coarsen_rows), i.e. the fraction
+        of its child cells turned on when the grids are nested, and the
+        surrogate models are fitted on these features and the same
+        predictions. Sweeping grid sizes then costs one neighborhood instead
+        of one per size.
+
+        Coarse features vary little around their mean (the more child cells,
+        the less), so they are fitted with a ridge regression on features
+        rescaled to the spread of binary ones, without feature selection
+        (the num_features largest weights are kept), and the kernel weights
+        of the fine samples. Cells without pixels are left out. The condition
+        number of the ridge system is stored in the condition attribute of
+        the coarse explanations, with a warning above max_condition.
+
+        The explanations of a grid use its gridSegmentation as segments,
+        with the same feature ids as explain_instance with that
+        segmentation. With hide_color None, the turned-off cells show the
+        mean colors of the finest cells.
+
+        Args:
+            grid_sizes: grid sizes to explain the image at
+            max_condition: condition number of the coarse ridge systems above
+                which a warning is issued
+            the others: see explain_instance
+
+        Returns:
+            dict mapping every grid size to its ImageExplanation
+        """
+        grid_sizes = sorted(set(grid_sizes))
+        finest = grid_sizes[-1]
+        self._start_image()
+        image, segments, fudged_image, fudged_images_pool = \
+            self._prepare_instance(
+                image, hide_color,
+                lambda img: grid_segmentation.gridSegmentation(finest, img),
+                random_seed)
+        data, labels_matrix = self.data_labels(
+            image, fudged_image, segments, classifier_fn, num_samples,
+            batch_size=batch_size, fudged_images_pool=fudged_images_pool,
+            pipelined=pipelined, max_memory_mb=max_memory_mb,
+            preprocess_fn=preprocess_fn)
+
+        fine_index = image_composition.SegmentIndex(segments, data.shape[1])
+        explanations = {}
+        for size in grid_sizes:
+            if size == finest:
+                explanations[size] = self._build_explanation(
+                    image, segments, data, labels_matrix, labels, top_labels,
+                    num_features, distance_metric, model_regressor)
+                continue
+            grid_segments = grid_segmentation.gridSegmentation(size, image)
+            grid_data = image_composition.coarsen_rows(
+                data, fine_index, image_composition.SegmentIndex(grid_segments))
+            explanations[size] = self._build_coarse_explanation(
+                image, grid_segments, grid_data, data, labels_matrix, labels,
+                top_labels, num_features, distance_metric, max_condition)
+        return explanations
+
+    def _build_coarse_explanation(self, image, segments, grid_data, data,
+                                  labels, top, top_labels, num_features,
+                                  distance_metric, max_condition):
+        """Fits the local models of a coarse grid of
+        explain_instance_multiscale on the fractional rows grid_data
+        derived from the binary rows data."""
+        ret_exp = ImageExplanation(image, segments)
+        ret_exp.timings = self.timings
+        if top_labels:
+            top = np.argsort(labels[0])[-top_labels:]
+            ret_exp.top_labels = list(top)
+            ret_exp.top_labels.reverse()
+        top = list(top)
+
+        weights = self.base.kernel_fn(
+            kernel_distances.distances_to_first(data, distance_metric))
+        if self.sampling_design is not None:
+            sample_weights = self.sampling_design.sample_weights(data)
+            if sample_weights is not None:
+                weights = weights * sample_weights
+        mean = weights.dot(grid_data) / weights.sum()
+        spread = np.sqrt(weights.dot((grid_data - mean) ** 2) / weights.sum())
+        used = np.flatnonzero(spread > 0)
+        # Binary features turned on half of the time have a spread of 1/2
+        scale = 2 * spread[used]
+        scaled = grid_data[:, used] / scale
+        intercepts, coefs, scores = self.base.weighted_ridge(
+            scaled, labels[:, top], weights)
+
+        centered = scaled - weights.dot(scaled) / weights.sum()
+        eigenvalues = np.linalg.eigvalsh(
+            (centered * weights[:, np.newaxis]).T.dot(centered))
+        # weighted_ridge adds alpha = 1 to the diagonal
+        ret_exp.condition = (eigenvalues[-1] + 1.) / (eigenvalues[0] + 1.) \
+            if len(used) else 1.
+        if ret_exp.condition > max_condition:
+            warnings.warn('The ridge system of a %d-cell grid has condition '
+                          'number %g' % (grid_data.shape[1],
+                                         ret_exp.condition))
+
+        coefs = coefs / scale
+        for i, label in enumerate(top):
+            ret_exp.intercept[label] = intercepts[i]
+            ret_exp.local_exp[label] = sorted(
+                zip(used.tolist(), coefs[i]), key=lambda x: np.abs(x[1]),
+                reverse=True)[:num_features]
+            ret_exp.score = scores[i]
+            ret_exp.local_pred = np.array(
+                [intercepts[i] + grid_data[0, used].dot(coefs[i])])
+        return ret_exp
+
+    def extend_explanation(self, explanation, classifier_fn, num_samples,
+                           batch_size=10, pipelined=False, max_memory_mb=None,
+                           preprocess_fn=None):
+        """Adds samples to the neighborhood of an explanation and refits it.
+
+        Only the new samples are composed and predicted. The explanation must
+        have been generated by this explainer with keep_neighborhood=True or
+        by explain_instance_adaptive, and classifier_fn and preprocess_fn
+        must be the ones it was generated with.
+
+        Args:
+            explanation: ImageExplanation to extend
+            num_samples: number of samples to add
+            the others: see explain_instance
+
+        Returns:
+            A new ImageExplanation, fitted on the extended neighborhood, which
+            can be extended in turn. The neighborhood is shared with the
+            given explanation.
+        """
+        neighborhood = explanation.neighborhood
+        if neighborhood is None:
+            raise ValueError('The explanation has no neighborhood, see '
+                             'keep_neighborhood in explain_instance')
+        self._add_samples(neighborhood, num_samples, classifier_fn,
+                          batch_size, pipelined, max_memory_mb, preprocess_fn)
+        if neighborhood.ridge is not None:
+            neighborhood.ranking(0)
+        return self._explain_neighborhood(explanation.image,
+                                          explanation.segments, neighborhood,
+                                          *neighborhood.explain_args)
+
+    def _new_neighborhood(self, image, fudged_image, segments,
+                          fudged_images_pool, num_samples, distance_metric):
+        data, compose, row_keys = self._neighborhood(
+            image, fudged_image, segments, num_samples, fudged_images_pool)
+        return Neighborhood(self.image_id, data, compose, row_keys,
+                            distance_metric)
+
+    def _predict_neighborhood(self, neighborhood, classifier_fn, batch_size,
+                              pipelined, max_memory_mb, preprocess_fn):
+        """Predicts the rows of the neighborhood not predicted yet."""
+        start = 0 if neighborhood.labels is None else len(neighborhood.labels)
+        rows = neighborhood.data[start:]
+
+        def compose(rows, index):
+            return neighborhood.compose(rows, index + start)
+
+        keys = None
+        if neighborhood.row_keys is not None:
+            keys = self._cache_keys(
+                classifier_fn, lambda: neighborhood.row_keys(rows, start),
+                preprocess_fn)
+        sizer = self._batch_sizer(neighborhood.compose.image, batch_size,
+                                  max_memory_mb, pipelined)
+        labels, _, self.timings = pipeline.predict_batches(
+            compose, self._classifier(classifier_fn, preprocess_fn), rows,
+            sizer, pipelined=pipelined, keys=keys,
+            cache=self.prediction_cache)
+        neighborhood.add_labels(labels)
+
+    def _add_samples(self, neighborhood, num_samples, classifier_fn,
+                     batch_size, pipelined, max_memory_mb, preprocess_fn):
+        """Draws num_samples more rows (and donors) for the neighborhood
+        and predicts them."""
+        image_id = self.image_id
+        self.image_id = neighborhood.image_id
+        try:
+            start = len(neighborhood)
+            rows = self._draw_more_data(neighborhood.data.shape[1], start,
+                                        start + num_samples)
+            compose = neighborhood.compose
+            if compose.donors is not None:
+                compose.donors = np.concatenate(
+                    (compose.donors,
+                     self._draw_more_donors(rows, compose, start)))
+        finally:
+            self.image_id = image_id
+        neighborhood.data = np.concatenate((neighborhood.data, rows))
+        self._predict_neighborhood(neighborhood, classifier_fn, batch_size,
+                                   pipelined, max_memory_mb, preprocess_fn)
+
+    def _explain_neighborhood(self, image, segments, neighborhood, top,
+                              top_labels, num_features, model_regressor):
+        ret_exp = self._build_explanation(image, segments, neighborhood.data,
+                                          neighborhood.labels, top,
+                                          top_labels, num_features,
+                                          neighborhood.distance_metric,
+                                          model_regressor)
+        neighborhood.explain_args = (top, top_labels, num_features,
+                                     model_regressor)
+        ret_exp.neighborhood = neighborhood
+        return ret_exp
+
+    def _start_image(self):
+        """Moves the random streams on to the next explained image."""
+        self.image_id = self.image_counter
+        self.image_counter += 1
+        self._prepare_rng = None
+
+    def _prepare_generator(self):
+        if self._prepare_rng is None:
+            self._prepare_rng = self.random_streams.generator(
+                self.image_id, random_streams.PREPARE)
+        return self._prepare_rng
+
+    def _segmentation_seed(self):
+        """Draws the random seed of the default segmentation."""
+        if self.random_streams is None:
+            return self.random_state.randint(0, high=1000)
+        return int(self._prepare_generator().integers(0, 1000))
+
+    def _choose_image(self, images):
+        """Draws one of images."""
+        if self.random_streams is None:
+            import random
+            return random.choice(images)
+        return images[int(self._prepare_generator().integers(len(images)))]
+
+    def _draw_data(self, num_samples, n_features, start=0, stop=None):
+        """Draws rows [start, stop) (all by default) of the binary
+        perturbation matrix. Row 0, the original image, is all ones.
+
+        With random streams, any range of rows can be drawn on its own;
+        without, only the whole matrix can."""
+        if stop is None:
+            stop = num_samples
+        if self.sampling_design is not None:
+            data = np.concatenate((
+                np.ones((1, n_features), dtype=np.uint8),
+                self.sampling_design.rows(num_samples - 1, n_features,
+                                          self._design_generator(0))))
+            return data[start:stop]
+        if self.random_streams is None:
+            data = self.random_state.randint(0, 2, num_samples * n_features)\
+                .reshape((num_samples, n_features))[start:stop]\
+                .astype(np.uint8)
+        else:
+            data = self.random_streams.binary_rows(self.image_id, n_features,
+                                                   start, stop)
+        if start == 0 and stop > 0:
+            data[0, :] = 1
+        return data
+
+    def _draw_more_data(self, n_features, start, stop):
+        """Draws rows [start, stop) of a neighborhood whose first start
+        rows are already drawn. Without random streams, they are simply the
+        next draws of random_state. A sampling design draws them as a block
+        of its own."""
+        if self.sampling_design is not None:
+            return self.sampling_design.rows(stop - start, n_features,
+                                             self._design_generator(start))
+        if self.random_streams is None:
+            return self.random_state.randint(0, 2, (stop - start) * n_features)\
+                .reshape((stop - start, n_features)).astype(np.uint8)
+        return self._draw_data(stop, n_features, start, stop)
+
+    def _design_generator(self, start):
+        """Random state of the sampling design for the block of rows from
+        start on."""
+        if self.random_streams is None:
+            return self.random_state
+        return self.random_streams.generator(self.image_id,
+                                             random_streams.DESIGN, start)
+
+    def _draw_more_donors(self, rows, compose, start):
+        """Draws the donors of rows, the rows of the neighborhood from start
+        on, for a compose built with a pool."""
+        return self._draw_donors(rows, len(compose.pool), start)
+
+    def _default_segmentation(self, random_seed):
+        return SegmentationAlgorithm('quickshift', kernel_size=4,
+                                     max_dist=200, ratio=0.2,
+                                     random_seed=random_seed,
+                                     cache=self.segmentation_cache)
+
+    def _prepare_instance(self, image, hide_color, segmentation_fn,
+                          random_seed):
+        """Segments the image and builds what is shown in place of the
+        turned-off superpixels.
+
+        Returns:
+            (image, segments, fudged_image, fudged_images_pool)
+        """
         if len(image.shape) == 2:
             image = gray2rgb(image)
         if random_seed is None:
-            random_seed = self.random_state.randint(0, high=1000)
+            random_seed = self._segmentation_seed()
 
         if segmentation_fn is None:
-            segmentation_fn = SegmentationAlgorithm('quickshift', kernel_size=4,
-                                                    max_dist=200, ratio=0.2,
-                                                    random_seed=random_seed)
+            segmentation_fn = self._default_segmentation(random_seed)
         try:
             segments = segmentation_fn(image)
         except ValueError as e:
             raise e
+        segments = image_composition.segments_array(segments)
 
-        fudged_image = image.copy()
         if hide_color is None:
-            for x in np.unique(segments):
-                fudged_image[segments == x] = (
-                    np.mean(image[segments == x][:, 0]),
-                    np.mean(image[segments == x][:, 1]),
-                    np.mean(image[segments == x][:, 2]))
+            fudged_image = SegmentStatistics(segments, image).mean_image()
         else:
+            fudged_image = image.copy()
             fudged_image[:] = hide_color
 
-        top = labels
+        return image, segments, fudged_image, []
+
+    def _build_explanation(self, image, segments, data, labels, top,
+                           top_labels, num_features, distance_metric,
+                           model_regressor):
+        """Fits the local models on the predicted neighborhood."""
+        distances = kernel_distances.distances_to_first(data, distance_metric)
 
-        if return_sample_neighborhood_images:
-            data, labels, sam = self.data_labels(image, fudged_image, segments,
-            		                                    classifier_fn, num_samples,
-            		                                    batch_size=batch_size,
-            		                                    return_sample_neighborhood_images=return_sample_neighborhood_images)
-        else:
-            data, labels = self.data_labels(image, fudged_image, segments,
-            		                                    classifier_fn, num_samples,
-            		                                    batch_size=batch_size,
-            		                                    return_sample_neighborhood_images=return_sample_neighborhood_images)
-
-        distances = sklearn.metrics.pairwise_distances(
-            data,
-            data[0].reshape(1, -1),
-            metric=distance_metric
-        ).ravel()
-        
         ret_exp = ImageExplanation(image, segments)
+        ret_exp.timings = self.timings
 
         if top_labels:
             top = np.argsort(labels[0])[-top_labels:]
             ret_exp.top_labels = list(top)
             ret_exp.top_labels.reverse()
 
-        for label in top:
+        sample_weights = None
+        if self.sampling_design is not None:
+            sample_weights = self.sampling_design.sample_weights(data)
+        fits = self.base.explain_instance_with_data_multi(
+            data, labels, distances, top, num_features,
+            model_regressor=model_regressor,
+            feature_selection=self.feature_selection,
+            sample_weights=sample_weights)
+        for label, fit in zip(top, fits):
             (ret_exp.intercept[label],
              ret_exp.local_exp[label],
-             ret_exp.score, ret_exp.local_pred) = self.base.explain_instance_with_data(
-                data, labels, distances, label, num_features,
-                model_regressor=model_regressor,
-                feature_selection=self.feature_selection)
-        if(return_sample_neighborhood_images):
-            return ret_exp, sam
+             ret_exp.score, ret_exp.local_pred) = fit
         return ret_exp
 
     def data_labels(self,
@@ -237,7 +1294,11 @@ class LimeImageExplainer(object):
                     num_samples,
                     batch_size=10,
                     return_sample_neighborhood_images=False,
-                    fudged_images_pool=[]):
+                    fudged_images_pool=[],
+                    pipelined=False,
+                    max_memory_mb=None,
+                    processes=None,
+                    preprocess_fn=None):
         """Generates images and predictions in the neighborhood of this image.
 
         Args:
@@ -248,62 +1309,195 @@ class LimeImageExplainer(object):
             classifier_fn: function that takes a list of images and returns a
                 matrix of prediction probabilities
             num_samples: size of the neighborhood to learn the linear model
-            batch_size: classifier_fn will be called on batches of this size.
+            batch_size: classifier_fn will be called on batches of this size,
+                or of adaptive size if 'auto'.
+            return_sample_neighborhood_images: if True, also return the
+                perturbed images, as a memory-mapped array (num_samples,) +
+                image.shape in the dtype of image
+            fudged_images_pool: images (a list or an ImagePool) to draw the
+                pixels of each turned-off superpixel from. If empty,
+                fudged_image is used.
+            pipelined: if True, compose the next batch in a background thread
+                while classifier_fn runs on the current one. The seconds spent
+                in each stage are stored in self.timings.
+            max_memory_mb: memory budget, in megabytes, for the perturbed
+                images alive at the same time.
+            processes: if not None, every batch is split between this many
+                worker processes, which compose their rows into shared
+                memory-mapped buffers (see parallel_compose.py). The images
+                are the same as the serial ones. parallel_compose.
+                compose_speedup measures the gain for a neighborhood. A
+                parallel_compose.ComposeWorkers can be given instead, to
+                reuse its processes across neighborhoods.
+            preprocess_fn: optional function applied to every batch right
+                before classifier_fn (see explain_instance).
 
         Returns:
             A tuple (data, labels), where:
-                data: dense num_samples * num_superpixels
+                data: dense num_samples * num_superpixels uint8 matrix
                 labels: prediction probabilities matrix
         """
-        import random
-        
+        data, compose, row_keys = self._neighborhood(
+            image, fudged_image, segments, num_samples, fudged_images_pool)
+
+        if processes is not None:
+            compose = parallel_compose.ProcessComposer(compose, data,
+                                                       processes)
+        keys = self._cache_keys(classifier_fn, row_keys, preprocess_fn)
+        compose_rows = compose
+        if return_sample_neighborhood_images:
+            # Batches are composed straight into the returned samples, and
+            # all the rows have to be composed
+            samples = image_composition.neighborhood_buffer(len(data), image)
+            keys = None
+
+            def compose_rows(rows, index):
+                return compose(rows, index,
+                               out=samples[index[0]:index[-1] + 1])
+
+        sizer = self._batch_sizer(image, batch_size, max_memory_mb, pipelined)
+        try:
+            labels, _, self.timings = pipeline.predict_batches(
+                compose_rows, self._classifier(classifier_fn, preprocess_fn),
+                data, sizer, pipelined=pipelined, keys=keys,
+                cache=self.prediction_cache)
+        finally:
+            if processes is not None:
+                compose.close()
+        if processes is not None:
+            self.timings['processes'] = compose.processes
+
+        if(return_sample_neighborhood_images):
+            return data, np.array(labels), samples
+        else:
+            return data, np.array(labels)
+
+    @staticmethod
+    def _batch_sizer(image, batch_size, max_memory_mb, pipelined):
+        """Batch size policy for perturbed images shaped like image"""
+        live_batches = pipeline.DEFAULT_DEPTH + 2 if pipelined else 1
+        return batching.make_batch_sizer(batch_size, image.nbytes,
+                                         max_memory_mb=max_memory_mb,
+                                         live_batches=live_batches)
+
+    @staticmethod
+    def _classifier(classifier_fn, preprocess_fn):
+        """classifier_fn, applied after preprocess_fn if there is one."""
+        if preprocess_fn is None:
+            return classifier_fn
+        return lambda imgs: classifier_fn(preprocess_fn(imgs))
+
+    def _cache_keys(self, classifier_fn, row_keys, preprocess_fn=None):
+        """Prediction cache keys of the rows of a neighborhood, or None if
+        the cache is disabled or the neighborhood cannot be cached."""
+        if self.prediction_cache is None or row_keys is None:
+            return None
+        classifier_key = prediction_cache.callable_key(classifier_fn)
+        if preprocess_fn is not None:
+            classifier_key = (classifier_key,
+                              prediction_cache.callable_key(preprocess_fn))
+        return [(classifier_key,) + key for key in row_keys()]
+
+    def _neighborhood(self, image, fudged_image, segments, num_samples,
+                      fudged_images_pool=[]):
+        """Draws the perturbation matrix of the neighborhood.
+
+        Returns:
+            (data, compose, row_keys), where data is the binary num_samples *
+            num_superpixels matrix, compose is an image_composition.Composer
+            returning the perturbed images of rows = data[index], and
+            row_keys is a function (rows=data, start=0) returning one
+            hashable key per row of rows = data[start:start + len(rows)]
+            that identifies its perturbed image, or None if rows cannot be
+            told apart by a key.
+        """
         if len(fudged_images_pool) == 0:
             fudged_images_pool = [fudged_image]
         
         n_features = np.unique(segments).shape[0]
-        data = self.random_state.randint(0, 2, num_samples * n_features)\
-            .reshape((num_samples, n_features))
-        labels = []
-        data[0, :] = 1
-        imgs = []
-        samples = []
-        
-        for row in data:
-            temp = copy.deepcopy(image)
-            zeros = np.where(row == 0)[0]
-            mask = np.zeros(segments.shape)#.astype(bool)
-            
-            fudged_images_indexes = range(1,len(fudged_images_pool)+1)
-            for z in zeros:
-                val = random.choice(fudged_images_indexes)
-                mask[segments == z] = val
-            
-            for i in fudged_images_indexes:
-                temp[mask == i] = fudged_images_pool[i-1][mask == i]
-                
-            imgs.append(temp)
-            samples = imgs
-            
-            if len(imgs) == batch_size:
-                preds = classifier_fn(np.array(imgs))
-                labels.extend(preds)
-                #if(return_sample_neighborhood_images):
-                
-                imgs = []
-        if len(imgs) > 0:
-            preds = classifier_fn(np.array(imgs))
-            labels.extend(preds)
+        data = self._draw_data(num_samples, n_features)
 
-        if(return_sample_neighborhood_images):
-            return data, np.array(labels), samples
+        index = image_composition.SegmentIndex(segments, n_features)
+        if len(fudged_images_pool) > 1:
+            donors = self._draw_donors(data, len(fudged_images_pool))
+            compose = image_composition.Composer(image, index,
+                                                 pool=fudged_images_pool,
+                                                 donors=donors)
         else:
-            return data, np.array(labels)
+            if self.random_streams is None:
+                # Nothing to draw, but Python's global random module is moved
+                # on by one draw per zero, as the original per-row code did,
+                # so later draws in the process are unchanged
+                self._draw_donors(data, 1)
+            compose = image_composition.Composer(image, index,
+                                                 fudged_images_pool[0])
+
+        def row_keys(rows=data, start=0):
+            if len(fudged_images_pool) == 1:
+                fudge = array_digest(fudged_images_pool[0])
+            else:
+                fudge = self._pool_key(fudged_images_pool)
+            instance = (array_digest(image), array_digest(segments), fudge)
+            packed = np.packbits(rows > 0, axis=1)
+            if len(fudged_images_pool) == 1:
+                return [instance + (p.tobytes(),) for p in packed]
+            donors = compose.donors[start:start + len(rows)]
+            return [instance + (p.tobytes(), donors[i][rows[i] == 0].tobytes())
+                    for i, p in enumerate(packed)]
+
+        return data, compose, row_keys
+
+    def _pool_key(self, pool):
+        """Identifies a pool of donor images in the prediction cache keys.
+
+        The content digest of a pool that is not an ImagePool or ImageView
+        is computed once per pool object held by the explainer, and
+        forgotten when the pool is reassigned: images modified in place are
+        not seen, a new pool has to be assigned instead."""
+        if isinstance(pool, (ImagePool, ImageView)):
+            return pool.key()
+        held = [value for value in self.__dict__.values()
+                if value is not self._pool_digests]
+        self._pool_digests = [(p, key) for p, key in self._pool_digests
+                              if any(p is value for value in held)]
+        for p, key in self._pool_digests:
+            if p is pool:
+                return key
+        key = images_digest(pool)
+        if any(pool is value for value in held):
+            self._pool_digests.append((pool, key))
+        return key
+
+    def _draw_donors(self, data, pool_size, start=0):
+        """Draws, for every turned-off superpixel of every row, the index of
+        the pool image its pixels are taken from.
+
+        Without random streams, the draws follow the row-major order of the
+        zeros in data, using Python's global random module. With random
+        streams, data holds the rows of the neighborhood from start on."""
+        if self.random_streams is not None:
+            u = self.random_streams.uniform(self.image_id,
+                                            random_streams.DONORS,
+                                            data.shape[1:], start,
+                                            start + len(data))
+            donors = np.minimum((u * pool_size).astype(int), pool_size - 1)
+            return np.where(data == 0, donors, 0)
+
+        import random
+
+        fudged_images_indexes = range(pool_size)
+        donors = np.zeros(data.shape, dtype=int)
+        for r in range(data.shape[0]):
+            for z in np.where(data[r] == 0)[0]:
+                donors[r, z] = random.choice(fudged_images_indexes)
+        return donors
 
 class LimeImageMixedPatchworkExplainer(LimeImageExplainer): 
     
     # Extend LimeImageExplainer so that  three new parameters are added. These
     # parameters holds i) images of the same cluster, ii) all other images and
-    # iii) the probability to draw images from the same cluster.
+    # iii) the probability to draw images from the same cluster. The images
+    # can be lists of arrays or ImagePools.
     def __init__(self, same_clus_images, all_other_images, same_clus_prob, *args, **kwargs):
         super(LimeImageMixedPatchworkExplainer, self).__init__(*args, **kwargs)
         self.same_clus_images = same_clus_images
@@ -311,206 +1505,127 @@ class LimeImageMixedPatchworkExplainer(LimeImageExplainer):
         self.same_clus_prob = same_clus_prob
         
     # Override
-    def explain_instance(self, image, classifier_fn, labels=(1,),
-                         hide_color=None,
-                         top_labels=5, num_features=100000, num_samples=1000,
-                         batch_size=10,
-                         segmentation_fn=None,
-                         distance_metric='cosine',
-                         model_regressor=None,
-                         random_seed=None,
-                         return_sample_neighborhood_images=False):
+    def _prepare_instance(self, image, hide_color, segmentation_fn,
+                          random_seed):
         
         if len(image.shape) == 2:
             image = gray2rgb(image)
         if random_seed is None:
-            random_seed = self.random_state.randint(0, high=1000)
+            random_seed = self._segmentation_seed()
 
         if segmentation_fn is None:
-            segmentation_fn = SegmentationAlgorithm('quickshift', kernel_size=4,
-                                                    max_dist=200, ratio=0.2,
-                                                    random_seed=random_seed)
+            segmentation_fn = self._default_segmentation(random_seed)
         try:
             segments = segmentation_fn(image)
         except ValueError as e:
             raise e
+        segments = image_composition.segments_array(segments)
 
         # Draw the fudged_image at random
         #import random
         fudged_image = None#random.choice(self.image_pool)
 
-        top = labels
+        return image, segments, fudged_image, []
+        
+    # Override
+    def _neighborhood(self, image, fudged_image, segments, num_samples,
+                      fudged_images_pool=[]):
 
-        if(return_sample_neighborhood_images):
-            data, labels, samples = self.data_labels(image, fudged_image, segments,
-                                                     classifier_fn, num_samples,
-                                                     batch_size=batch_size, 
-                                                     return_sample_neighborhood_images=return_sample_neighborhood_images,
-                                                     )
-        else:
-            data, labels = self.data_labels(image, fudged_image, segments,
-                                            classifier_fn, num_samples,
-                                            batch_size=batch_size, 
-                                            return_sample_neighborhood_images=return_sample_neighborhood_images,
-                                            )
-
-        distances = sklearn.metrics.pairwise_distances(
-            data,
-            data[0].reshape(1, -1),
-            metric=distance_metric
-        ).ravel()
-    
-        ret_exp = ImageExplanation(image, segments)
+        n_features = np.unique(segments).shape[0]
+        data = self._draw_data(num_samples, n_features)
 
-        if top_labels:
-            top = np.argsort(labels[0])[-top_labels:]
-            ret_exp.top_labels = list(top)
-            ret_exp.top_labels.reverse()
-            
-        for label in top:
-            (ret_exp.intercept[label],
-             ret_exp.local_exp[label],
-             ret_exp.score, ret_exp.local_pred) = self.base.explain_instance_with_data(
-                data, labels, distances, label, num_features,
-                model_regressor=model_regressor,
-                feature_selection=self.feature_selection)
+        # Donors index the images of all_other_images followed by the ones
+        # of same_clus_images
+        index = image_composition.SegmentIndex(segments, n_features)
+        donors = self._draw_mixed_donors(data)
+        pool = list(self.all_other_images) + list(self.same_clus_images)
+        compose = image_composition.Composer(image, index, pool=pool,
+                                             donors=donors)
+
+        def row_keys(rows=data, start=0):
+            instance = (array_digest(image), array_digest(segments),
+                        self._pool_key(self.all_other_images),
+                        self._pool_key(self.same_clus_images))
+            packed = np.packbits(rows > 0, axis=1)
+            donors = compose.donors[start:start + len(rows)]
+            return [instance + (p.tobytes(), donors[i][rows[i] == 0].tobytes())
+                    for i, p in enumerate(packed)]
+
+        return data, compose, row_keys
 
-        if(return_sample_neighborhood_images):             
-            return ret_exp, samples
-        else:
-            return ret_exp
-        
     # Override
-    def data_labels(self,
-                    image,
-                    fudged_image,
-                    segments,
-                    classifier_fn,
-                    num_samples,
-                    batch_size=10,
-                    return_sample_neighborhood_images=False):
-        
+    def _draw_more_donors(self, rows, compose, start):
+        return self._draw_mixed_donors(rows, start)
+
+    def _draw_mixed_donors(self, data, start=0):
+        """Draws the donor of every turned-off superpixel of every row: an
+        image of the same cluster with probability same_clus_prob, any other
+        image otherwise.
+
+        Without random streams, the draws follow the row-major order of the
+        zeros in data, using Python's global random module. With random
+        streams, data holds the rows of the neighborhood from start on."""
         import random as rnd
-        
-        n_features = np.unique(segments).shape[0]
-        data = self.random_state.randint(0, 2, num_samples * n_features)\
-            .reshape((num_samples, n_features))
-        labels = []
-        data[0, :] = 1
-        imgs = []
-        samples = []
-        
-        for row in data:
-            temp = copy.deepcopy(image)
-            zeros = np.where(row == 0)[0]
-            mask = np.zeros(segments.shape)#.astype(bool)
-            
-            all_other_images_indexes = range(1,len(self.all_other_images)+1)
-            same_clus_images_indexes = range(1,len(self.same_clus_images)+1)
-            
-            for z in zeros:
+
+        n_other = len(self.all_other_images)
+        if self.random_streams is not None:
+            n_same = len(self.same_clus_images)
+            if n_same + n_other == 0:
+                raise ValueError('No image to draw patches from')
+            u = self.random_streams.uniform(self.image_id,
+                                            random_streams.DONORS,
+                                            data.shape[1:] + (2,), start,
+                                            start + len(data))
+            same = (u[..., 0] < self.same_clus_prob) & (n_same > 0) | \
+                (n_other == 0)
+            donors = np.where(
+                same,
+                n_other + np.minimum((u[..., 1] * n_same).astype(int),
+                                     max(n_same - 1, 0)),
+                np.minimum((u[..., 1] * n_other).astype(int),
+                           max(n_other - 1, 0)))
+            return np.where(data == 0, donors, 0)
+
+        all_other_images_indexes = range(n_other)
+        same_clus_images_indexes = range(len(self.same_clus_images))
+        donors = np.zeros(data.shape, dtype=int)
+        for r in range(data.shape[0]):
+            for z in np.where(data[r] == 0)[0]:
                 proba = rnd.random()
                 if proba < self.same_clus_prob:
-                    val = - rnd.choice(same_clus_images_indexes)
+                    donors[r, z] = n_other + rnd.choice(same_clus_images_indexes)
                 else:
-                    val = rnd.choice(all_other_images_indexes)
-                    
-                mask[segments == z] = val
-            
-            for i in all_other_images_indexes:
-                temp[mask == i] = self.all_other_images[i-1][mask == i]
-            
-            for j in same_clus_images_indexes:
-                temp[mask == -j] = self.same_clus_images[j-1][mask == -j]
-                
-                
-            imgs.append(temp)
-            samples = imgs
-            
-            if len(imgs) == batch_size:
-                preds = classifier_fn(np.array(imgs))
-                labels.extend(preds)
-                imgs = []
-                
-        if len(imgs) > 0:
-            preds = classifier_fn(np.array(imgs))
-            labels.extend(preds)
-
-        if(return_sample_neighborhood_images):
-            return data, np.array(labels), samples
-        else:
-            return data, np.array(labels)
+                    donors[r, z] = rnd.choice(all_other_images_indexes)
+        return donors
     
 
 class LimeImagePatchworkExplainer(LimeImageExplainer): 
 
     # Extend LimeImageExplainer so that  a new parameter is added. This
-    # parameter holds the collection of images to draw the fudged image
-    # (i.e. image to show when superpixel is turned off) from.
+    # parameter holds the collection of images (a list of arrays or an
+    # ImagePool) to draw the fudged image (i.e. image to show when superpixel
+    # is turned off) from.
     def __init__(self, image_pool, *args, **kwargs):
         super(LimeImagePatchworkExplainer, self).__init__(*args, **kwargs)
         self.image_pool = image_pool
 
-    # LimeImagePatchworkExplainer  ovverides the explain_instance method 
+    # LimeImagePatchworkExplainer  ovverides the _prepare_instance method 
     # so that the fudged_image passed to the method data_labels is drawn 
     # at random from the ones inside 'image_pool'.
-    def explain_instance(self, image, classifier_fn, labels=(1,),
-                         hide_color=None,
-                         top_labels=5, num_features=100000, num_samples=1000,
-                         batch_size=10,
-                         segmentation_fn=None,
-                         distance_metric='cosine',
-                         model_regressor=None,
-                         random_seed=None,
-                         return_sample_neighborhood_images=False):
-        """Generates explanations for a prediction.
-
-        First, we generate neighborhood data by randomly perturbing features
-        from the instance (see __data_inverse). We then learn locally weighted
-        linear models on this neighborhood data to explain each of the classes
-        in an interpretable way (see lime_base.py).
-
-        Args:
-            image: 3 dimension RGB image. If this is only two dimensional,
-                we will assume it's a grayscale image and call gray2rgb.
-            classifier_fn: classifier prediction probability function, which
-                takes a numpy array and outputs prediction probabilities.  For
-                ScikitClassifiers , this is classifier.predict_proba.
-            labels: iterable with labels to be explained.
-            hide_color: TODO
-            top_labels: if not None, ignore labels and produce explanations for
-                the K labels with highest prediction probabilities, where K is
-                this parameter.
-            num_features: maximum number of features present in explanation
-            num_samples: size of the neighborhood to learn the linear model
-            batch_size: TODO
-            distance_metric: the distance metric to use for weights.
-            model_regressor: sklearn regressor to use in explanation. Defaults
-            to Ridge regression in LimeBase. Must have model_regressor.coef_
-            and 'sample_weight' as a parameter to model_regressor.fit()
-            segmentation_fn: SegmentationAlgorithm, wrapped skimage
-            segmentation function
-            random_seed: integer used as random seed for the segmentation
-                algorithm. If None, a random integer, between 0 and 1000,
-                will be generated using the internal random number generator.
-
-        Returns:
-            An Explanation object (see explanation.py) with the corresponding
-            explanations.
-        """
+    def _prepare_instance(self, image, hide_color, segmentation_fn,
+                          random_seed):
         if len(image.shape) == 2:
             image = gray2rgb(image)
         if random_seed is None:
-            random_seed = self.random_state.randint(0, high=1000)
+            random_seed = self._segmentation_seed()
 
         if segmentation_fn is None:
-            segmentation_fn = SegmentationAlgorithm('quickshift', kernel_size=4,
-                                                    max_dist=200, ratio=0.2,
-                                                    random_seed=random_seed)
+            segmentation_fn = self._default_segmentation(random_seed)
         try:
             segments = segmentation_fn(image)
         except ValueError as e:
             raise e
+        segments = image_composition.segments_array(segments)
 
         # fudged_image = image.copy()
         # if hide_color is None:
@@ -523,135 +1638,67 @@ class LimeImagePatchworkExplainer(LimeImageExplainer):
         #     fudged_image[:] = hide_color
 
         # Draw the fudged_image at random
-        import random
-        fudged_image = random.choice(self.image_pool)
+        fudged_image = self._choose_image(self.image_pool)
 
-        top = labels
-
-        if(return_sample_neighborhood_images):
-            data, labels, samples = self.data_labels(image, fudged_image, segments,
-                                                     classifier_fn, num_samples,
-                                                     batch_size=batch_size, 
-                                                     return_sample_neighborhood_images=return_sample_neighborhood_images,
-                                                     fudged_images_pool=self.image_pool)
-        else:
-            data, labels = self.data_labels(image, fudged_image, segments,
-                                            classifier_fn, num_samples,
-                                            batch_size=batch_size, 
-                                            return_sample_neighborhood_images=return_sample_neighborhood_images,
-                                            fudged_images_pool=self.image_pool)
-
-        distances = sklearn.metrics.pairwise_distances(
-            data,
-            data[0].reshape(1, -1),
-            metric=distance_metric
-        ).ravel()
-    
-        ret_exp = ImageExplanation(image, segments)
-
-        if top_labels:
-            top = np.argsort(labels[0])[-top_labels:]
-            ret_exp.top_labels = list(top)
-            ret_exp.top_labels.reverse()
-            
-        for label in top:
-            (ret_exp.intercept[label],
-             ret_exp.local_exp[label],
-             ret_exp.score, ret_exp.local_pred) = self.base.explain_instance_with_data(
-                data, labels, distances, label, num_features,
-                model_regressor=model_regressor,
-                feature_selection=self.feature_selection)
-
-        if(return_sample_neighborhood_images):             
-            return ret_exp, samples
-        else:
-            return ret_exp
+        return image, segments, fudged_image, self.image_pool
     
         
 class LimeImageEnhancedPatchworkExplainer(LimeImagePatchworkExplainer):
     
     def __init__(self, image_pool, *args, **kwargs):
+        """Init function.
+
+        Args:
+            image_pool: images (a list or an ImagePool) whose patches
+                replace the turned-off superpixels
+            patch_index: optional patch_search.PatchIndex built on
+                image_pool. Explained images segmented like the index
+                (e.g. with the same grid) are answered from it instead of
+                scanning the pool.
+            the others: see LimeImageExplainer
+        """
+        self.patch_index = kwargs.pop('patch_index', None)
         super(LimeImageEnhancedPatchworkExplainer, self).__init__(image_pool,*args, **kwargs)
         self.image_pool = image_pool
+        # (pool, its stack) of the last pool searched for patches
+        self._stacked_pool = None
         
     # Overrides
-    def data_labels(self,
-                    image,
-                    fudged_image,
-                    segments,
-                    classifier_fn,
-                    num_samples,
-                    batch_size=10,
-                    return_sample_neighborhood_images=False,
-                    fudged_images_pool=[]):
+    def _neighborhood(self, image, fudged_image, segments, num_samples,
+                      fudged_images_pool=[]):
         
         if len(fudged_images_pool) == 0:
             fudged_images_pool = [fudged_image]
         
         n_features = np.unique(segments).shape[0]
-        data = self.random_state.randint(0, 2, num_samples * n_features)\
-            .reshape((num_samples, n_features))
-        labels = []
-        data[0, :] = 1
-        imgs = []
-        samples = []
-            
-        patch_wall = copy.deepcopy(image)
-        
-#        from multiprocessing import Pool, cpu_count
-#        
-#        import time
-#        start = time.time()
-#        
-#        pool = Pool(processes=cpu_count())
-#        patch_pairs = [pool.apply_async(loop_body, 
-#                                         (segments, 
-#                                          fudged_images_pool, 
-#                                          seg, 
-#                                          image)) 
-#                        for seg in np.unique(segments)]
-#        pool.close()
-#        pairs = [res.get(timeout=100) for res in patch_pairs]
-#        pool.join()
-#        del pool
-#        
-#        for pai in pairs:
-#            patch = pai[0]
-#            numb = pai[1]
-#            patch_wall[segments == numb] = patch
-        
-        for seg in np.unique(segments):
-            patches = self.extract_patches(fudged_images_pool, segments, seg)
-            patch_wall[segments == seg] = \
-                self.get_most_similar_patch(patch_wall[segments == seg], patches)
-                
-#        end = time.time()
-#        print "patch wall created in %s" % str(end-start)
-        
-        for row in data:
-            temp = copy.deepcopy(image)
-            zeros = np.where(row == 0)[0]
-            #mask = np.zeros(segments.shape)#.astype(bool)
+        data = self._draw_data(num_samples, n_features)
             
-            for z in zeros:
-                temp[segments == z] = patch_wall[segments == z]
-                
-            imgs.append(temp)
-            samples = imgs
-            
-            if len(imgs) == batch_size:
-                preds = classifier_fn(np.array(imgs))
-                labels.extend(preds)
-                imgs = []
-                
-        if len(imgs) > 0:
-            preds = classifier_fn(np.array(imgs))
-            labels.extend(preds)
-
-        if(return_sample_neighborhood_images):
-            return data, np.array(labels), samples
+        if self.patch_index is not None and \
+                fudged_images_pool is self.image_pool and \
+                self.patch_index.matches(segments):
+            patch_wall = self.patch_index.patch_wall(image)
         else:
-            return data, np.array(labels)
+            patch_wall = patch_search.patch_wall(
+                image, self._pool_array(fudged_images_pool), segments)
+
+        index = image_composition.SegmentIndex(segments, n_features)
+        compose = image_composition.Composer(image, index, patch_wall)
+
+        def row_keys(rows=data, start=0):
+            instance = (array_digest(image), array_digest(segments),
+                        array_digest(patch_wall))
+            return [instance + (p.tobytes(),)
+                    for p in np.packbits(rows > 0, axis=1)]
+
+        return data, compose, row_keys
+
+    def _pool_array(self, pool):
+        """The pool stacked in one array. The stack is kept while the same
+        pool object is searched, e.g. self.image_pool until it is
+        reassigned, so it is not rebuilt for every explained image."""
+        if self._stacked_pool is None or self._stacked_pool[0] is not pool:
+            self._stacked_pool = (pool, patch_search.stack_pool(pool))
+        return self._stacked_pool[1]
     
     
     
@@ -671,8 +1718,3 @@ class LimeImageEnhancedPatchworkExplainer(LimeImagePatchworkExplainer):
                 min_error = error
                 best_patch = p
         return best_patch
-
-#def loop_body(segments, images, seg_no, original_image):
-#    patches = extract_patches(images, segments, seg_no, original_image)
-#    patch = get_most_similar_patch(original_image[segments == seg_no], patches)
-#    return (patch, seg_no)
\ No newline at end of file
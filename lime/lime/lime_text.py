@@ -13,7 +13,9 @@ import sklearn
 from sklearn.utils import check_random_state
 
 from . import explanation
+from . import kernel_distances
 from . import lime_base
+from . import sampling_designs
 
 
 class TextDomainMapper(explanation.DomainMapper):
@@ -182,7 +184,8 @@ class LimeTextExplainer(object):
                  feature_selection='auto',
                  split_expression=r'\W+',
                  bow=True,
-                 random_state=None):
+                 random_state=None,
+                 sampling_design=None):
         """Init function.
 
         Args:
@@ -205,6 +208,10 @@ class LimeTextExplainer(object):
             random_state: an integer or numpy.RandomState that will be used to
                 generate random numbers. If None, the random state will be
                 initialized using the internal numpy seed.
+            sampling_design: if not None, a sampling_designs.SamplingDesign,
+                or the name of one, drawing which words are removed instead
+                of removing a uniformly drawn number of random words. See
+                sampling_designs.py.
         """
 
         # exponential kernel
@@ -218,6 +225,11 @@ class LimeTextExplainer(object):
         self.feature_selection = feature_selection
         self.bow = bow
         self.split_expression = split_expression
+        self.sampling_design = None
+        if sampling_design is not None:
+            # The kernel is applied to cosine distances times 100
+            self.sampling_design = sampling_designs.get_design(
+                sampling_design, lambda d: kernel(d * 100))
 
     def explain_instance(self,
                          text_instance,
@@ -272,13 +284,17 @@ class LimeTextExplainer(object):
             labels = np.argsort(yss[0])[-top_labels:]
             ret_exp.top_labels = list(labels)
             ret_exp.top_labels.reverse()
+        sample_weights = None
+        if self.sampling_design is not None:
+            sample_weights = self.sampling_design.sample_weights(data)
         for label in labels:
             (ret_exp.intercept[label],
              ret_exp.local_exp[label],
              ret_exp.score, ret_exp.local_pred) = self.base.explain_instance_with_data(
                 data, yss, distances, label, num_features,
                 model_regressor=model_regressor,
-                feature_selection=self.feature_selection)
+                feature_selection=self.feature_selection,
+                sample_weights=sample_weights)
         return ret_exp
 
     def __data_labels_distances(self,
@@ -314,20 +330,28 @@ class LimeTextExplainer(object):
         """
 
         def distance_fn(x):
-            return sklearn.metrics.pairwise.pairwise_distances(
-                x, x[0], metric=distance_metric).ravel() * 100
+            return kernel_distances.distances_to_first(
+                x, distance_metric) * 100
 
         doc_size = indexed_string.num_words()
-        sample = self.random_state.randint(1, doc_size + 1, num_samples - 1)
         data = np.ones((num_samples, doc_size))
         data[0] = np.ones(doc_size)
-        features_range = range(doc_size)
         inverse_data = [indexed_string.raw_string()]
-        for i, size in enumerate(sample, start=1):
-            inactive = self.random_state.choice(features_range, size,
-                                                replace=False)
-            data[i, inactive] = 0
-            inverse_data.append(indexed_string.inverse_removing(inactive))
+        if self.sampling_design is not None:
+            data[1:] = self.sampling_design.rows(num_samples - 1, doc_size,
+                                                 self.random_state)
+            for row in data[1:]:
+                inverse_data.append(indexed_string.inverse_removing(
+                    np.flatnonzero(row == 0)))
+        else:
+            sample = self.random_state.randint(1, doc_size + 1,
+                                               num_samples - 1)
+            features_range = range(doc_size)
+            for i, size in enumerate(sample, start=1):
+                inactive = self.random_state.choice(features_range, size,
+                                                    replace=False)
+                data[i, inactive] = 0
+                inverse_data.append(indexed_string.inverse_removing(inactive))
         labels = classifier_fn(inverse_data)
         distances = distance_fn(sp.sparse.csr_matrix(data))
         return data, labels, distances
@@ -4,164 +4,200 @@
 Created on Wed Oct  3 09:28:29 2018
 
 @author: leo
+
+Occlusion explanations: the weight of a superpixel is how much the
+prediction drops when it alone is turned off. They take one classifier call
+per superpixel plus one for the original image, and involve no sampling.
 """
 
-import copy
+import warnings
 
 import numpy as np
-import sklearn
-import sklearn.preprocessing
-from sklearn.utils import check_random_state
-from skimage.color import gray2rgb
-
-try: 
-    from . import lime_base
-    from .wrappers.scikit_image import SegmentationAlgorithm
-except:
-    import lime_base
-    from wrappers.scikit_image import SegmentationAlgorithm
 
-class LimeImageTrivialExplainer(object):
+try:
+    from . import image_composition
+    from .lime_image import ImageExplanation, LimeImageExplainer
+    from .utils.generic_utils import array_digest
+except:
+    import image_composition
+    from lime_image import ImageExplanation, LimeImageExplainer
+    from utils.generic_utils import array_digest
+
+
+# Default num_samples of explain_instance, the only value (with None) that
+# does not warn that it is ignored
+DEFAULT_NUM_SAMPLES = 1000
+
+
+def occlusion_cells(shape, stride):
+    """Segmentation of an image of the given shape in stride x stride cells
+    (smaller at the right and bottom borders), labelled 0 to n - 1 row by
+    row.
+
+    Returns:
+        (segments, (n_cell_rows, n_cell_cols))
+    """
+    n_rows = -(-shape[0] // stride)
+    n_cols = -(-shape[1] // stride)
+    rows = np.arange(shape[0]) // stride
+    cols = np.arange(shape[1]) // stride
+    return rows[:, np.newaxis] * n_cols + cols, (n_rows, n_cols)
+
+
+def occlusion_rows(n_features, cell_shape=None, window=1):
+    """Perturbation rows of an occlusion neighborhood.
+
+    Args:
+        n_features: number of columns
+        cell_shape: (n_cell_rows, n_cell_cols) when the columns are the
+            cells of occlusion_cells. None to turn off one column per row.
+        window: side, in cells, of the square window turned off by each
+            row, slid one cell at a time over the cells
+
+    Returns:
+        uint8 array whose row 0 is all ones and every other row turns off
+        one column (or window of cells).
+    """
+    if cell_shape is None:
+        data = np.ones((n_features + 1, n_features), dtype=np.uint8)
+        data[np.arange(1, n_features + 1), np.arange(n_features)] = 0
+        return data
+    n_rows, n_cols = cell_shape
+    window_rows = max(n_rows - window + 1, 1)
+    window_cols = max(n_cols - window + 1, 1)
+    data = np.ones((window_rows * window_cols + 1, n_features),
+                   dtype=np.uint8)
+    cells = np.arange(n_rows * n_cols).reshape(cell_shape)
+    for r in range(window_rows):
+        for c in range(window_cols):
+            data[1 + r * window_cols + c,
+                 cells[r:r + window, c:c + window].ravel()] = 0
+    return data
+
+
+class LimeImageTrivialExplainer(LimeImageExplainer):
+    """Explains predictions on images by occlusion.
+
+    The neighborhood is the original image followed by one image per
+    superpixel, with that superpixel alone turned off (shown as hide_color,
+    or as its mean color if hide_color is None). The weight of a superpixel
+    for a label is the drop of the predicted probability when it is turned
+    off. Neighborhoods are composed and predicted in batches as in
+    LimeImageExplainer, so batch_size, pipelined, max_memory_mb,
+    prediction_cache and return_sample_neighborhood_images work the same,
+    while distance_metric and model_regressor are ignored. num_samples
+    should be left to its default or None: the size of the neighborhood is
+    set by the segmentation, and any other value is ignored with a warning.
+
+    Superpixels are the distinct labels of the segmentation, whatever their
+    values, so a gridSegmentation (labelled from 1) has all its cells
+    occluded, and the explanation is keyed by those labels.
+
+    With window, the image is instead cut in stride x stride cells, and a
+    window x window square of pixels is slid over them with a step of
+    stride pixels. The weight of a cell is the mean drop of the windows
+    covering it.
+    """
 
     def __init__(self, kernel_width=.25, verbose=False,
-                 feature_selection='auto', random_state=None):
-
-        kernel_width = float(kernel_width)
-
-        def kernel(d):
-            return np.sqrt(np.exp(-(d ** 2) / kernel_width ** 2))
-
-        self.random_state = check_random_state(random_state)
-        self.feature_selection = feature_selection
-        self.base = lime_base.LimeBase(kernel, verbose, random_state=self.random_state)
-
-    def explain_instance(self, image, classifier_fn, labels=(1,),
-                         hide_color=None,
-                         top_labels=5, num_features=100000, num_samples=1000,
-                         batch_size=10,
-                         segmentation_fn=None,
-                         distance_metric='cosine',
-                         model_regressor=None,
-                         random_seed=None,
-                         return_sample_neighborhood_images=False):
-
-        if len(image.shape) == 2:
-            image = gray2rgb(image)
-        if random_seed is None:
-            random_seed = self.random_state.randint(0, high=1000)
-
-        if segmentation_fn is None:
-            segmentation_fn = SegmentationAlgorithm('quickshift', kernel_size=4,
-                                                    max_dist=200, ratio=0.2,
-                                                    random_seed=random_seed)
-        try:
-            segments = segmentation_fn(image)
-        except ValueError as e:
-            raise e
-
-        fudged_image = image.copy()
-        if hide_color is None:
-            for x in np.unique(segments):
-                fudged_image[segments == x] = (
-                    np.mean(image[segments == x][:, 0]),
-                    np.mean(image[segments == x][:, 1]),
-                    np.mean(image[segments == x][:, 2]))
-        else:
-            fudged_image[:] = hide_color
-
-        top = labels
-
-        if return_sample_neighborhood_images:
-            labels, sam = self.data_labels(image, fudged_image, segments,
-            		                                    classifier_fn, num_samples,
-            		                                    batch_size=batch_size,
-            		                                    return_sample_neighborhood_images=return_sample_neighborhood_images)
+                 feature_selection='auto', random_state=None, window=None,
+                 stride=None, **kwargs):
+        """Init function.
+
+        Args:
+            window: side, in pixels, of the sliding occlusion window. If
+                None, superpixels are turned off one by one.
+            stride: step, in pixels, of the sliding window. Defaults to
+                window. window must be a multiple of it.
+            the others: see LimeImageExplainer
+        """
+        super(LimeImageTrivialExplainer, self).__init__(
+            kernel_width, verbose, feature_selection, random_state, **kwargs)
+        if stride is None:
+            stride = window
+        if window is not None and window % stride:
+            raise ValueError('window must be a multiple of stride')
+        self.window = window
+        self.stride = stride
+
+    # Override
+    def _prepare_instance(self, image, hide_color, segmentation_fn,
+                          random_seed):
+        if self.window is None:
+            return super(LimeImageTrivialExplainer, self)._prepare_instance(
+                image, hide_color, segmentation_fn, random_seed)
+        cells, _ = occlusion_cells(image.shape[:2], self.stride)
+        return super(LimeImageTrivialExplainer, self)._prepare_instance(
+            image, hide_color, lambda img: cells, random_seed)
+
+    # Override: the neighborhood only depends on the segments. Column i of
+    # the rows is the segment np.unique(segments)[i].
+    def _neighborhood(self, image, fudged_image, segments, num_samples,
+                      fudged_images_pool=[]):
+        if num_samples is not None and num_samples != DEFAULT_NUM_SAMPLES:
+            warnings.warn('num_samples is ignored by occlusion explanations, '
+                          'which take one sample per superpixel or window')
+        labels, columns = np.unique(segments, return_inverse=True)
+        columns = columns.reshape(segments.shape)
+        if self.window is None:
+            data = occlusion_rows(len(labels))
         else:
-            labels = self.data_labels(image, fudged_image, segments,
-            		                                    classifier_fn, num_samples,
-            		                                    batch_size=batch_size,
-            		                                    return_sample_neighborhood_images=return_sample_neighborhood_images)
-
+            # Cells of occlusion_cells are labelled row by row
+            cell_shape = (len(np.unique(columns[:, 0])),
+                          len(np.unique(columns[0])))
+            data = occlusion_rows(len(labels), cell_shape,
+                                  self.window // self.stride)
+        index = image_composition.SegmentIndex(columns, len(labels))
+        compose = image_composition.Composer(image, index, fudged_image)
+
+        def row_keys(rows=data, start=0):
+            instance = (array_digest(image), array_digest(segments),
+                        array_digest(fudged_image))
+            return [instance + (p.tobytes(),)
+                    for p in np.packbits(rows > 0, axis=1)]
+
+        return data, compose, row_keys
+
+    # Override
+    def _draw_more_data(self, n_features, start, stop):
+        raise ValueError('Occlusion neighborhoods cannot be extended')
+
+    # Override
+    def _build_explanation(self, image, segments, data, labels, top,
+                           top_labels, num_features, distance_metric,
+                           model_regressor):
+        ret_exp = ImageExplanation(image, segments)
+        ret_exp.timings = self.timings
 
         if top_labels:
-            orig_img_probs = classifier_fn(image)
-            top = np.argsort(orig_img_probs)[-top_labels:]
-
-        for label in top:
-            target_class_probs = labels[:, label]
-            
-            
-            
-        if(return_sample_neighborhood_images):
-            return ret_exp, sam
+            top = np.argsort(labels[0])[-top_labels:]
+            ret_exp.top_labels = list(top)
+            ret_exp.top_labels.reverse()
+
+        # Mean drop of the occlusions covering every column
+        top = list(top)
+        drops = labels[0, top] - labels[1:, top]
+        rows, columns = np.nonzero(data[1:] == 0)
+        weights = np.zeros((data.shape[1], len(top)))
+        np.add.at(weights, columns, drops[rows])
+        weights /= np.maximum(np.bincount(columns,
+                                          minlength=data.shape[1]),
+                              1)[:, np.newaxis]
+        segment_labels = np.unique(segments)
+        for i, label in enumerate(top):
+            w = weights[:, i]
+            # Additive model: the original prediction minus the weights of
+            # the columns turned off
+            intercept = labels[0, label] - w.sum()
+            predictions = intercept + data.dot(w)
+            residual_ss = ((labels[:, label] - predictions) ** 2).sum()
+            total_ss = ((labels[:, label] - labels[:, label].mean()) ** 2)\
+                .sum()
+            ret_exp.intercept[label] = intercept
+            ret_exp.local_exp[label] = sorted(
+                zip(segment_labels.tolist(), w),
+                key=lambda x: np.abs(x[1]), reverse=True)[:num_features]
+            ret_exp.score = 1 - residual_ss / total_ss if total_ss > 0 \
+                else 1.
+            ret_exp.local_pred = np.array([labels[0, label]])
         return ret_exp
-    
-    def data_labels(self,
-                    image,
-                    fudged_image,
-                    segments,
-                    classifier_fn,
-                    batch_size=10,
-                    return_sample_neighborhood_images=False,
-                    fudged_images_pool=[]):
-
-        import random
-        
-        if len(fudged_images_pool) == 0:
-            fudged_images_pool = [fudged_image]
-        
-        n_features = np.unique(segments).shape[0]
-        
-        data = np.ones((n_features, n_features), dtype=int)
-        for i in range(len(n_features)):
-            data[i,i] = 0
-            
-        labels = []
-        imgs = []
-        #imgs_to_return = []
-        samples = []
-        
-        for j in range(len(data)):
-            row = data[j]
-            temp = copy.deepcopy(image)
-            zeros = np.where(row == 0)[0]
-            mask = np.zeros(segments.shape)
-            
-            fudged_images_indexes = range(1,len(fudged_images_pool)+1)
-            
-            for z in zeros:
-                val = random.choice(fudged_images_indexes)
-                mask[segments == z] = val
-            
-            for i in fudged_images_indexes:
-                temp[mask == i] = fudged_images_pool[i-1][mask == i]
-                
-            imgs.append(temp)
-            samples = imgs
-            
-            if len(imgs) == batch_size:
-                preds = classifier_fn(np.array(imgs))
-                labels.extend(preds)
-                #if(return_sample_neighborhood_images):
-                #imgs_to_return.append(imgs)
-                imgs = []
-                
-        if len(imgs) > 0:
-            preds = classifier_fn(np.array(imgs))
-            labels.extend(preds)
-
-        if(return_sample_neighborhood_images):
-            return np.array(labels), samples
-        else:
-            return np.array(labels)
-        
-    def best_n_feats(self,
-                   probs,
-                   label,
-                   num_feats):
-        
-        sorted_probs = sorted(probs, key=lambda x: x[0])
-        return np.array(sorted_probs)[:,1][num_feats]
-        
-        
-        
\ No newline at end of file
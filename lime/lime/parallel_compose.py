@@ -0,0 +1,341 @@
+"""
+Composition of perturbed images in worker processes.
+
+The image, the segmentation, the fudged image or donor pool, the
+perturbation matrix and the donors of a neighborhood are written once to
+.npy files that the workers memory-map. For every batch, each worker
+composes a shard of its rows directly into a memory-mapped output buffer,
+which the classifier then reads without any pixel being pickled between
+processes.
+
+The worker processes and the output buffers live in a ComposeWorkers, which
+can be kept across neighborhoods (and explain_instance calls) so that the
+processes are started once.
+"""
+import collections
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    from . import pipeline
+    from .image_composition import Composer, SegmentIndex
+    from .image_pool import ImagePool
+except:
+    import pipeline
+    from image_composition import Composer, SegmentIndex
+    from image_pool import ImagePool
+
+
+# Number of neighborhoods a worker process keeps loaded
+LOADED_NEIGHBORHOODS = 4
+
+# State of a worker process: the neighborhoods it composes and its view of
+# the output buffers, both by path
+_worker = {}
+
+
+def _init_worker(max_buffers):
+    _worker.clear()
+    _worker['neighborhoods'] = collections.OrderedDict()
+    _worker['buffers'] = collections.OrderedDict()
+    _worker['max_buffers'] = max_buffers
+
+
+def _cached(cache, key, load, size):
+    if key not in cache:
+        if len(cache) >= size:
+            cache.popitem(last=False)
+        cache[key] = load(key)
+    return cache[key]
+
+
+def _load_composer(directory):
+    def load(name):
+        path = os.path.join(directory, name + '.npy')
+        return np.load(path, mmap_mode='r') if os.path.exists(path) else None
+
+    image = load('image')
+    features = load('features')
+    index = SegmentIndex(features.reshape(image.shape[:2]),
+                         int(np.load(os.path.join(directory,
+                                                  'n_features.npy'))))
+    pool = None
+    if os.path.exists(os.path.join(directory, 'pool.npy')):
+        pool = ImagePool(os.path.join(directory, 'pool.npy'))
+    elif os.path.exists(os.path.join(directory, 'pool_ref.npy')):
+        ref = np.load(os.path.join(directory, 'pool_ref.npy'),
+                      allow_pickle=True).item()
+        pool = ImagePool(ref['path'], ref['indices'])
+    composer = Composer(image, index, fudged_image=load('fudged'), pool=pool,
+                        donors=load('donors'))
+    return composer, load('data')
+
+
+def _compose_shard(args):
+    directory, buffer_path, offset, rows_index = args
+    composer, data = _cached(_worker['neighborhoods'], directory,
+                             _load_composer, LOADED_NEIGHBORHOODS)
+    buffer = _cached(_worker['buffers'], buffer_path,
+                     lambda path: np.load(path, mmap_mode='r+'),
+                     _worker['max_buffers'])
+    out = buffer[offset:offset + len(rows_index)]
+    composer(data[rows_index], rows_index, out=out)
+    return len(rows_index)
+
+
+class ComposeWorkers(object):
+    """Worker processes and output buffers shared by the ProcessComposers
+    of any number of neighborhoods.
+
+    Starting the processes costs far more than composing a small
+    neighborhood, so a ComposeWorkers meant to be reused is passed as the
+    processes argument of explain_instance, explain_instances or
+    data_labels, and closed once all the explanations are done:
+
+        with ComposeWorkers(4) as workers:
+            for image in images:
+                explainer.explain_instance(image, ..., processes=workers)
+
+    The composed batches are views of a ring of memory-mapped buffers, so a
+    batch is only valid until `buffers` more batches have been composed.
+    """
+
+    def __init__(self, processes=None, buffers=pipeline.DEFAULT_DEPTH + 3):
+        """Init function.
+
+        Args:
+            processes: number of worker processes. Defaults to the CPU count.
+            buffers: number of output buffers used in turn. With the default,
+                batches stay valid while pipeline.predict_batches holds them,
+                pipelined or not.
+        """
+        self.processes = processes or multiprocessing.cpu_count()
+        self.directory = tempfile.mkdtemp(prefix='lime_compose_')
+        self._buffers = [None] * max(1, buffers)
+        self._turn = 0
+        self._files = 0
+        self.pool = multiprocessing.Pool(self.processes,
+                                         initializer=_init_worker,
+                                         initargs=(2 * len(self._buffers),))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _new_path(self, name):
+        self._files += 1
+        # A new name every time, so workers never reuse a stale mapping
+        return os.path.join(self.directory, '%s%d' % (name, self._files))
+
+    def workspace(self):
+        """Returns a new directory for the files of a neighborhood."""
+        path = self._new_path('neighborhood')
+        os.mkdir(path)
+        return path
+
+    def buffer(self, size, image):
+        """Next buffer of the ring, resized to hold size images shaped like
+        image if needed."""
+        turn = self._turn
+        self._turn = (turn + 1) % len(self._buffers)
+        buffer = self._buffers[turn]
+        if buffer is None or len(buffer) < size or \
+                buffer.shape[1:] != image.shape or \
+                buffer.dtype != image.dtype:
+            path = self._new_path('out') + '.npy'
+            buffer = np.lib.format.open_memmap(
+                path, mode='w+', dtype=image.dtype,
+                shape=(size,) + image.shape)
+            if self._buffers[turn] is not None:
+                os.remove(self._buffers[turn].filename)
+            self._buffers[turn] = buffer
+        return buffer
+
+    def compose(self, workspace, rows_index, out):
+        """Composes the rows rows_index of the neighborhood saved in
+        workspace into the buffer out, split between the workers."""
+        shards = [s for s in np.array_split(np.arange(len(rows_index)),
+                                            self.processes) if len(s)]
+        self.pool.map(_compose_shard,
+                      [(workspace, out.filename, s[0], rows_index[s])
+                       for s in shards])
+        return out[:len(rows_index)]
+
+    def close(self):
+        """Stops the workers and deletes the shared files."""
+        self.pool.close()
+        self.pool.join()
+        self._buffers = []
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ProcessComposer(object):
+    """Drop-in replacement of a Composer that splits every batch between
+    worker processes.
+
+    The composed batches are views of a ring of memory-mapped buffers (see
+    ComposeWorkers). Set copy to keep them longer.
+    """
+
+    def __init__(self, composer, data, processes=None, copy=False,
+                 buffers=pipeline.DEFAULT_DEPTH + 3):
+        """Init function.
+
+        Args:
+            composer: image_composition.Composer of the neighborhood
+            data: the perturbation matrix of the neighborhood
+            processes: a ComposeWorkers to compose with, left running by
+                close, or the number of worker processes to start for this
+                neighborhood only. Defaults to the CPU count.
+            copy: if True, return copies of the composed batches
+            buffers: number of output buffers of the workers started for
+                this neighborhood, see ComposeWorkers.
+        """
+        self._owns_workers = not isinstance(processes, ComposeWorkers)
+        if self._owns_workers:
+            processes = ComposeWorkers(processes, buffers)
+        self.workers = processes
+        self.processes = processes.processes
+        self.copy = copy
+        self.image = composer.image
+        self.directory = self.workers.workspace()
+        self._save(composer, data)
+
+    def _save(self, composer, data):
+        def save(name, array):
+            np.save(os.path.join(self.directory, name + '.npy'), array)
+
+        save('image', composer.image)
+        save('features', composer.index.pixel_features)
+        save('n_features', composer.index.n_features)
+        save('data', np.asarray(data))
+        if composer.fudged_image is not None:
+            save('fudged', composer.fudged_image)
+        if composer.pool is None:
+            return
+        if isinstance(composer.pool, ImagePool):
+            save('donors', composer.donors)
+            np.save(os.path.join(self.directory, 'pool_ref.npy'),
+                    {'path': composer.pool.path,
+                     'indices': composer.pool.indices})
+            return
+        # Only the donors actually drawn are written
+        off = np.asarray(data) == 0
+        used = np.unique(composer.donors[off])
+        donors = np.zeros(composer.donors.shape, dtype=int)
+        donors[off] = np.searchsorted(used, composer.donors[off])
+        save('donors', donors)
+        images = [composer.pool[i] for i in used] or [composer.image]
+        ImagePool.create(images, os.path.join(self.directory, 'pool.npy'))
+
+    def __call__(self, rows, rows_index, out=None):
+        rows_index = np.asarray(rows_index)
+        batch = self.workers.compose(
+            self.directory, rows_index,
+            self.workers.buffer(len(rows_index), self.image))
+        if out is not None:
+            np.copyto(out, batch)
+            return out
+        return np.array(batch) if self.copy else batch
+
+    def close(self):
+        """Deletes the files of the neighborhood, and stops the workers if
+        they were started for it."""
+        if self._owns_workers:
+            self.workers.close()
+        else:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def compose_speedup(composer, data, processes=None, batch_size=100):
+    """Times the composition of a whole neighborhood serially and with
+    ProcessComposer.
+
+    Returns:
+        dict with the 'serial' and 'parallel' seconds (worker start-up
+        excluded), and the 'speedup' of the latter.
+    """
+    batches = [np.arange(start, min(start + batch_size, len(data)))
+               for start in range(0, len(data), batch_size)]
+    t = time.time()
+    for index in batches:
+        composer(data[index], index)
+    serial = time.time() - t
+    parallel_composer = ProcessComposer(composer, data, processes)
+    try:
+        t = time.time()
+        for index in batches:
+            parallel_composer(data[index], index)
+        parallel = time.time() - t
+    finally:
+        parallel_composer.close()
+    return {'serial': serial, 'parallel': parallel,
+            'speedup': serial / max(parallel, 1e-9)}
+
+
+def workers_speedup(neighborhoods, processes=None, batch_size=100):
+    """Times the composition of several neighborhoods with a ProcessComposer
+    starting its own workers for each, and with one ComposeWorkers reused
+    by all of them. Worker start-up is included in both.
+
+    Args:
+        neighborhoods: list of (composer, data) pairs, as returned by
+            LimeImageExplainer._neighborhood
+
+    Returns:
+        dict with the 'fresh' and 'reused' seconds, and the 'speedup' of the
+        latter.
+    """
+    def run(processes):
+        for composer, data in neighborhoods:
+            parallel_composer = ProcessComposer(composer, data, processes)
+            try:
+                for start in range(0, len(data), batch_size):
+                    index = np.arange(start, min(start + batch_size,
+                                                 len(data)))
+                    parallel_composer(data[index], index)
+            finally:
+                parallel_composer.close()
+
+    t = time.time()
+    run(processes)
+    fresh = time.time() - t
+    t = time.time()
+    with ComposeWorkers(processes) as workers:
+        run(workers)
+    reused = time.time() - t
+    return {'fresh': fresh, 'reused': reused,
+            'speedup': fresh / max(reused, 1e-9)}
+
+
+def benchmark(images=8, size=299, grid=16, num_samples=100, processes=2,
+              batch_size=10, seed=0):
+    """Runs workers_speedup on random images and grid segmentations, with
+    fudged images, as in explain_instance with hide_color."""
+    rs = np.random.RandomState(seed)
+    cell = -(-size // grid)
+    segments = np.arange(grid * grid).reshape(grid, grid)\
+        .repeat(cell, 0).repeat(cell, 1)[:size, :size]
+    index = SegmentIndex(segments)
+    neighborhoods = []
+    for _ in range(images):
+        image = rs.randint(0, 256, (size, size, 3)).astype(np.uint8)
+        data = rs.randint(0, 2, (num_samples, grid * grid)).astype(np.uint8)
+        neighborhoods.append((Composer(image, index,
+                                       fudged_image=np.zeros_like(image)),
+                              data))
+    return workers_speedup(neighborhoods, processes, batch_size)
+
+
+if __name__ == '__main__':
+    for n in (4, 16):
+        print('%2d images 299x299: %s' % (n, benchmark(images=n)))
+        print('%2d images 64x64, 50 samples: %s'
+              % (n, benchmark(images=n, size=64, grid=8, num_samples=50)))
@@ -0,0 +1,303 @@
+"""
+Search, in a pool of images, of the patch most similar to every segment of
+an image.
+
+The patch of segment s in a pool image is the set of its pixels where
+segments == s. The error of a patch is the Euclidean distance between its
+pixels and the ones of the image. Errors are computed for all the segments
+and pool images with one segment-sum reduction per chunk of pool images,
+instead of one np.linalg.norm call per (segment, pool image) pair.
+"""
+from __future__ import print_function
+
+import pickle
+
+import numpy as np
+
+try:
+    from .image_pool import ImagePool, ImageView, images_digest
+    from .segment_stats import SegmentStatistics
+    from .utils.generic_utils import array_digest
+except:
+    from image_pool import ImagePool, ImageView, images_digest
+    from segment_stats import SegmentStatistics
+    from utils.generic_utils import array_digest
+
+
+CHUNK_MB = 64
+
+
+def stack_pool(pool):
+    """Returns the pool as a single array (n_images, H, W[, C])."""
+    if isinstance(pool, np.ndarray):
+        return pool
+    if isinstance(pool, (ImagePool, ImageView)):
+        return pool.asarray()
+    return np.stack([np.asarray(p) for p in pool])
+
+
+def segment_errors(image, pool, stats, chunk_mb=CHUNK_MB):
+    """Squared patch errors of every pool image on every segment.
+
+    Args:
+        image: numpy array (H, W[, C])
+        pool: array (n_images, H, W[, C]), see stack_pool
+        stats: SegmentStatistics of the segmentation
+        chunk_mb: size, in megabytes, of the float64 differences computed at
+            once
+
+    Returns:
+        float64 array (n_images, n_segments), ordered as stats.labels
+    """
+    n_pixels = stats.inverse.shape[0]
+    reference = np.asarray(image, dtype=float).reshape((n_pixels, -1))
+    chunk = max(1, int(chunk_mb * 2 ** 20 // (reference.nbytes or 1)))
+    starts = stats.offsets[:-1]
+    errors = np.empty((len(pool), stats.n_segments))
+    for begin in range(0, len(pool), chunk):
+        block = np.asarray(pool[begin:begin + chunk], dtype=float)
+        block = block.reshape((block.shape[0], n_pixels, -1))
+        squared = ((block - reference) ** 2).sum(axis=2)
+        errors[begin:begin + chunk] = np.add.reduceat(
+            squared[:, stats.order], starts, axis=1)
+    return errors
+
+
+def best_patches(errors):
+    """Index of the pool image with the smallest non-zero error on every
+    segment.
+
+    Patches identical to the image (zero error) are excluded, and ties go
+    to the first image of the pool. Segments without any candidate get -1.
+    """
+    candidates = np.where(errors > 0, errors, np.inf)
+    best = np.argmin(candidates, axis=0)
+    best[np.isinf(candidates[best, np.arange(errors.shape[1])])] = -1
+    return best
+
+
+def patch_wall(image, pool, segments, chunk_mb=CHUNK_MB):
+    """Image in which every segment is replaced by its most similar patch
+    from the pool.
+
+    Segments with no patch different from the image keep their pixels.
+
+    Args:
+        image: numpy array (H, W[, C])
+        pool: sequence of arrays shaped like image, or their stack
+        segments: 2d numpy array of integer segment labels
+        chunk_mb: see segment_errors
+
+    Returns:
+        array with the shape and dtype of image
+    """
+    pool = stack_pool(pool)
+    stats = SegmentStatistics(segments)
+    best = best_patches(segment_errors(image, pool, stats, chunk_mb))
+    return compose_patches(image, pool, stats, best)
+
+
+def compose_patches(image, pool, stats, donors):
+    """Copies into image the pixels of segment stats.labels[i] from the pool
+    image donors[i], for every i with donors[i] >= 0."""
+    n_pixels = stats.inverse.shape[0]
+    wall = np.array(image, copy=True)
+    flat = wall.reshape((n_pixels, -1))
+    pixel_donors = donors[stats.inverse]
+    replaced = np.flatnonzero(pixel_donors >= 0)
+    flat_pool = pool.reshape((pool.shape[0], n_pixels, -1))
+    flat[replaced] = flat_pool[pixel_donors[replaced], replaced]
+    return wall
+
+
+class PatchIndex(object):
+    """Nearest-patch index over a fixed pool and segmentation.
+
+    One KD-tree per segment holds a low-dimensional descriptor of the patch
+    of every pool image on that segment: the patch pixels are cut in dims
+    runs, and each run is summarized by its sum over the square root of its
+    length. That is an orthogonal projection of the patch, so descriptor
+    distances never exceed patch errors. Candidates are taken from the tree
+    in order of descriptor distance and ranked by their exact error until
+    the next descriptor distance is larger than the best error found, which
+    gives the same patches as a full scan (ties aside) while reading the
+    pixels of a few pool images only. When the image is far from every pool
+    image on some segments, the descriptors prune little and those segments
+    fall back to a scan of the pool.
+
+    The index is only valid for the segmentation it was built with (e.g.
+    one grid geometry), see matches, and for the pool it was built on,
+    which load checks by content.
+    """
+
+    def __init__(self, pool, segments, dims=16, candidates=4, leaf_size=16):
+        """Init function.
+
+        Args:
+            pool: sequence of images shaped like the images to explain, or
+                their stack
+            segments: 2d numpy array, the segmentation shared by all the
+                explained images
+            dims: size of the descriptors stored in the trees. KD-trees
+                stop beating a linear scan beyond a few tens of dimensions.
+            candidates: number of nearest descriptors whose exact error is
+                computed first, doubled until the search is exact
+            leaf_size: leaf size of the KD-trees
+        """
+        import scipy.spatial
+
+        self.segments = np.asarray(segments)
+        self.segments_digest = array_digest(self.segments)
+        self.dims = dims
+        self.candidates = max(1, candidates)
+        self.stats = SegmentStatistics(self.segments)
+        pool = stack_pool(pool)
+        self.pool_size = len(pool)
+        self.pool_digest = images_digest(pool)
+        self.trees = [scipy.spatial.cKDTree(self._descriptors(pool, s),
+                                            leafsize=leaf_size)
+                      for s in range(self.stats.n_segments)]
+        self.pool = pool
+
+    def _pixels(self, s):
+        return self.stats.order[self.stats.offsets[s]:
+                                self.stats.offsets[s + 1]]
+
+    def _descriptors(self, images, s):
+        flat = images.reshape((images.shape[0], self.stats.inverse.shape[0],
+                               -1))
+        patches = np.asarray(flat[:, self._pixels(s)], dtype=float)\
+            .reshape((images.shape[0], -1))
+        length = patches.shape[1]
+        starts = np.unique(np.arange(min(self.dims, length)) * length //
+                           min(self.dims, length))
+        runs = np.diff(np.append(starts, length))
+        return np.add.reduceat(patches, starts, axis=1) / np.sqrt(runs)
+
+    def matches(self, segments):
+        """Whether the index was built for this segmentation."""
+        segments = np.asarray(segments)
+        return segments.shape == self.segments.shape and \
+            array_digest(segments) == self.segments_digest
+
+    def best_patches(self, image):
+        """Same as best_patches(segment_errors(image, pool, stats)) (ties
+        aside), answered from the trees.
+
+        Returns:
+            array (n_segments,) with the index of the chosen pool image of
+            every segment, ordered as self.stats.labels, -1 if none.
+        """
+        image = np.asarray(image)[np.newaxis]
+        n_pixels = self.stats.inverse.shape[0]
+        reference = np.asarray(image, dtype=float).reshape((n_pixels, -1))
+        flat_pool = self.pool.reshape((self.pool_size, n_pixels, -1))
+        best = np.full(self.stats.n_segments, -1, dtype=int)
+        # Past this many candidates, scanning the pool is cheaper
+        limit = max(self.candidates, self.pool_size // 32)
+        unresolved = []
+        for s, tree in enumerate(self.trees):
+            query = self._descriptors(image, s)[0]
+            pixels = self._pixels(s)
+            k = min(self.candidates, self.pool_size)
+            while True:
+                distances, found = tree.query(query, k=k)
+                distances = np.atleast_1d(distances)
+                found = np.sort(np.atleast_1d(found))
+                errors = ((np.asarray(flat_pool[found[:, np.newaxis],
+                                                pixels], dtype=float) -
+                           reference[pixels]) ** 2).sum(axis=(1, 2))
+                valid = np.flatnonzero(errors > 0)
+                # Patches not examined yet have an error of at least the
+                # largest descriptor distance found
+                if k == self.pool_size or (len(valid) and
+                        errors[valid].min() <= distances[-1] ** 2):
+                    break
+                if k >= limit:
+                    valid = None
+                    break
+                k = min(2 * k, self.pool_size)
+            if valid is None:
+                unresolved.append(s)
+            elif len(valid):
+                best[s] = found[valid[np.argmin(errors[valid])]]
+        if unresolved:
+            # No pool image is close enough to the image on these segments
+            # for the descriptors to prune the search
+            errors = segment_errors(image[0], self.pool, self.stats)
+            best[unresolved] = best_patches(errors[:, unresolved])
+        return best
+
+    def patch_wall(self, image):
+        """Image in which every segment is replaced by its most similar patch
+        from the pool (see patch_wall)."""
+        return compose_patches(image, self.pool, self.stats,
+                               self.best_patches(image))
+
+    def save(self, path):
+        """Saves the index, without the pool, to a file."""
+        state = dict(self.__dict__)
+        del state['pool']
+        with open(path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path, pool):
+        """Loads an index saved with save.
+
+        Args:
+            path: file written by save
+            pool: the pool the index was built on. A ValueError is raised if
+                its images differ from the ones the index was built on.
+        """
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        pool = stack_pool(pool)
+        if len(pool) != state['pool_size']:
+            raise ValueError('The index was built on a pool of %d images, '
+                             'not %d' % (state['pool_size'], len(pool)))
+        if images_digest(pool) != state['pool_digest']:
+            raise ValueError('The index was built on a different pool')
+        index = cls.__new__(cls)
+        index.__dict__.update(state)
+        index.pool = pool
+        return index
+
+
+def benchmark(pool_size=200, size=64, grid=8, repeats=5, seed=0, dims=16):
+    """Times the best-patch search of a full pool scan and of a PatchIndex
+    on random images.
+
+    Returns:
+        dict with the seconds taken to build the index and the mean seconds
+        per searched image of the 'scan' and of the 'index'
+    """
+    import time
+
+    rs = np.random.RandomState(seed)
+    pool = rs.rand(pool_size, size, size, 3)
+    cell = size // grid
+    segments = np.arange(grid * grid).reshape(grid, grid)\
+        .repeat(cell, 0).repeat(cell, 1)
+    images = [pool[rs.randint(pool_size)] + rs.rand(size, size, 3) * .1
+              for _ in range(repeats)]
+    stats = SegmentStatistics(segments)
+
+    start = time.time()
+    index = PatchIndex(pool, segments, dims=dims)
+    build = time.time() - start
+    start = time.time()
+    scanned = [best_patches(segment_errors(image, pool, stats))
+               for image in images]
+    scan = (time.time() - start) / repeats
+    start = time.time()
+    indexed = [index.best_patches(image) for image in images]
+    search = (time.time() - start) / repeats
+    if not all((a == b).all() for a, b in zip(scanned, indexed)):
+        raise AssertionError('The index and the scan disagree')
+    return {'build': build, 'scan': scan, 'index': search}
+
+
+if __name__ == '__main__':
+    for n in (100, 400, 1600):
+        print('pool %5d: %s' % (n, benchmark(pool_size=n)))
@@ -0,0 +1,184 @@
+"""
+Runs a classifier over the batches of a perturbed neighborhood, optionally
+composing the next batch in a background thread while the classifier runs
+on the current one.
+"""
+import numbers
+import threading
+import time
+
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from . import batching
+    from . import prediction_cache
+except:
+    import batching
+    import prediction_cache
+
+
+DEFAULT_DEPTH = 2
+
+
+def predict_batches(compose_fn, classifier_fn, data, batch_size,
+                    pipelined=False, depth=DEFAULT_DEPTH, keep_samples=False,
+                    keys=None, cache=None):
+    """Composes and classifies the neighborhood described by data.
+
+    Args:
+        compose_fn: function (rows, index) -> array of perturbed images for
+            rows = data[index], index being an array of row numbers
+        classifier_fn: function that takes an array of images and returns a
+            matrix of prediction probabilities
+        data: 2d binary array, one perturbation per row
+        batch_size: number of rows per call to compose_fn and classifier_fn,
+            or a batch sizer (see batching.py) choosing the size of every
+            batch and told how long classifier_fn took on it. When
+            classifier_fn raises a MemoryError, a sizer with a shrink method
+            makes the next batches smaller and the batch is classified in
+            two halves.
+        pipelined: if True, batches are composed by a background thread and
+            handed over through a queue holding at most depth batches, so
+            composition overlaps with classifier_fn.
+        depth: maximum number of composed batches waiting to be classified
+        keep_samples: if True, also return the perturbed images
+        keys: optional list with a hashable key per row. Rows with the same
+            key must yield the same perturbed image.
+        cache: optional PredictionCache. If given together with keys (and
+            keep_samples is False), only the rows whose key is neither in
+            the cache nor repeated earlier in data are composed and
+            classified.
+
+    Returns:
+        (labels, samples, timings), where labels is a list with one
+        prediction per row, samples is the list of perturbed images (empty
+        if keep_samples is False) and timings is a dict with the seconds
+        spent composing ('compose'), in classifier_fn ('classify'), waiting
+        for a composed batch ('wait'), the wall-clock 'total', the number
+        of 'batches', their sizes ('batch_sizes') and the 'throughput' of
+        classifier_fn in samples per second. When the cache is used, the
+        number of rows served from it ('cache_hits') and predicted
+        ('cache_misses') are also reported.
+    """
+    if keys is not None and cache is not None and not keep_samples:
+        return _predict_cached(compose_fn, classifier_fn, data, batch_size,
+                               pipelined, depth, keys, cache)
+    if isinstance(batch_size, numbers.Integral):
+        sizer = batching.FixedBatchSizer(batch_size)
+    else:
+        sizer = batch_size
+    timings = {'compose': 0., 'classify': 0., 'wait': 0., 'total': 0.,
+               'batch_sizes': []}
+    labels = []
+    samples = []
+
+    def batches():
+        start = 0
+        while start < len(data):
+            index = np.arange(start, min(start + sizer.next_size(), len(data)))
+            yield data[index], index
+            start += len(index)
+
+    def compose(rows, index):
+        t = time.time()
+        imgs = compose_fn(rows, index)
+        timings['compose'] += time.time() - t
+        return imgs
+
+    def classify(imgs):
+        t = time.time()
+        try:
+            predictions = classifier_fn(imgs)
+        except MemoryError:
+            # Later batches are made smaller, and this one is classified
+            # in two halves
+            if not hasattr(sizer, 'shrink') or not sizer.shrink(len(imgs)):
+                raise
+            timings['classify'] += time.time() - t
+            half = len(imgs) // 2
+            classify(imgs[:half])
+            classify(imgs[half:])
+            return
+        labels.extend(predictions)
+        elapsed = time.time() - t
+        timings['classify'] += elapsed
+        timings['batch_sizes'].append(len(imgs))
+        sizer.record(len(imgs), elapsed, getattr(imgs, 'nbytes', None))
+        if keep_samples:
+            samples.extend(imgs)
+
+    begin = time.time()
+    if not pipelined:
+        for rows, index in batches():
+            classify(compose(rows, index))
+    else:
+        _run_pipelined(compose, classify, batches(), depth, timings)
+    timings['total'] = time.time() - begin
+    timings['batches'] = len(timings['batch_sizes'])
+    timings['throughput'] = len(labels) / max(timings['classify'], 1e-9)
+    return labels, samples, timings
+
+
+def _predict_cached(compose_fn, classifier_fn, data, batch_size, pipelined,
+                    depth, keys, cache):
+    todo, known = prediction_cache.lookup_rows(cache, keys)
+    todo = np.array(todo, dtype=int)
+
+    def compose(rows, index):
+        return compose_fn(rows, todo[index])
+
+    labels, _, timings = predict_batches(compose, classifier_fn, data[todo],
+                                         batch_size, pipelined=pipelined,
+                                         depth=depth)
+    for i, label in zip(todo, labels):
+        known[keys[i]] = label
+        cache.put(keys[i], label)
+    timings['cache_misses'] = len(todo)
+    timings['cache_hits'] = len(keys) - len(todo)
+    return [known[key] for key in keys], [], timings
+
+
+def _run_pipelined(compose, classify, batches, depth, timings):
+    ready = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            for rows, index in batches:
+                if stop.is_set():
+                    return
+                put(compose(rows, index))
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    worker = threading.Thread(target=produce)
+    worker.daemon = True
+    worker.start()
+    try:
+        while True:
+            t = time.time()
+            item = ready.get()
+            timings['wait'] += time.time() - t
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            classify(item)
+    finally:
+        stop.set()
+        worker.join()
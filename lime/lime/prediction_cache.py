@@ -0,0 +1,127 @@
+"""
+Memoization of classifier predictions on perturbed images.
+
+A perturbed image is fully determined by the image being explained, its
+segmentation, what is shown in place of the turned-off superpixels and the
+perturbation row (plus, for pool-based explainers, which pool image each
+turned-off superpixel is taken from). The explainers in lime_image.py build
+a hashable key out of these, so repeated rows within a neighborhood, and
+across explanations of the same image, are predicted only once.
+"""
+from collections import OrderedDict
+
+
+class PredictionCache(object):
+    """Bounded LRU mapping from perturbation keys to predictions.
+
+    hits and misses count the lookups since the cache was created (or last
+    cleared), so the savings of a whole experiment can be read from them.
+    """
+
+    def __init__(self, max_size=100000):
+        """Init function.
+
+        Args:
+            max_size: maximum number of predictions kept. The least recently
+                used ones are evicted first.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.
+
+    def get(self, key):
+        """Returns the prediction stored for key, or None."""
+        value = self._entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class _Identity(object):
+    """Hashable reference to an object, equal only to references to the
+    same object. Cache keys hold it instead of id(obj): the reference keeps
+    the object alive, so its id cannot be reused by another object while
+    the key is in the cache."""
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __hash__(self):
+        return id(self.obj)
+
+    def __eq__(self, other):
+        return isinstance(other, _Identity) and other.obj is self.obj
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def callable_key(fn):
+    """Hashable identity of a classifier function.
+
+    Bound methods are identified by their instance and function, since
+    `model.predict` builds a new bound method object on every access. The
+    key references the instance (or the function), so a classifier created
+    after another one is garbage-collected never gets its key.
+    """
+    owner = getattr(fn, '__self__', None)
+    if owner is not None:
+        return (_Identity(owner), getattr(fn, '__func__', fn))
+    return _Identity(fn)
+
+
+def lookup_rows(cache, keys):
+    """Looks up the perturbation rows of a neighborhood in the cache.
+
+    Args:
+        cache: PredictionCache
+        keys: list with the key of every row
+
+    Returns:
+        (todo, known), where todo is the list of row numbers that have to be
+        predicted (the first row of every key not in the cache) and known
+        maps the keys found in the cache to their predictions. Rows
+        repeating a key within keys count as hits.
+    """
+    todo = []
+    known = {}
+    scheduled = set()
+    for i, key in enumerate(keys):
+        if key in known or key in scheduled:
+            cache.hits += 1
+            continue
+        value = cache.get(key)
+        if value is None:
+            todo.append(i)
+            scheduled.add(key)
+        else:
+            known[key] = value
+    return todo, known
@@ -0,0 +1,87 @@
+"""
+Reproducible, independent random streams for the image explainers.
+
+Every draw made while explaining an image comes from a numpy Generator
+(Philox, a counter-based bit generator) whose seed sequence is derived from
+the explainer seed, the number of the explained image, what is being drawn
+and, for the neighborhood, the chunk of rows. A chunk of rows is thus the
+same whichever process generates it and in whatever order, so a
+neighborhood generated in shards equals the one generated serially.
+"""
+import numpy as np
+
+
+# What a stream is used for
+PREPARE = 0
+DATA = 1
+DONORS = 2
+DESIGN = 3
+
+DEFAULT_CHUNK_SIZE = 256
+
+
+class RandomStreams(object):
+    """Factory of the random generators of an explainer."""
+
+    def __init__(self, seed=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Init function.
+
+        Args:
+            seed: integer, or sequence of integers, the streams are derived
+                from. If None, fresh entropy is drawn from the OS (and kept
+                in self.seed, so the streams can be recreated).
+            chunk_size: number of neighborhood rows drawn from each stream
+        """
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.chunk_size = int(chunk_size)
+
+    def generator(self, image_id, purpose, chunk=0):
+        """Generator of the given image, purpose and chunk of rows."""
+        sequence = np.random.SeedSequence(
+            self.seed, spawn_key=(int(image_id), int(purpose), int(chunk)))
+        return np.random.Generator(np.random.Philox(sequence))
+
+    def chunks(self, image_id, purpose, start, stop):
+        """Iterates over the chunks overlapping rows [start, stop).
+
+        Yields:
+            (first, last, offset, generator) for every chunk, where rows
+            [first, last) are the ones of the chunk inside [start, stop) and
+            offset is the position of row first in its chunk. The generator
+            has already skipped the draws of the rows before first, as long
+            as the caller draws the same amount for every row.
+        """
+        chunk = start // self.chunk_size
+        while chunk * self.chunk_size < stop:
+            chunk_start = chunk * self.chunk_size
+            first = max(start, chunk_start)
+            last = min(stop, chunk_start + self.chunk_size)
+            yield (first, last, first - chunk_start,
+                   self.generator(image_id, purpose, chunk))
+            chunk += 1
+
+    def binary_rows(self, image_id, n_features, start, stop):
+        """Rows [start, stop) of the perturbation matrix of an image.
+
+        Returns:
+            uint8 array (stop - start, n_features) of 0s and 1s. Row 0, the
+            original image, is not set to ones here.
+        """
+        rows = np.empty((stop - start, n_features), dtype=np.uint8)
+        for first, last, offset, gen in self.chunks(image_id, DATA,
+                                                    start, stop):
+            drawn = gen.integers(0, 2, (offset + last - first, n_features))
+            rows[first - start:last - start] = drawn[offset:]
+        return rows
+
+    def uniform(self, image_id, purpose, shape, start, stop):
+        """Uniform floats in [0, 1), one array of the given shape per row
+        [start, stop), drawn from the chunk streams of purpose."""
+        out = np.empty((stop - start,) + tuple(shape))
+        for first, last, offset, gen in self.chunks(image_id, purpose,
+                                                    start, stop):
+            drawn = gen.random((offset + last - first,) + tuple(shape))
+            out[first - start:last - start] = drawn[offset:]
+        return out
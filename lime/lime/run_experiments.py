@@ -14,6 +14,7 @@ from grid_segmentation import gridSegmentation
 import evaluation_measures
 import clustering
 from helper_functions import absoluteFilePaths
+from segmentation_cache import SegmentationCache
 
 # Function used to preprocess images before feeding
 # them to the inception_v3 net
@@ -63,6 +64,13 @@ gts = load_ground_truths(gt_paths)
 
 grid_sizes = [4,8,16,32,64]
 
+# Quickshift segmentations of lime and limecolor, shared by all their runs.
+# Fill it beforehand with
+#   python -m lime.segmentation_cache ../../chosen_1000_images \
+#       --cache-dir seg_cache --seed 0
+segmentation_cache = SegmentationCache("seg_cache")
+segmentation_seed = 0
+
 lime_version = str(sys.argv[1])
 
 print "explainer: %s" % lime_version
@@ -78,7 +86,9 @@ if lime_version == 'lime':
                                                               gts,
                                                               neigh_size=100,
                                                               segmentation_fun=None,
-                                                              hide_col=h[0])
+                                                              hide_col=h[0],
+                                                              segmentation_cache=segmentation_cache,
+                                                              segmentation_seed=segmentation_seed)
         filename = "exp_results/%s_hidecol=%s_neighsize=200" % (lime_version, h[1])
         np.save(filename, qualities)
 # ---------------------------------------------------------------------------------------------
@@ -94,7 +104,9 @@ elif lime_version == 'limecolor':
                                                               gts,
                                                               neigh_size=100,
                                                               segmentation_fun=None,
-                                                              hide_col=h[0])
+                                                              hide_col=h[0],
+                                                              segmentation_cache=segmentation_cache,
+                                                              segmentation_seed=segmentation_seed)
         filename = "exp_results/%s_hidecol=%s_neighsize=200" % (lime_version, h[1])
         np.save(filename, qualities)
 # ---------------------------------------------------------------------------------------------
@@ -119,6 +131,28 @@ elif lime_version == 'lime#':
             np.save(filename, qualities)
 # ---------------------------------------------------------------------------------------------
 
+# Testing Lime# on every grid size from one neighborhood --------------------------------------
+elif lime_version == 'lime#multiscale':
+    hide_colors = [(None,'None')]
+    for h in hide_colors:
+        # One neighborhood per image, on the finest grid, explains every
+        # grid size
+        qualities_per_grid = evaluation_measures.evaluate_explanations_multiscale(
+                model,
+                bb_outcomes,
+                imgs,
+                gts,
+                grid_sizes,
+                neigh_size=100,
+                hide_col=h[0])
+        # Unlike the lime# files, these hold one entry per image, NaN where
+        # the image was not scored (e.g. ill-conditioned coarse fit)
+        for g in grid_sizes:
+            filename = \
+                "exp_results/%s_hidecol=%s_gridsize=%s_neighsize=200_perimage" % (lime_version, h[1], g)
+            np.save(filename, qualities_per_grid[g])
+# ---------------------------------------------------------------------------------------------
+
 # Testing Lime# Random ------------------------------------------------------------------------
 elif lime_version == 'lime#R':
     image_pool = imgs
@@ -192,6 +226,24 @@ elif lime_version == 'lime#RC':
     del images
 # ---------------------------------------------------------------------------------------------
 
+# Testing occlusion ---------------------------------------------------------------------------
+elif lime_version == 'occlusion':
+    hide_colors = [(None,'None')]
+    for g in grid_sizes:
+        for h in hide_colors:
+            qualities = evaluation_measures.evaluate_explanations(
+                    lime_version,
+                    model,
+                    bb_outcomes,
+                    imgs,
+                    gts,
+                    segmentation_fun=partial(gridSegmentation,g),
+                    hide_col=h[0])
+            filename = \
+                "exp_results/%s_hidecol=%s_gridsize=%s" % (lime_version, h[1], g)
+            np.save(filename, qualities)
+# ---------------------------------------------------------------------------------------------
+
 else:
     print("Unsupported explainer type")
 
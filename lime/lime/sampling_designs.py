@@ -0,0 +1,338 @@
+"""
+Sampling designs of the binary perturbation masks of a neighborhood.
+
+By default, every entry of a LIME mask is an independent coin flip. The
+designs in this module spread the same number of masks more evenly, so the
+surrogate model is estimated with less variance from the same number of
+classifier calls:
+
+    'antithetic': masks come in pairs, a random mask and its complement
+    'balanced': every feature is off in (almost exactly) half of the masks
+    'sobol': masks are a scrambled Sobol sequence thresholded at 1/2
+    'kernel': the number of features kept is drawn where the kernel weight
+        is, and the masks carry importance weights correcting for it
+
+The module can be run as a script to compare the fidelity of the designs
+against a large uniform neighborhood for a range of classifier calls, e.g.
+
+    python -m lime.sampling_designs --calls 50 100 200 400 --repeats 10
+"""
+from __future__ import print_function
+
+import argparse
+import warnings
+from abc import ABCMeta, abstractmethod
+
+import numpy as np
+from scipy.special import gammaln
+
+try:
+    from . import kernel_distances
+except:
+    import kernel_distances
+
+
+def _seed(random_state):
+    """Integer seed drawn from a numpy RandomState or Generator."""
+    if hasattr(random_state, 'integers'):
+        return int(random_state.integers(2 ** 31))
+    return int(random_state.randint(2 ** 31))
+
+
+class SamplingDesign(ABCMeta('ABC', (object,), {})):
+    """Draws the perturbed rows of a neighborhood (the original instance,
+    row 0, is added by the explainer). Abstract: designs define rows."""
+
+    name = None
+
+    @abstractmethod
+    def rows(self, n_rows, n_features, random_state):
+        """Returns a uint8 array (n_rows, n_features) of 0s and 1s.
+
+        Args:
+            random_state: numpy RandomState or Generator to draw from
+        """
+
+    def sample_weights(self, data):
+        """Factors the kernel weights of the rows of data (a neighborhood,
+        row 0 included) are multiplied by, or None."""
+        return None
+
+
+class UniformDesign(SamplingDesign):
+    """Independent fair coin flips, as in the original LIME."""
+
+    name = 'uniform'
+
+    def rows(self, n_rows, n_features, random_state):
+        return (random_state.random((n_rows, n_features)) < .5)\
+            .astype(np.uint8)
+
+
+class AntitheticDesign(SamplingDesign):
+    """Pairs of complementary masks: every feature is off in exactly one of
+    the two, which cancels the noise the feature coefficients would get
+    from features that are off together by chance."""
+
+    name = 'antithetic'
+
+    def __init__(self, base=None):
+        """Init function.
+
+        Args:
+            base: design of the first mask of every pair. Defaults to
+                UniformDesign.
+        """
+        self.base = UniformDesign() if base is None else base
+
+    def rows(self, n_rows, n_features, random_state):
+        half = self.base.rows((n_rows + 1) // 2, n_features, random_state)
+        rows = np.empty((2 * len(half), n_features), dtype=np.uint8)
+        rows[0::2] = half
+        rows[1::2] = 1 - half
+        return rows[:n_rows]
+
+
+class BalancedDesign(SamplingDesign):
+    """Every column is an independent random permutation of a vector with as
+    many zeros as ones, so all the features are off equally often."""
+
+    name = 'balanced'
+
+    def rows(self, n_rows, n_features, random_state):
+        column = (np.arange(n_rows) % 2).astype(np.uint8)
+        order = np.argsort(random_state.random((n_rows, n_features)), axis=0)
+        rows = column[order]
+        if n_rows % 2:
+            # Half of the columns get the extra zero, half the extra one
+            flip = random_state.random(n_features) < .5
+            rows[:, flip] = 1 - rows[:, flip]
+        return rows
+
+
+class SobolDesign(SamplingDesign):
+    """Scrambled Sobol points thresholded at 1/2. Any set of columns sees
+    its 0/1 combinations far more evenly than with independent flips.
+    Requires scipy >= 1.7 and at most 21201 features."""
+
+    name = 'sobol'
+
+    def rows(self, n_rows, n_features, random_state):
+        from scipy.stats import qmc
+
+        sobol = qmc.Sobol(n_features, scramble=True, seed=_seed(random_state))
+        with warnings.catch_warnings():
+            # Balance is only exact for powers of two
+            warnings.simplefilter('ignore', UserWarning)
+            points = sobol.random(n_rows)
+        return (points < .5).astype(np.uint8)
+
+
+class KernelDesign(SamplingDesign):
+    """Draws the number of features kept, k, with probability proportional
+    to C(n_features, k) * kernel_fn(distance), i.e. where a uniform mask
+    would carry its kernel weight, then which features at random.
+
+    Masks close to the instance, which dominate the weighted fit, are then
+    sampled much more often. sample_weights returns the importance weights
+    (uniform density over design density) that keep the fit an estimate of
+    the same weighted least squares problem.
+    """
+
+    name = 'kernel'
+
+    def __init__(self, kernel_fn, distance_metric='cosine'):
+        """Init function.
+
+        Args:
+            kernel_fn: the kernel of the explainer, mapping distances to
+                weights
+            distance_metric: the metric the distances are computed with, one
+                of kernel_distances.BINARY_METRICS
+        """
+        self.kernel_fn = kernel_fn
+        self.distance_metric = distance_metric
+
+    def _kernel(self, ones, n_features):
+        distances = kernel_distances.BINARY_METRICS[self.distance_metric](
+            np.asarray(ones, dtype=float), n_features)
+        return self.kernel_fn(distances)
+
+    def ones_distribution(self, n_features):
+        """Probability of every number of features kept, 0 to n_features."""
+        k = np.arange(n_features + 1)
+        with np.errstate(divide='ignore'):
+            log_p = gammaln(n_features + 1) - gammaln(k + 1) - \
+                gammaln(n_features - k + 1) + \
+                np.log(self._kernel(k, n_features))
+        p = np.exp(log_p - log_p.max())
+        return p / p.sum()
+
+    def rows(self, n_rows, n_features, random_state):
+        p = self.ones_distribution(n_features)
+        ones = np.searchsorted(np.cumsum(p), random_state.random(n_rows),
+                               side='right')
+        ones = np.minimum(ones, n_features)
+        # The features kept are the first ones of a random order
+        ranks = np.argsort(np.argsort(
+            random_state.random((n_rows, n_features)), axis=1), axis=1)
+        return (ranks < ones[:, np.newaxis]).astype(np.uint8)
+
+    def sample_weights(self, data):
+        ones = np.asarray(data, dtype=float).sum(1)
+        with np.errstate(divide='ignore'):
+            weights = 1. / self._kernel(ones, data.shape[1])
+        return weights / weights[0]
+
+
+DESIGNS = {
+    'uniform': UniformDesign,
+    'antithetic': AntitheticDesign,
+    'balanced': BalancedDesign,
+    'sobol': SobolDesign,
+}
+
+
+def get_design(design, kernel_fn=None, distance_metric='cosine'):
+    """Returns a SamplingDesign.
+
+    Args:
+        design: a SamplingDesign, or the name of one ('kernel' included)
+        kernel_fn, distance_metric: kernel of the explainer, for 'kernel'
+    """
+    if isinstance(design, SamplingDesign):
+        return design
+    if design == 'kernel':
+        return KernelDesign(kernel_fn, distance_metric)
+    if design not in DESIGNS:
+        raise ValueError('Unknown sampling design %r' % (design,))
+    return DESIGNS[design]()
+
+
+def fidelity(explanation, reference, label, top_k=10):
+    """Agreement of an explanation with a reference one for label.
+
+    Returns:
+        (correlation, overlap): the correlation of the weights of all the
+        features, and the fraction of the reference top_k features (by
+        absolute weight) that are also in the top_k of the explanation.
+    """
+    n_features = 1 + max(max(f for f, _ in reference.local_exp[label]),
+                         max(f for f, _ in explanation.local_exp[label]))
+    weights = np.zeros((2, n_features))
+    for row, exp in enumerate((explanation, reference)):
+        for f, w in exp.local_exp[label]:
+            weights[row, f] = w
+    correlation = np.corrcoef(weights)[0, 1]
+    top = [set(f for f, _ in exp.local_exp[label][:top_k])
+           for exp in (explanation, reference)]
+    return correlation, len(top[0] & top[1]) / float(top_k)
+
+
+def benchmark(image, classifier_fn, segmentation_fn, label,
+              designs=('uniform', 'antithetic', 'balanced', 'sobol',
+                       'kernel'),
+              calls=(50, 100, 200, 400), reference_calls=5000, repeats=5,
+              top_k=10, seed=0):
+    """Fidelity of the explanations of each design against calls.
+
+    Every explanation is compared (see fidelity) with a reference explanation
+    from a uniform neighborhood of reference_calls samples. A call is one
+    perturbed sample given to classifier_fn.
+
+    Returns:
+        dict mapping every design to a list of (calls, mean correlation,
+        mean top_k overlap), averaged over repeats neighborhoods.
+    """
+    try:
+        from .lime_image import LimeImageExplainer
+    except:
+        from lime_image import LimeImageExplainer
+
+    kwargs = dict(labels=(label,), top_labels=None, hide_color=0,
+                  segmentation_fn=segmentation_fn, batch_size=100)
+    reference = LimeImageExplainer(feature_selection='none',
+                                   random_state=seed).explain_instance(
+        image, classifier_fn, num_samples=reference_calls, **kwargs)
+    results = {}
+    for design in designs:
+        curve = []
+        for n in calls:
+            scores = []
+            for r in range(repeats):
+                explainer = LimeImageExplainer(feature_selection='none',
+                                               random_state=seed + 1 + r,
+                                               sampling_design=design)
+                exp = explainer.explain_instance(image, classifier_fn,
+                                                 num_samples=n, **kwargs)
+                scores.append(fidelity(exp, reference, label, top_k))
+            correlation, overlap = np.mean(scores, axis=0)
+            curve.append((n, correlation, overlap))
+        results[design] = curve
+    return results
+
+
+def _synthetic_problem(grid, seed):
+    """A grid-segmented image and a classifier whose score is a sparse
+    linear function of the segment means plus a few interactions."""
+    try:
+        from .grid_segmentation import gridSegmentation
+    except:
+        from grid_segmentation import gridSegmentation
+
+    rs = np.random.RandomState(seed)
+    image = rs.rand(8 * grid, 8 * grid, 3)
+    segments = gridSegmentation(grid, image)
+    n_segments = len(np.unique(segments))
+    coefs = rs.standard_normal(n_segments) * \
+        (rs.rand(n_segments) < .3)
+    pairs = rs.randint(0, n_segments, (n_segments // 4, 2))
+    labels = np.where((segments >= 0) & (segments < n_segments), segments,
+                      n_segments)
+    counts = np.bincount(labels.ravel(), minlength=n_segments + 1)
+
+    def classifier_fn(imgs):
+        imgs = np.asarray(imgs)
+        sums = np.stack([np.bincount(labels.ravel(),
+                                     weights=im.mean(-1).ravel(),
+                                     minlength=n_segments + 1)
+                         for im in imgs])
+        means = sums[:, :n_segments] / np.maximum(counts[:n_segments], 1)
+        score = means.dot(coefs) + \
+            (means[:, pairs[:, 0]] * means[:, pairs[:, 1]]).sum(1)
+        p = 1. / (1. + np.exp(-score))
+        return np.stack([1 - p, p], 1)
+
+    return image, segments, classifier_fn
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Fidelity of the sampling designs against the number '
+                    'of classifier calls, on a synthetic grid problem.')
+    parser.add_argument('--grid', type=int, default=8,
+                        help='cells per side of the grid segmentation')
+    parser.add_argument('--calls', type=int, nargs='+',
+                        default=[50, 100, 200, 400])
+    parser.add_argument('--reference-calls', type=int, default=5000)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    image, segments, classifier_fn = _synthetic_problem(args.grid, args.seed)
+    results = benchmark(image, classifier_fn, lambda img: segments, 1,
+                        calls=args.calls,
+                        reference_calls=args.reference_calls,
+                        repeats=args.repeats, top_k=args.top_k,
+                        seed=args.seed)
+    print('%-12s %6s %12s %12s' % ('design', 'calls', 'correlation',
+                                    'top-%d' % args.top_k))
+    for design, curve in results.items():
+        for n, correlation, overlap in curve:
+            print('%-12s %6d %12.3f %12.3f' % (design, n, correlation,
+                                                overlap))
+
+
+if __name__ == '__main__':
+    main()
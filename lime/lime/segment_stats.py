@@ -0,0 +1,150 @@
+"""
+Per-segment statistics of an image, computed in a single pass over the
+pixels.
+"""
+import numpy as np
+
+
+class SegmentStatistics(object):
+    """Pixel counts, channel sums and means, bounding boxes and pixel lists
+    of every segment of a segmentation.
+
+    Everything is computed with np.bincount-style reductions over the
+    pixels, so the cost is O(pixels) whatever the number of segments,
+    instead of one full-image `segments == x` comparison per segment.
+    """
+
+    def __init__(self, segments, image=None):
+        """Init function.
+
+        Args:
+            segments: 2d numpy array of integer segment labels
+            image: optional 2d or 3d numpy array with the same height and
+                width as segments. If given, channel_sums and channel_means
+                refer to it.
+        """
+        segments = np.asarray(segments)
+        self.shape = segments.shape
+        flat = segments.ravel()
+        if flat.size and flat.min() >= 0 and flat.max() <= 4 * flat.size:
+            counts = np.bincount(flat)
+            self.labels = np.flatnonzero(counts)
+            lut = np.zeros(counts.shape[0], dtype=np.intp)
+            lut[self.labels] = np.arange(self.labels.shape[0])
+            self.inverse = lut[flat]
+            self.counts = counts[self.labels]
+        else:
+            self.labels, self.inverse = np.unique(flat, return_inverse=True)
+            self.inverse = self.inverse.ravel()
+            self.counts = np.bincount(self.inverse,
+                                      minlength=self.labels.shape[0])
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        self.image = image
+        self._order = None
+        self._channel_sums = None
+
+    @property
+    def n_segments(self):
+        return self.labels.shape[0]
+
+    def positions(self, labels):
+        """Returns the position of each label in self.labels, -1 for the
+        labels that are not in the segmentation."""
+        labels = np.asarray(labels)
+        if self.n_segments == 0:
+            return np.full(labels.shape, -1, dtype=np.intp)
+        pos = np.minimum(np.searchsorted(self.labels, labels),
+                         self.n_segments - 1)
+        return np.where(self.labels[pos] == labels, pos, -1)
+
+    def sums(self, values):
+        """Per-segment sums of a per-pixel array.
+
+        Args:
+            values: array shaped (H, W) or (H, W, C)
+
+        Returns:
+            array (n_segments,) or (n_segments, C) of float64 sums
+        """
+        values = np.asarray(values, dtype=float)
+        flat = values.reshape((self.inverse.shape[0], -1))
+        sums = np.stack([np.bincount(self.inverse, weights=flat[:, c],
+                                     minlength=self.n_segments)
+                         for c in range(flat.shape[1])], axis=1)
+        return sums if values.ndim == 3 else sums[:, 0]
+
+    def means(self, values):
+        """Per-segment means of a per-pixel array (see sums)."""
+        sums = self.sums(values)
+        counts = self.counts if sums.ndim == 1 else self.counts[:, np.newaxis]
+        return sums / counts
+
+    @property
+    def channel_sums(self):
+        if self._channel_sums is None:
+            self._channel_sums = self.sums(self.image)
+        return self._channel_sums
+
+    @property
+    def channel_means(self):
+        counts = self.counts
+        if self.channel_sums.ndim == 2:
+            counts = counts[:, np.newaxis]
+        return self.channel_sums / counts
+
+    def mean_image(self, dtype=None):
+        """Image where every pixel takes the mean color of its segment.
+
+        The means are computed by np.mean over the pixels of every segment,
+        in row-major order, so they are bit for bit those of
+        np.mean(image[segments == x][:, c]) (float32 images are averaged in
+        float32), unlike channel_means.
+
+        Args:
+            dtype: dtype of the result. Defaults to the dtype of image.
+        """
+        if dtype is None:
+            dtype = self.image.dtype
+        image = np.asarray(self.image)
+        flat = image.reshape((self.inverse.shape[0], -1))
+        means = np.empty((self.n_segments, flat.shape[1]))
+        for i in range(self.n_segments):
+            pixels = flat[self.order[self.offsets[i]:self.offsets[i + 1]]]
+            for c in range(flat.shape[1]):
+                means[i, c] = np.mean(pixels[:, c])
+        out = np.empty(image.shape, dtype=dtype)
+        out[...] = means[self.inverse].reshape(image.shape)
+        return out
+
+    @property
+    def bounding_boxes(self):
+        """Array (n_segments, 4) with the (min_row, min_col, max_row,
+        max_col) of every segment, bounds included."""
+        starts = self.offsets[:-1]
+        rows, cols = np.unravel_index(self.order, self.shape)
+        return np.stack([np.minimum.reduceat(rows, starts),
+                         np.minimum.reduceat(cols, starts),
+                         np.maximum.reduceat(rows, starts),
+                         np.maximum.reduceat(cols, starts)], axis=1)
+
+    @property
+    def order(self):
+        """Flat pixel indices sorted by segment."""
+        if self._order is None:
+            self._order = np.argsort(self.inverse, kind='mergesort')
+        return self._order
+
+    def pixels(self, label):
+        """Flat indices of the pixels of a segment label (empty if the label
+        is not in the segmentation)."""
+        pos = self.positions(label)
+        if pos < 0:
+            return self.order[:0]
+        return self.order[self.offsets[pos]:self.offsets[pos + 1]]
+
+    def label_mask(self, labels):
+        """Boolean (H, W) mask of the pixels whose segment is in labels."""
+        selected = np.zeros(self.n_segments + 1, dtype=bool)
+        selected[self.positions(labels)] = True
+        selected[-1] = False
+        return selected[self.inverse].reshape(self.shape)
@@ -0,0 +1,256 @@
+"""
+Persistent, content-addressed cache of image segmentations.
+
+Segmentations are stored as compressed .npz files named after a digest of
+the image content, the segmentation algorithm and its parameters (random
+seed included), so the same quickshift result is computed once and reused
+by every explainer variant of an experiment.
+
+The module can also be run as a script to fill the cache for a whole image
+folder in parallel, e.g.
+
+    python -m lime.segmentation_cache ../../chosen_1000_images \\
+        --cache-dir seg_cache --seed 0 --seed 1 --processes 8
+"""
+from __future__ import print_function
+
+import argparse
+import ast
+import hashlib
+import os
+import tempfile
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+try:
+    from .utils.generic_utils import array_digest
+    from .wrappers.scikit_image import SegmentationAlgorithm
+except:
+    from utils.generic_utils import array_digest
+    from wrappers.scikit_image import SegmentationAlgorithm
+
+
+class SegmentationCache(object):
+    """Directory of .npz segmentations with a size bound.
+
+    When the files exceed max_size_mb, the least recently used ones (by
+    modification time, refreshed on every hit) are deleted. The size of the
+    directory is scanned once, then tracked as files are written, so the
+    directory is only rescanned when a write takes it over budget. Files
+    written by other processes are only counted at that point.
+    """
+
+    def __init__(self, directory, max_size_mb=1024):
+        """Init function.
+
+        Args:
+            directory: where the segmentations are stored. Created if it
+                does not exist.
+            max_size_mb: maximum size of the cache on disk, in megabytes.
+                None means unbounded.
+        """
+        self.directory = directory
+        self.max_size_mb = max_size_mb
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created in the meantime by another process
+                if not os.path.isdir(directory):
+                    raise
+        self.size = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def key(image, algo_type, params):
+        """Returns the cache key of a segmentation.
+
+        Args:
+            image: numpy array being segmented
+            algo_type: name of the segmentation algorithm
+            params: dict of the parameters the algorithm is called with
+        """
+        description = repr((algo_type, sorted(params.items())))
+        digest = hashlib.sha1(description.encode('utf-8'))
+        digest.update(array_digest(image).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """Returns the stored segmentation, or None."""
+        path = self.path(key)
+        try:
+            with np.load(path) as stored:
+                segments = stored['segments']
+            os.utime(path, None)
+        except (IOError, OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return segments
+
+    def put(self, key, segments):
+        """Stores a segmentation, then evicts old entries if the tracked
+        size is over budget."""
+        path = self.path(key)
+        replaced = os.path.getsize(path) if os.path.exists(path) else 0
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, segments=segments)
+            written = os.path.getsize(tmp_path)
+            os.rename(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.size += written - replaced
+        if self.max_size_mb is not None and \
+                self.size > self.max_size_mb * 2 ** 20:
+            self.evict()
+
+    def _entries(self):
+        """(mtime, size, name) of the files of the cache."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits in
+        max_size_mb, and resets the tracked size from the directory."""
+        entries = self._entries()
+        total = sum(e[1] for e in entries)
+        if self.max_size_mb is not None:
+            budget = self.max_size_mb * 2 ** 20
+            for _, size, name in sorted(entries):
+                if total <= budget:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                total -= size
+        self.size = total
+
+    def segment(self, image, algo_type, params, segmentation_fn):
+        """Returns the cached segmentation of image, computing and storing
+        it with segmentation_fn(image) on a miss."""
+        key = self.key(image, algo_type, params)
+        segments = self.get(key)
+        if segments is None:
+            segments = segmentation_fn(image)
+            self.put(key, segments)
+        return segments
+
+
+def load_inception_image(path, size=299):
+    """Loads an image as run_experiments.py feeds it to inception_v3: resized
+    with nearest-neighbor interpolation and scaled to [-1, 1] as float32."""
+    from PIL import Image
+
+    img = Image.open(path).convert('RGB').resize((size, size), Image.NEAREST)
+    x = np.asarray(img, dtype='float32')
+    x /= 127.5
+    x -= 1.
+    return x
+
+
+def _presegment_one(args):
+    path, cache, algo_type, params, size = args
+    fn = SegmentationAlgorithm(algo_type, cache=cache, **params)
+    image = load_inception_image(path, size)
+    key = cache.key(image, algo_type, fn.target_params)
+    if key in cache:
+        return path, False
+    fn(image)
+    return path, True
+
+
+def presegment(paths, cache, algo_type='quickshift', params=None, seeds=(None,),
+               size=299, processes=None):
+    """Fills the cache with the segmentation of every image.
+
+    Args:
+        paths: image files
+        cache: SegmentationCache
+        algo_type, params: segmentation algorithm and its parameters, as
+            given to SegmentationAlgorithm
+        seeds: random seeds to segment each image with. None keeps params
+            as they are.
+        size: side of the square the images are resized to
+        processes: number of worker processes. Defaults to the CPU count.
+
+    Returns:
+        number of segmentations computed (the others were already cached)
+    """
+    params = dict(params or {})
+    jobs = []
+    for seed in seeds:
+        job_params = dict(params)
+        if seed is not None:
+            job_params['random_seed'] = seed
+        jobs.extend((p, cache, algo_type, job_params, size) for p in paths)
+    pool = Pool(processes=processes or cpu_count())
+    try:
+        computed = sum(new for _, new in pool.imap_unordered(_presegment_one,
+                                                             jobs))
+    finally:
+        pool.close()
+        pool.join()
+    return computed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Pre-segments every image of a folder into a '
+                    'segmentation cache. Only explanations whose '
+                    'random_seed is one of the given seeds will hit it.')
+    parser.add_argument('folder')
+    parser.add_argument('--cache-dir', required=True)
+    parser.add_argument('--max-size-mb', type=float, default=1024)
+    parser.add_argument('--algo', default='quickshift')
+    parser.add_argument('--param', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='algorithm parameter; defaults to the ones of '
+                             'LimeImageExplainer for quickshift')
+    parser.add_argument('--seed', action='append', type=int, default=[])
+    parser.add_argument('--size', type=int, default=299)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    params = {}
+    if args.algo == 'quickshift' and not args.param:
+        params = dict(kernel_size=4, max_dist=200, ratio=0.2)
+    for p in args.param:
+        name, value = p.split('=', 1)
+        try:
+            params[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            params[name] = value
+
+    paths = sorted(os.path.join(dirpath, f)
+                   for dirpath, _, files in os.walk(args.folder)
+                   for f in files)
+    cache = SegmentationCache(args.cache_dir, max_size_mb=args.max_size_mb)
+    computed = presegment(paths, cache, args.algo, params,
+                          seeds=args.seed or [None], size=args.size,
+                          processes=args.processes)
+    print('%d images, %d segmentations computed' % (len(paths), computed))
+
+
+if __name__ == '__main__':
+    main()
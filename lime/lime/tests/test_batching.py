@@ -0,0 +1,86 @@
+import unittest
+
+import numpy as np
+
+from lime.batching import (AdaptiveBatchSizer, FixedBatchSizer,
+                           make_batch_sizer)
+from lime.pipeline import predict_batches
+
+
+class TestBatching(unittest.TestCase):
+
+    def test_adaptive_grows_then_settles_on_best_size(self):
+        # classifier taking 1s per call up to 40 images, linear after that
+        def seconds(size):
+            return max(size, 40) / 40.
+
+        sizer = AdaptiveBatchSizer(initial=10)
+        for _ in range(8):
+            size = sizer.next_size()
+            sizer.record(size, seconds(size))
+        self.assertEqual(sizer.sizes[:4], [10, 20, 40, 80])
+        self.assertTrue(sizer.settled)
+        self.assertEqual(sizer.sizes[-1], 40)
+
+    def test_adaptive_respects_max_size(self):
+        sizer = AdaptiveBatchSizer(initial=10, max_size=25)
+        for _ in range(5):
+            size = sizer.next_size()
+            sizer.record(size, 0.01)
+        self.assertEqual(max(sizer.sizes), 25)
+
+    def test_make_batch_sizer_memory_budget(self):
+        one_mb = 2 ** 20
+        sizer = make_batch_sizer(100, one_mb, max_memory_mb=30)
+        self.assertIsInstance(sizer, FixedBatchSizer)
+        self.assertEqual(sizer.next_size(), 30)
+        sizer = make_batch_sizer('auto', one_mb, max_memory_mb=30,
+                                 live_batches=3)
+        self.assertIsInstance(sizer, AdaptiveBatchSizer)
+        self.assertEqual(sizer.max_size, 10)
+        self.assertEqual(sizer.max_memory_mb, 10)
+
+    def test_adaptive_halves_on_memory_error(self):
+        calls = []
+
+        def classifier(imgs):
+            calls.append(len(imgs))
+            if len(imgs) > 30:
+                raise MemoryError
+            return imgs.sum(1)[:, np.newaxis]
+
+        data = np.arange(200).reshape(100, 2)
+        sizer = AdaptiveBatchSizer(initial=10)
+        labels, _, timings = predict_batches(
+            lambda rows, index: rows.astype(float), classifier, data, sizer)
+        self.assertEqual([l[0] for l in labels], list(data.sum(1)))
+        # 40 fails and is classified as 20 + 20, then batches stay at 20
+        self.assertEqual(calls[:6], [10, 20, 40, 20, 20, 20])
+        self.assertEqual(sizer.shrinks, [40])
+        self.assertEqual(max(timings['batch_sizes']), 20)
+        self.assertTrue(sizer.settled)
+
+        def out_of_memory(imgs):
+            raise MemoryError
+
+        self.assertRaises(MemoryError, predict_batches,
+                          lambda rows, index: rows, out_of_memory, data,
+                          AdaptiveBatchSizer(initial=4))
+        self.assertRaises(MemoryError, predict_batches,
+                          lambda rows, index: rows, classifier, data, 50)
+
+    def test_adaptive_halves_over_measured_budget(self):
+        sizer = AdaptiveBatchSizer(initial=10, max_memory_mb=1)
+        one_mb = 2 ** 20
+        sizer.record(sizer.next_size(), 1., nbytes=one_mb // 2)
+        self.assertEqual(sizer.next_size(), 20)
+        # The batch took twice the budget
+        sizer.record(20, 1., nbytes=2 * one_mb)
+        self.assertEqual(sizer.next_size(), 10)
+        self.assertEqual(sizer.max_size, 10)
+        sizer.record(10, .01, nbytes=one_mb)
+        self.assertEqual(sizer.next_size(), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
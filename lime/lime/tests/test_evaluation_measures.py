@@ -0,0 +1,57 @@
+import unittest
+import warnings
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from lime.evaluation_measures import (evaluate_explanations_multiscale,
+                                      ground_truth_mask)
+
+
+class TestEvaluationMeasures(unittest.TestCase):
+
+    def setUp(self):
+        self.expected = np.zeros((4, 5), dtype=bool)
+        self.expected[1:3, 2:4] = True
+
+    def test_ground_truth_mask_of_color_image(self):
+        gt = np.full((4, 5, 4), 255, dtype=np.uint8)
+        gt[1:3, 2:4, 0] = 10
+        # The alpha channel is not part of the colors
+        gt[0, 0, 3] = 0
+        assert_array_equal(ground_truth_mask(gt), self.expected)
+        assert_array_equal(ground_truth_mask(gt[..., :3]), self.expected)
+
+    def test_ground_truth_mask_of_grayscale_image(self):
+        gt = np.full((4, 5), 255, dtype=np.uint8)
+        gt[1:3, 2:4] = 0
+        assert_array_equal(ground_truth_mask(gt), self.expected)
+
+    def test_multiscale_keeps_one_row_per_image(self):
+        class Model(object):
+            def predict(self, imgs):
+                imgs = np.asarray(imgs, dtype=float)
+                p = imgs[:, :8, :8].mean((1, 2, 3))
+                return np.stack([(1 - p) / 2, (1 + p) / 2], 1)
+
+        rs = np.random.RandomState(0)
+        images = [rs.rand(16, 16, 3) for _ in range(3)]
+        gts = [np.full((16, 16, 3), 255, dtype=np.uint8) for _ in images]
+        for gt in gts:
+            gt[:8, :8] = 0
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            qualities = evaluate_explanations_multiscale(
+                Model(), [1, 1, 1], images, gts, (2, 4), neigh_size=30,
+                max_condition=1.)
+        # Every coarse fit is skipped, with a warning, the finest is kept
+        self.assertEqual(sum('grid size 2' in str(w.message)
+                             for w in caught), 3)
+        for g in (2, 4):
+            self.assertEqual(len(qualities[g]), 3)
+        self.assertTrue(all(np.isnan(q) for q in qualities[2]))
+        self.assertTrue(all(isinstance(q, list) for q in qualities[4]))
+
+
+if __name__ == '__main__':
+    unittest.main()
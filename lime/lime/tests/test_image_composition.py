@@ -0,0 +1,78 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from lime.image_composition import (GridSegments, SegmentIndex,
+                                    coarsen_rows, compose_batch,
+                                    compose_batch_from_pool)
+
+
+class TestImageComposition(unittest.TestCase):
+
+    def setUp(self):
+        self.rs = np.random.RandomState(0)
+
+    def check_grid_path(self, segments, shape):
+        image = self.rs.randint(0, 256, shape).astype(np.uint8)
+        fudged = self.rs.rand(*shape) * 255
+        pool = [self.rs.randint(0, 256, shape).astype(np.uint8)
+                for _ in range(3)]
+        n_features = len(np.unique(segments))
+        rows = self.rs.randint(0, 2, (6, n_features))
+        donors = self.rs.randint(0, 3, rows.shape)
+        index = SegmentIndex(segments, n_features)
+        self.assertIsNotNone(index.grid)
+        pixel_index = SegmentIndex(segments, n_features)
+        pixel_index.grid = None
+        assert_array_equal(compose_batch(image, fudged, index, rows),
+                           compose_batch(image, fudged, pixel_index, rows))
+        assert_array_equal(
+            compose_batch_from_pool(image, pool, index, rows, donors),
+            compose_batch_from_pool(image, pool, pixel_index, rows, donors))
+
+    def test_uniform_grid(self):
+        segments = np.arange(1, 17).reshape(4, 4).repeat(5, 0).repeat(3, 1)
+        self.check_grid_path(segments, (20, 12, 3))
+        self.check_grid_path(segments, (20, 12))
+
+    def test_irregular_grid(self):
+        segments = np.arange(12).reshape(3, 4).repeat([2, 5, 1], 0)\
+            .repeat([3, 1, 4, 2], 1)
+        grid = GridSegments.from_segments(segments)
+        assert_array_equal(grid.row_sizes, [2, 5, 1])
+        assert_array_equal(grid.col_sizes, [3, 1, 4, 2])
+        self.assertFalse(grid.uniform)
+        self.check_grid_path(segments, (8, 10, 3))
+        self.check_grid_path(grid, (8, 10, 3))
+
+    def test_not_a_grid(self):
+        segments = np.tril(np.ones((6, 6), dtype=int))
+        self.assertIsNone(GridSegments.from_segments(segments))
+        self.assertIsNone(SegmentIndex(segments).grid)
+
+    def test_coarsen_rows_of_nested_grids(self):
+        fine = np.arange(16).reshape(4, 4).repeat(3, 0).repeat(3, 1)
+        coarse = np.arange(4).reshape(2, 2).repeat(6, 0).repeat(6, 1)
+        rows = self.rs.randint(0, 2, (5, 16))
+        children = np.arange(16).reshape(2, 2, 2, 2).transpose(0, 2, 1, 3)\
+            .reshape(4, 4)
+        assert_array_equal(
+            coarsen_rows(rows, SegmentIndex(fine), SegmentIndex(coarse)),
+            rows[:, children].mean(2))
+        # Whole coarse cells turned off give binary rows
+        rows = np.ones((1, 16), dtype=int)
+        rows[0, children[2]] = 0
+        assert_array_equal(
+            coarsen_rows(rows, SegmentIndex(fine), SegmentIndex(coarse)),
+            [[1, 1, 0, 1]])
+        # A fine segment without column is always on, a coarse column
+        # without pixels is 1
+        assert_array_equal(
+            coarsen_rows(np.zeros((1, 15)), SegmentIndex(fine, 15),
+                         SegmentIndex(coarse + 1, 4)),
+            [[1, 0, 0, 0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import pickle
+import random
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from lime.image_pool import ClusterIndex, ImagePool, ImageView
+from lime.lime_image import LimeImagePatchworkExplainer
+from lime.patch_search import patch_wall
+
+
+class TestImagePool(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.images = [rs.rand(12, 12, 3) for _ in range(5)]
+        self.pool = ImagePool.create(self.images)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_views(self):
+        self.assertEqual(len(self.pool), 5)
+        self.assertEqual(self.pool.shape, (5, 12, 12, 3))
+        assert_array_equal(self.pool[-1], self.images[4])
+        view = self.pool[[3, 1]]
+        self.assertIsInstance(view, ImagePool)
+        assert_array_equal(np.array(list(view)),
+                           np.array([self.images[3], self.images[1]]))
+        assert_array_equal(view[1:][0], self.images[1])
+        assert_array_equal(self.pool[1:4].asarray(),
+                           np.array(self.images[1:4]))
+        self.assertRaises(IndexError, view.__getitem__, 2)
+
+    def test_pickles_without_pixels(self):
+        view = self.pool[[4, 0]]
+        dumped = pickle.dumps(view)
+        self.assertLess(len(dumped), self.images[0].nbytes)
+        loaded = pickle.loads(dumped)
+        assert_array_equal(loaded[0], self.images[4])
+        self.assertEqual(loaded.key(), view.key())
+        self.assertNotEqual(self.pool[[0, 4]].key(), view.key())
+
+    def test_explainers_accept_pools(self):
+        image = self.images[0] * 0.5
+        segments = np.arange(16).reshape(4, 4).repeat(3, 0).repeat(3, 1)
+        assert_array_equal(patch_wall(image, self.pool, segments),
+                           patch_wall(image, self.images, segments))
+        explanations = []
+        for pool in (self.images, self.pool):
+            random.seed(1)
+            explainer = LimeImagePatchworkExplainer(pool, random_state=2)
+            explanations.append(explainer.explain_instance(
+                image, lambda imgs: np.asarray(imgs).reshape(
+                    len(imgs), -1)[:, :3], top_labels=1, num_samples=20,
+                segmentation_fn=lambda img: segments))
+        self.assertEqual(explanations[0].local_exp, explanations[1].local_exp)
+
+    def test_cluster_index_views(self):
+        labels = [2, 0, 2, 1, 0]
+        for images in (self.images, self.pool):
+            clusters = ClusterIndex(images, labels)
+            same = clusters.same_cluster(2)
+            other = clusters.other_clusters(2)
+            self.assertIsInstance(same, type(images[1:]) if isinstance(
+                images, ImagePool) else ImageView)
+            assert_array_equal(np.array(list(same)),
+                               np.array([self.images[0], self.images[2]]))
+            assert_array_equal(np.array(list(other)),
+                               np.array([self.images[i] for i in (1, 3, 4)]))
+            self.assertEqual(len(clusters.same_cluster(7)), 0)
+        view = ClusterIndex(self.images, labels).other_clusters(0)
+        self.assertIs(view[1], self.images[2])
+        self.assertNotEqual(view.key(), view[1:].key())
+        self.assertRaises(ValueError, ClusterIndex, self.images, labels[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+import numpy as np
+import scipy.sparse
+from numpy.testing import assert_allclose
+from sklearn.metrics import pairwise_distances
+
+from lime.kernel_distances import BINARY_METRICS, distances_to_first
+
+
+class TestKernelDistances(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.data = rs.randint(0, 2, (100, 30)).astype(float)
+        self.data[0] = 1
+        self.data[5] = 0
+
+    def test_binary_metrics_match_pairwise_distances(self):
+        boolean = self.data.astype(bool)
+        for metric in BINARY_METRICS:
+            expected = pairwise_distances(boolean, boolean[:1],
+                                          metric=metric).ravel()
+            assert_allclose(distances_to_first(self.data, metric), expected,
+                            atol=1e-12)
+            assert_allclose(distances_to_first(
+                scipy.sparse.csr_matrix(self.data), metric), expected,
+                atol=1e-12)
+
+    def test_falls_back_to_pairwise_distances(self):
+        data = self.data.copy()
+        data[0, 0] = 0
+        for values, metric in ((data, 'cosine'), (data * 0.5, 'euclidean'),
+                               (self.data, 'cityblock')):
+            assert_allclose(distances_to_first(values, metric),
+                            pairwise_distances(values, values[:1],
+                                               metric=metric).ravel())
+
+
+if __name__ == '__main__':
+    unittest.main()
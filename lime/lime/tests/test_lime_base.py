@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+from sklearn.linear_model import Ridge
+
+from lime.lime_base import IncrementalRidge, LimeBase
+
+
+class TestLimeBase(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.data = rs.randint(0, 2, (200, 12)).astype(float)
+        self.labels = rs.rand(200, 5)
+        self.distances = rs.rand(200)
+        self.base = LimeBase(lambda d: np.sqrt(np.exp(-d ** 2 / .0625)),
+                             verbose=False, random_state=0)
+
+    def test_weighted_ridge_matches_sklearn(self):
+        weights = self.base.kernel_fn(self.distances)
+        intercepts, coefs, scores = LimeBase.weighted_ridge(
+            self.data, self.labels, weights)
+        for i in range(self.labels.shape[1]):
+            clf = Ridge(alpha=1, fit_intercept=True)
+            clf.fit(self.data, self.labels[:, i], sample_weight=weights)
+            assert_allclose(coefs[i], clf.coef_)
+            assert_allclose(intercepts[i], clf.intercept_)
+            assert_allclose(scores[i], clf.score(
+                self.data, self.labels[:, i], sample_weight=weights))
+
+    def test_incremental_ridge_matches_weighted_ridge(self):
+        weights = self.base.kernel_fn(self.distances)
+        ridge = IncrementalRidge(12, 5)
+        for start, stop in ((0, 1), (1, 60), (60, 61), (61, 200)):
+            ridge.update(self.data[start:stop], self.labels[start:stop],
+                         weights[start:stop])
+        for fit, ref in zip(ridge.fit(),
+                            LimeBase.weighted_ridge(self.data, self.labels,
+                                                    weights)):
+            assert_allclose(fit, ref)
+
+    def test_multi_matches_per_label(self):
+        for method in ('auto', 'none', 'highest_weights', 'lasso_path'):
+            for num_features in (3, 100):
+                fits = self.base.explain_instance_with_data_multi(
+                    self.data, self.labels, self.distances, [4, 0, 2],
+                    num_features, method)
+                for label, fit in zip([4, 0, 2], fits):
+                    ref = self.base.explain_instance_with_data(
+                        self.data, self.labels, self.distances, label,
+                        num_features, method)
+                    self.assertEqual([f for f, _ in fit[1]],
+                                     [f for f, _ in ref[1]])
+                    assert_allclose([w for _, w in fit[1]],
+                                    [w for _, w in ref[1]])
+                    assert_allclose(fit[0], ref[0])
+                    assert_allclose(fit[2], ref[2])
+                    assert_allclose(fit[3], ref[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,502 @@
+import copy
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from lime import lime_image
+from lime.grid_segmentation import gridSegmentation
+from lime.prediction_cache import PredictionCache
+from lime.lime_image import (ImageExplanation, LimeImageExplainer,
+                             LimeImageMixedPatchworkExplainer,
+                             LimeImagePatchworkExplainer)
+
+
+def reference_data_labels(image, segments, data, fudged_images_pool):
+    """Per-row composition as originally done by data_labels"""
+    imgs = []
+    for row in data:
+        temp = copy.deepcopy(image)
+        zeros = np.where(row == 0)[0]
+        mask = np.zeros(segments.shape)
+        fudged_images_indexes = range(1, len(fudged_images_pool) + 1)
+        for z in zeros:
+            val = random.choice(fudged_images_indexes)
+            mask[segments == z] = val
+        for i in fudged_images_indexes:
+            temp[mask == i] = fudged_images_pool[i - 1][mask == i]
+        imgs.append(temp)
+    return imgs
+
+
+def reference_mixed_data_labels(image, segments, data, same_clus_images,
+                                all_other_images, same_clus_prob):
+    """Per-row composition as originally done by the mixed explainer"""
+    imgs = []
+    for row in data:
+        temp = copy.deepcopy(image)
+        mask = np.zeros(segments.shape)
+        others = range(1, len(all_other_images) + 1)
+        sames = range(1, len(same_clus_images) + 1)
+        for z in np.where(row == 0)[0]:
+            if random.random() < same_clus_prob:
+                mask[segments == z] = - random.choice(sames)
+            else:
+                mask[segments == z] = random.choice(others)
+        for i in others:
+            temp[mask == i] = all_other_images[i - 1][mask == i]
+        for j in sames:
+            temp[mask == -j] = same_clus_images[j - 1][mask == -j]
+        imgs.append(temp)
+    return imgs
+
+
+class RecordingClassifier(object):
+    def __init__(self, n_classes=4):
+        self.n_classes = n_classes
+        self.batches = []
+
+    def __call__(self, imgs):
+        self.batches.append(np.array(imgs))
+        means = np.asarray(imgs, dtype=float).reshape(len(imgs), -1).mean(1)
+        return np.stack([means * (i + 1) for i in range(self.n_classes)], 1)
+
+
+class TestLimeImage(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.image = rs.randint(0, 256, (24, 24, 3)).astype(np.uint8)
+        self.segments = np.arange(36).reshape(6, 6).repeat(4, 0).repeat(4, 1)
+        self.fudged = np.zeros(self.image.shape) + 0.5
+
+    def test_data_labels_matches_per_row_composition(self):
+        explainer = LimeImageExplainer(random_state=1)
+        clf = RecordingClassifier()
+        data, labels, samples = explainer.data_labels(
+            self.image, self.fudged, self.segments, clf, 25, batch_size=7,
+            return_sample_neighborhood_images=True)
+        expected = reference_data_labels(self.image, self.segments, data,
+                                         [self.fudged])
+        self.assertEqual(len(samples), 25)
+        assert_array_equal(np.array(samples), np.array(expected))
+        assert_array_equal(np.concatenate(clf.batches), np.array(expected))
+        self.assertEqual([len(b) for b in clf.batches], [7, 7, 7, 4])
+        self.assertEqual(labels.shape, (25, 4))
+        self.assertTrue((data[0] == 1).all())
+
+    def test_global_random_state_follows_per_row_composition(self):
+        for hide_color in (None, 0):
+            random.seed(5)
+            explainer = LimeImageExplainer(random_state=1)
+            explainer.explain_instance(
+                self.image, RecordingClassifier(), top_labels=1,
+                hide_color=hide_color, num_samples=12, random_seed=0,
+                segmentation_fn=lambda img: self.segments)
+            after = random.random()
+            random.seed(5)
+            data = LimeImageExplainer(random_state=1).data_labels(
+                self.image, self.fudged, self.segments,
+                RecordingClassifier(), 12)[0]
+            random.seed(5)
+            reference_data_labels(self.image, self.segments, data,
+                                  [self.fudged])
+            self.assertEqual(after, random.random())
+
+    def test_neighborhood_keeps_image_dtype(self):
+        explainer = LimeImageExplainer(random_state=1)
+        clf = RecordingClassifier()
+        data, _, samples = explainer.data_labels(
+            self.image, self.fudged, self.segments, clf, 9, batch_size=4,
+            return_sample_neighborhood_images=True,
+            preprocess_fn=lambda imgs: imgs / 255.)
+        self.assertEqual(data.dtype, np.uint8)
+        self.assertIsInstance(samples, np.memmap)
+        self.assertEqual(samples.dtype, np.uint8)
+        expected = reference_data_labels(self.image, self.segments, data,
+                                         [self.fudged])
+        assert_array_equal(samples, np.array(expected))
+        assert_array_equal(np.concatenate(clf.batches),
+                           np.array(expected) / 255.)
+
+    def test_mean_color_samples_match_per_row_composition(self):
+        # float32 means must be those of np.mean, to the last bit
+        image = np.random.RandomState(3).rand(24, 24, 3).astype(np.float32)
+        baseline_fudged = image.copy()
+        for x in np.unique(self.segments):
+            baseline_fudged[self.segments == x] = (
+                np.mean(image[self.segments == x][:, 0]),
+                np.mean(image[self.segments == x][:, 1]),
+                np.mean(image[self.segments == x][:, 2]))
+        explainer = LimeImageExplainer(random_state=1)
+        explainer._start_image()
+        _, segments, fudged, _ = explainer._prepare_instance(
+            image, None, lambda img: self.segments, None)
+        assert_array_equal(fudged, baseline_fudged)
+        data, _, samples = explainer.data_labels(
+            image, fudged, segments, RecordingClassifier(), 15,
+            return_sample_neighborhood_images=True)
+        assert_array_equal(samples, np.array(reference_data_labels(
+            image, self.segments, data, [baseline_fudged])))
+
+    def test_data_labels_pool_matches_per_row_composition(self):
+        rs = np.random.RandomState(2)
+        pool = [rs.rand(*self.image.shape) * 255 for _ in range(3)]
+        explainer = LimeImagePatchworkExplainer(pool, random_state=1)
+        random.seed(10)
+        data, _, samples = explainer.data_labels(
+            self.image, None, self.segments, RecordingClassifier(), 12,
+            return_sample_neighborhood_images=True, fudged_images_pool=pool)
+        random.seed(10)
+        expected = reference_data_labels(self.image, self.segments, data, pool)
+        assert_array_equal(np.array(samples), np.array(expected))
+
+    def test_mixed_data_labels_matches_per_row_composition(self):
+        rs = np.random.RandomState(2)
+        pool = [rs.rand(*self.image.shape) * 255 for _ in range(5)]
+        explainer = LimeImageMixedPatchworkExplainer(pool[:2], pool[2:], 0.3,
+                                                     random_state=1)
+        random.seed(4)
+        data, _, samples = explainer.data_labels(
+            self.image, None, self.segments, RecordingClassifier(), 12,
+            batch_size=5, return_sample_neighborhood_images=True)
+        random.seed(4)
+        expected = reference_mixed_data_labels(self.image, self.segments, data,
+                                               pool[:2], pool[2:], 0.3)
+        assert_array_equal(np.array(samples), np.array(expected))
+
+    def test_grid_segments_keep_unmapped_label_on(self):
+        segments = gridSegmentation(4, self.image)
+        explainer = LimeImageExplainer(random_state=3)
+        data, _, samples = explainer.data_labels(
+            self.image, self.fudged, segments, RecordingClassifier(), 10,
+            return_sample_neighborhood_images=True)
+        expected = reference_data_labels(self.image, segments, data,
+                                         [self.fudged])
+        assert_array_equal(np.array(samples), np.array(expected))
+
+    def test_pipelined_data_labels_matches_serial(self):
+        results = []
+        for pipelined in (False, True):
+            explainer = LimeImageExplainer(random_state=5)
+            clf = RecordingClassifier()
+            data, labels = explainer.data_labels(
+                self.image, self.fudged, self.segments, clf, 33,
+                batch_size=5, pipelined=pipelined)
+            results.append((data, labels, np.concatenate(clf.batches)))
+            self.assertEqual(explainer.timings['batches'], 7)
+        for serial, piped in zip(*results):
+            assert_array_equal(serial, piped)
+
+    def test_explain_instance_reports_timings(self):
+        explainer = LimeImageExplainer(random_state=5)
+        exp = explainer.explain_instance(
+            self.image, RecordingClassifier(), hide_color=0, num_samples=20,
+            segmentation_fn=lambda img: self.segments, pipelined=True)
+        for stage in ('compose', 'classify', 'wait', 'total'):
+            self.assertGreaterEqual(exp.timings[stage], 0.)
+
+    def test_explain_instances_matches_explain_instance(self):
+        rs = np.random.RandomState(4)
+        images = [rs.randint(0, 256, self.image.shape).astype(np.uint8)
+                  for _ in range(3)]
+        pool = [rs.rand(*self.image.shape) * 255 for _ in range(4)]
+        explainers = [
+            lambda: LimeImageExplainer(random_state=7),
+            lambda: LimeImagePatchworkExplainer(pool, random_state=7),
+            lambda: LimeImageMixedPatchworkExplainer(pool[:2], pool[2:], 0.5,
+                                                     random_state=7)]
+        for make_explainer in explainers:
+            kwargs = dict(top_labels=2, num_samples=15,
+                          segmentation_fn=lambda img: self.segments)
+            random.seed(0)
+            explainer = make_explainer()
+            expected = [explainer.explain_instance(img, RecordingClassifier(),
+                                                   **kwargs)
+                        for img in images]
+            random.seed(0)
+            clf = RecordingClassifier()
+            explanations = make_explainer().explain_instances(
+                images, clf, batch_size=20, **kwargs)
+            self.assertEqual([len(b) for b in clf.batches], [20, 20, 5])
+            self.assertEqual(len(explanations), 3)
+            for exp, ref in zip(explanations, expected):
+                self.assertEqual(exp.top_labels, ref.top_labels)
+                for label in ref.top_labels:
+                    self.assertEqual(exp.local_exp[label],
+                                     ref.local_exp[label])
+
+    def test_batch_sizes_respect_memory_budget(self):
+        explainer = LimeImageExplainer(random_state=5)
+        budget = 10 * self.image.nbytes / 2. ** 20
+        exp = explainer.explain_instance(
+            self.image, RecordingClassifier(), hide_color=0, num_samples=64,
+            batch_size='auto', max_memory_mb=budget,
+            segmentation_fn=lambda img: self.segments)
+        self.assertEqual(sum(exp.timings['batch_sizes']), 64)
+        self.assertLessEqual(max(exp.timings['batch_sizes']), 10)
+        self.assertGreater(exp.timings['throughput'], 0)
+
+    def test_prediction_cache_predicts_each_mask_once(self):
+        segments = np.arange(4).reshape(2, 2).repeat(12, 0).repeat(12, 1)
+        cache = PredictionCache()
+        explainer = LimeImageExplainer(random_state=2, prediction_cache=cache)
+        clf = RecordingClassifier()
+        data, labels = explainer.data_labels(self.image, self.fudged,
+                                             segments, clf, 50)
+        n_unique = len(set(map(tuple, data)))
+        self.assertEqual(sum(len(b) for b in clf.batches), n_unique)
+        self.assertEqual(cache.misses, n_unique)
+        self.assertEqual(cache.hits, 50 - n_unique)
+        _, expected = LimeImageExplainer(random_state=2).data_labels(
+            self.image, self.fudged, segments, RecordingClassifier(), 50)
+        assert_array_equal(labels, expected)
+
+        # A second explanation of the same image reuses the predictions
+        clf.batches = []
+        explainer.data_labels(self.image, self.fudged, segments, clf, 50)
+        self.assertLessEqual(sum(len(b) for b in clf.batches),
+                             16 - n_unique)
+        self.assertEqual(explainer.timings['cache_hits'] +
+                         explainer.timings['cache_misses'], 50)
+
+    def test_prediction_cache_keys_pools_by_content(self):
+        rs = np.random.RandomState(3)
+        pool = [rs.rand(*self.image.shape) * 255 for _ in range(3)]
+        cache = PredictionCache()
+        explainer = LimeImagePatchworkExplainer(pool, random_state=2,
+                                                prediction_cache=cache)
+        kwargs = dict(top_labels=1, num_samples=20,
+                      segmentation_fn=lambda img: self.segments)
+        digests = []
+        images_digest = lime_image.images_digest
+
+        def traced_images_digest(images):
+            digests.append(images)
+            return images_digest(images)
+
+        lime_image.images_digest = traced_images_digest
+        try:
+            clf = RecordingClassifier()
+            explainer.explain_instance(self.image, clf, **kwargs)
+            self.assertEqual(cache.hits, 0)
+            explainer.explain_instance(self.image, clf, **kwargs)
+            # The pool is hashed once
+            self.assertEqual(len(digests), 1)
+            hits, misses = cache.hits, cache.misses
+            # A new pool with new pixels (but the same ids, were the old
+            # one freed): nothing can be reused
+            explainer.image_pool = [255 - im for im in pool]
+            del pool
+            clf = RecordingClassifier()
+            explainer.explain_instance(self.image, clf, **kwargs)
+        finally:
+            lime_image.images_digest = images_digest
+        self.assertEqual(len(digests), 2)
+        self.assertEqual(cache.hits, hits)
+        self.assertEqual(cache.misses, misses + 20)
+        self.assertEqual(sum(len(b) for b in clf.batches), 20)
+
+    def test_adaptive_sampling_matches_fixed_neighborhood(self):
+        rs = np.random.RandomState(4)
+        pool = [rs.rand(*self.image.shape) * 255 for _ in range(4)]
+        explainers = [
+            lambda: LimeImageExplainer(rng_seed=3),
+            lambda: LimeImageMixedPatchworkExplainer(pool[:2], pool[2:], 0.5,
+                                                     rng_seed=3)]
+        kwargs = dict(top_labels=2, segmentation_fn=lambda img: self.segments)
+        for make_explainer in explainers:
+            ref = make_explainer().explain_instance(
+                self.image, RecordingClassifier(), num_samples=70, **kwargs)
+            clf = RecordingClassifier()
+            exp = make_explainer().explain_instance_adaptive(
+                self.image, clf, max_samples=70, round_size=30,
+                tolerance=-1, **kwargs)
+            self.assertEqual([len(b) for b in clf.batches],
+                             [10, 10, 10] * 2 + [10])
+            self.assertEqual([n for n, _ in exp.neighborhood.history],
+                             [30, 60, 70])
+            self.assertEqual(exp.top_labels, ref.top_labels)
+            for label in ref.top_labels:
+                self.assertEqual(exp.local_exp[label], ref.local_exp[label])
+
+    def test_adaptive_sampling_stops_when_stable(self):
+        def clf(imgs):
+            imgs = np.asarray(imgs, dtype=float)
+            score = imgs[:, :4, :4].mean((1, 2, 3)) + \
+                2 * imgs[:, 4:8, :4].mean((1, 2, 3))
+            return np.stack([score, -score], 1)
+
+        exp = LimeImageExplainer(random_state=1).explain_instance_adaptive(
+            self.image, clf, hide_color=0, top_labels=1, max_samples=2000,
+            round_size=50, top_k=2, segmentation_fn=lambda img: self.segments)
+        self.assertLess(len(exp.neighborhood), 2000)
+        self.assertEqual([f for f, _ in exp.local_exp[0][:2]], [6, 0])
+
+    def test_extend_explanation_predicts_new_samples_only(self):
+        kwargs = dict(top_labels=2, segmentation_fn=lambda img: self.segments)
+        ref = LimeImageExplainer(rng_seed=5).explain_instance(
+            self.image, RecordingClassifier(), num_samples=45, **kwargs)
+        explainer = LimeImageExplainer(rng_seed=5)
+        exp = explainer.explain_instance(self.image, RecordingClassifier(),
+                                         num_samples=20,
+                                         keep_neighborhood=True, **kwargs)
+        clf = RecordingClassifier()
+        extended = explainer.extend_explanation(exp, clf, 25)
+        self.assertEqual(sum(len(b) for b in clf.batches), 25)
+        self.assertEqual(len(extended.neighborhood), 45)
+        for label in ref.top_labels:
+            self.assertEqual(extended.local_exp[label], ref.local_exp[label])
+        self.assertRaises(ValueError, explainer.extend_explanation,
+                          ImageExplanation(self.image, self.segments), clf, 5)
+
+    def test_hierarchical_explanation_refines_top_cells(self):
+        image = np.random.RandomState(1).randint(0, 256, (64, 64, 3))\
+            .astype(np.uint8)
+
+        def clf(imgs):
+            score = np.asarray(imgs, dtype=float)[:, :8, :8].mean((1, 2, 3))
+            return np.stack([score, 255 - score], 1)
+
+        explainer = LimeImageExplainer(random_state=1)
+        exp = explainer.explain_instance_hierarchical(
+            image, clf, grid_sizes=(2, 4, 8), num_samples=(40, 60, 80),
+            top_labels=1, hide_color=0)
+        self.assertEqual(len(exp.levels), 3)
+        self.assertEqual(exp.timings['samples'], 180)
+        self.assertEqual([len(np.unique(e.segments)) for e in exp.levels],
+                         [4, 7, 13])
+        assert_array_equal(np.unique(exp.segments), np.arange(13))
+        top = exp.local_exp[exp.top_labels[0]][0][0]
+        assert_array_equal(np.argwhere(exp.segments == top).min(0), [0, 0])
+        assert_array_equal(np.argwhere(exp.segments == top).max(0), [7, 7])
+
+    def test_multiscale_explanations_share_one_neighborhood(self):
+        image = np.random.RandomState(1).randint(0, 256, (32, 32, 3))\
+            .astype(np.uint8)
+        clf = RecordingClassifier()
+        explanations = LimeImageExplainer(random_state=3)\
+            .explain_instance_multiscale(image, clf, grid_sizes=(8, 2, 4),
+                                         num_samples=70, top_labels=2)
+        self.assertEqual(sorted(explanations), [2, 4, 8])
+        self.assertEqual(sum(len(b) for b in clf.batches), 70)
+        ref = LimeImageExplainer(random_state=3).explain_instance(
+            image, RecordingClassifier(), num_samples=70, top_labels=2,
+            segmentation_fn=lambda img: gridSegmentation(8, img))
+        for label in ref.top_labels:
+            self.assertEqual(explanations[8].local_exp[label],
+                             ref.local_exp[label])
+        for size, exp in explanations.items():
+            assert_array_equal(exp.segments, gridSegmentation(size, image))
+            self.assertEqual(sorted(f for f, _ in exp.local_exp[3]),
+                             list(range(size * size)))
+
+    def test_multiscale_coarse_fits_are_regularized(self):
+        image = np.random.RandomState(1).randint(0, 256, (32, 32, 3))\
+            .astype(np.uint8)
+        explainer = LimeImageExplainer(random_state=3)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            explanations = explainer.explain_instance_multiscale(
+                image, RecordingClassifier(), grid_sizes=(2, 4, 8),
+                num_samples=70, top_labels=1)
+        self.assertEqual(caught, [])
+        for size in (2, 4):
+            self.assertLess(explanations[size].condition, 100.)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            explainer.explain_instance_multiscale(
+                image, RecordingClassifier(), grid_sizes=(2, 4, 8),
+                num_samples=70, top_labels=1, max_condition=1.)
+        self.assertEqual(len(caught), 2)
+
+    def test_get_image_and_mask(self):
+        exp = ImageExplanation(self.image, self.segments)
+        exp.local_exp[0] = [(3, 0.5), (7, -0.4), (0, 0.3), (50, 0.2)]
+        temp, mask = exp.get_image_and_mask(0, num_features=4)
+        self.assertEqual(set(np.unique(mask)), {0, 1})
+        assert_array_equal(mask == 1, np.isin(self.segments, [3, 0]))
+        self.assertTrue((temp[mask == 1, 1] == self.image.max()).all())
+        assert_array_equal(temp[mask == 0], self.image[mask == 0])
+        temp, mask = exp.get_image_and_mask(0, positive_only=False,
+                                            hide_rest=True, num_features=2)
+        assert_array_equal(mask, np.where(self.segments == 3, 2,
+                                          np.where(self.segments == 7, 1, 0)))
+        self.assertTrue((temp[mask == 0] == 0).all())
+        self.assertTrue((temp[mask == 1, 0] == self.image.max()).all())
+
+    def test_get_masks(self):
+        exp = ImageExplanation(self.image, self.segments)
+        exp.local_exp[0] = [(3, 0.5), (7, -0.4), (0, 0.3), (50, 0.2),
+                            (1, 0.01)]
+        for positive_only in (True, False):
+            kwargs = dict(positive_only=positive_only, min_weight=0.1)
+            masks = exp.get_masks(0, 4, **kwargs)
+            self.assertEqual(masks.shape, (4,) + self.segments.shape)
+            for k in range(1, 5):
+                assert_array_equal(masks[k - 1], exp.get_image_and_mask(
+                    0, num_features=k, **kwargs)[1])
+        ranks = exp.get_masks(0, cumulative=True)
+        assert_array_equal(ranks, np.select(
+            [self.segments == 3, self.segments == 0, self.segments == 1],
+            [1, 2, 4]))
+
+
+    def test_save_and_load(self):
+        image = np.random.RandomState(1).randint(0, 256, (32, 32, 3))\
+            .astype(np.uint8)
+
+        def clf(imgs):
+            score = np.asarray(imgs, dtype=float)[:, :8, :8].mean((1, 2, 3))
+            return np.stack([score, 255 - score], 1)
+
+        exp = LimeImageExplainer(random_state=1).explain_instance_hierarchical(
+            image, clf, grid_sizes=(2, 4), num_samples=40, top_labels=1,
+            hide_color=0, keep_neighborhood=True)
+        directory = tempfile.mkdtemp()
+        try:
+            image_path = os.path.join(directory, 'image.npy')
+            np.save(image_path, image)
+            path = exp.save(os.path.join(directory, 'exp'), image_path)
+            loaded = ImageExplanation.load(path)
+            self.assertIsNone(loaded._segments)
+            self.assertIsNone(loaded._image)
+            self.assertEqual(loaded.top_labels, exp.top_labels)
+            self.assertEqual(loaded.timings['samples'], 80)
+            self.assertIsNone(loaded.neighborhood)
+            label = exp.top_labels[0]
+            self.assertEqual([f for f, _ in loaded.local_exp[label]],
+                             [f for f, _ in exp.local_exp[label]])
+            np.testing.assert_allclose([w for _, w in loaded.local_exp[label]],
+                                       [w for _, w in exp.local_exp[label]],
+                                       rtol=1e-6)
+            self.assertAlmostEqual(loaded.intercept[label],
+                                   exp.intercept[label])
+            # Scoring the masks reads the segments, not the image
+            assert_array_equal(loaded.get_masks(label, cumulative=True),
+                               exp.get_masks(label, cumulative=True))
+            self.assertIsNone(loaded._image)
+            self.assertIsInstance(loaded.segments, np.memmap)
+            self.assertEqual(loaded.segments.dtype, np.uint16)
+            assert_array_equal(loaded.image, image)
+            self.assertEqual(len(loaded.levels), 2)
+            assert_array_equal(loaded.levels[0].segments,
+                               exp.levels[0].segments)
+            assert_array_equal(loaded.levels[0].image, image)
+
+            loaded = ImageExplanation.load(path, image=image[::-1])
+            self.assertRaises(ValueError, getattr, loaded, 'image')
+            exp.save(path, compress=True, store_image=True)
+            loaded = ImageExplanation.load(path)
+            assert_array_equal(loaded.segments, exp.segments)
+            assert_array_equal(loaded.image, image)
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+import warnings
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from lime.grid_segmentation import gridSegmentation
+from lime.lime_trivial import LimeImageTrivialExplainer, occlusion_rows
+
+
+class CountingClassifier(object):
+    """Probability of class 1 grows with the brightness of the top left
+    quarter of the image."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, imgs):
+        imgs = np.asarray(imgs, dtype=float)
+        self.calls += len(imgs)
+        h, w = imgs.shape[1] // 2, imgs.shape[2] // 2
+        p = imgs[:, :h, :w].mean((1, 2, 3)) / 255.
+        return np.stack([1 - p, p], 1)
+
+
+class TestLimeTrivial(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.image = rs.randint(1, 256, (12, 12, 3)).astype(np.uint8)
+        self.segments = np.arange(9).reshape(3, 3).repeat(4, 0).repeat(4, 1)
+
+    def test_occlusion_rows(self):
+        data = occlusion_rows(3)
+        assert_array_equal(data, [[1, 1, 1], [0, 1, 1], [1, 0, 1],
+                                  [1, 1, 0]])
+        data = occlusion_rows(6, (2, 3), window=2)
+        assert_array_equal(data, [[1, 1, 1, 1, 1, 1],
+                                  [0, 0, 1, 0, 0, 1],
+                                  [1, 0, 0, 1, 0, 0]])
+
+    def test_superpixel_occlusion(self):
+        clf = CountingClassifier()
+        explainer = LimeImageTrivialExplainer()
+        exp = explainer.explain_instance(
+            self.image, clf, top_labels=2, hide_color=0, batch_size=4,
+            segmentation_fn=lambda img: self.segments)
+        self.assertEqual(clf.calls, 10)
+        p0 = clf(self.image[np.newaxis])[0, 1]
+        for f, w in exp.local_exp[1]:
+            occluded = self.image.copy()
+            occluded[self.segments == f] = 0
+            assert_allclose(w, p0 - clf(occluded[np.newaxis])[0, 1])
+        # Only the top left quarter (segments 0, 1, 3 and 4) matters
+        self.assertEqual(sorted(f for f, w in exp.local_exp[1] if w > 0),
+                         [0, 1, 3, 4])
+        self.assertAlmostEqual(exp.score, 1.)
+        _, mask = exp.get_image_and_mask(1, num_features=2)
+        self.assertTrue(mask[:6, :6].any())
+        self.assertFalse(mask[6:, 6:].any())
+
+    def test_sliding_window_occlusion(self):
+        clf = CountingClassifier()
+        explainer = LimeImageTrivialExplainer(window=4, stride=2)
+        exp = explainer.explain_instance(self.image, clf, labels=(1,),
+                                         top_labels=None, hide_color=0)
+        self.assertEqual(clf.calls, 26)
+        self.assertEqual(len(np.unique(exp.segments)), 36)
+
+        p0 = clf(self.image[np.newaxis])[0, 1]
+        drops = np.zeros((12, 12))
+        covers = np.zeros((12, 12))
+        for r in range(0, 9, 2):
+            for c in range(0, 9, 2):
+                occluded = self.image.copy()
+                occluded[r:r + 4, c:c + 4] = 0
+                drops[r:r + 4, c:c + 4] += p0 - clf(occluded[np.newaxis])[0, 1]
+                covers[r:r + 4, c:c + 4] += 1
+        for f, w in exp.local_exp[1]:
+            cell = exp.segments == f
+            assert_allclose(w, (drops / covers)[cell][0])
+
+        self.assertRaises(ValueError, LimeImageTrivialExplainer, window=5,
+                          stride=2)
+
+    def test_segments_labelled_from_one(self):
+        segments = gridSegmentation(3, self.image)
+        self.assertEqual(segments.min(), 1)
+        clf = CountingClassifier()
+        exp = LimeImageTrivialExplainer().explain_instance(
+            self.image, clf, labels=(1,), top_labels=None, hide_color=0,
+            segmentation_fn=lambda img: segments)
+        # Every cell, the last one included, is occluded once
+        self.assertEqual(clf.calls, 10)
+        weights = dict(exp.local_exp[1])
+        self.assertEqual(sorted(weights), list(range(1, 10)))
+        p0 = clf(self.image[np.newaxis])[0, 1]
+        for f, w in weights.items():
+            occluded = self.image.copy()
+            occluded[segments == f] = 0
+            assert_allclose(w, p0 - clf(occluded[np.newaxis])[0, 1])
+
+    def test_num_samples_is_ignored_with_a_warning(self):
+        explainer = LimeImageTrivialExplainer(window=4)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            for num_samples in (None, 1000, 50):
+                clf = CountingClassifier()
+                explainer.explain_instance(self.image, clf, labels=(1,),
+                                           top_labels=None, hide_color=0,
+                                           num_samples=num_samples)
+                self.assertEqual(clf.calls, 10)
+        self.assertEqual(len(caught), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import random
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from lime.image_pool import ImagePool
+from lime.lime_image import (LimeImageEnhancedPatchworkExplainer,
+                             LimeImageExplainer,
+                             LimeImageMixedPatchworkExplainer,
+                             LimeImagePatchworkExplainer)
+from lime.parallel_compose import (ComposeWorkers, compose_speedup,
+                                   workers_speedup)
+
+
+def classifier(imgs):
+    flat = np.asarray(imgs, dtype=float).reshape(len(imgs), -1)
+    return np.stack([flat.mean(1), flat[:, :50].mean(1)], 1)
+
+
+class TestParallelCompose(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.image = rs.rand(16, 16, 3)
+        self.pool = [rs.rand(16, 16, 3) for _ in range(4)]
+        self.segments = np.arange(16).reshape(4, 4).repeat(4, 0).repeat(4, 1)
+        self.fudged = np.zeros(self.image.shape)
+
+    def test_matches_serial_for_every_explainer(self):
+        image_pool = ImagePool.create(self.pool)
+        explainers = [
+            lambda: LimeImageExplainer(rng_seed=2),
+            lambda: LimeImagePatchworkExplainer(self.pool, rng_seed=2),
+            lambda: LimeImagePatchworkExplainer(image_pool, rng_seed=2),
+            lambda: LimeImageMixedPatchworkExplainer(self.pool[:1],
+                                                     self.pool[1:], 0.5,
+                                                     rng_seed=2),
+            lambda: LimeImageEnhancedPatchworkExplainer(self.pool,
+                                                        rng_seed=2)]
+        try:
+            for make_explainer in explainers:
+                results = []
+                for processes in (None, 2):
+                    explainer = make_explainer()
+                    explainer._start_image()
+                    _, segments, fudged, pool = explainer._prepare_instance(
+                        self.image, 0, lambda img: self.segments, None)
+                    results.append(explainer.data_labels(
+                        self.image, fudged, segments, classifier, 23,
+                        batch_size=5, fudged_images_pool=pool,
+                        return_sample_neighborhood_images=True,
+                        processes=processes))
+                for serial, parallel in zip(*results):
+                    assert_array_equal(np.array(serial), np.array(parallel))
+                self.assertEqual(explainer.timings['processes'], 2)
+        finally:
+            image_pool.close()
+
+    def test_pipelined_explanation(self):
+        random.seed(0)
+        expected = LimeImageExplainer(random_state=1).explain_instance(
+            self.image, classifier, top_labels=2, num_samples=40,
+            batch_size=6, segmentation_fn=lambda img: self.segments)
+        random.seed(0)
+        exp = LimeImageExplainer(random_state=1).explain_instance(
+            self.image, classifier, top_labels=2, num_samples=40,
+            batch_size=6, segmentation_fn=lambda img: self.segments,
+            pipelined=True, processes=2)
+        self.assertEqual(exp.local_exp, expected.local_exp)
+
+    def test_workers_reused_across_calls(self):
+        images = [self.image, self.pool[0], self.image * .5]
+        kwargs = dict(top_labels=2, num_samples=30, batch_size=7,
+                      segmentation_fn=lambda img: self.segments)
+        serial = LimeImageExplainer(random_state=1)
+        expected = [serial.explain_instance(image, classifier, **kwargs)
+                    for image in images]
+        with ComposeWorkers(2) as workers:
+            explainer = LimeImageExplainer(random_state=1)
+            explanations = [explainer.explain_instance(
+                image, classifier, processes=workers, **kwargs)
+                for image in images]
+            pids = set(p.pid for p in workers.pool._pool)
+            explanations.extend(LimeImageExplainer(
+                random_state=1).explain_instances(
+                    images, classifier, processes=workers, **kwargs))
+            self.assertEqual(set(p.pid for p in workers.pool._pool), pids)
+        for exp, ref in zip(explanations, expected + expected):
+            self.assertEqual(exp.local_exp, ref.local_exp)
+
+    def test_workers_speedup(self):
+        explainer = LimeImageExplainer(random_state=1)
+        neighborhoods = []
+        for _ in range(3):
+            data, compose, _ = explainer._neighborhood(
+                self.image, self.fudged, self.segments, 20)
+            neighborhoods.append((compose, data))
+        timings = workers_speedup(neighborhoods, processes=2, batch_size=8)
+        self.assertGreater(timings['speedup'], 0)
+
+    def test_compose_speedup(self):
+        explainer = LimeImageExplainer(random_state=1)
+        data, compose, _ = explainer._neighborhood(
+            self.image, self.fudged, self.segments, 20)
+        timings = compose_speedup(compose, data, processes=2, batch_size=8)
+        self.assertGreater(timings['speedup'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
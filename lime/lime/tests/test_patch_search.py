@@ -0,0 +1,130 @@
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from lime.lime_image import LimeImageEnhancedPatchworkExplainer
+from lime import patch_search
+from lime.grid_segmentation import gridSegmentation
+from lime.patch_search import PatchIndex, patch_wall
+
+
+def reference_patch_wall(image, pool, segments):
+    """Patch wall as originally built by the enhanced explainer"""
+    explainer = LimeImageEnhancedPatchworkExplainer(pool)
+    wall = copy.deepcopy(image)
+    for seg in np.unique(segments):
+        patches = explainer.extract_patches(pool, segments, seg)
+        wall[segments == seg] = explainer.get_most_similar_patch(
+            wall[segments == seg], patches)
+    return wall
+
+
+class TestPatchSearch(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.image = rs.rand(20, 20, 3)
+        self.segments = np.arange(25).reshape(5, 5).repeat(4, 0).repeat(4, 1)
+        self.pool = [rs.rand(20, 20, 3) for _ in range(6)]
+
+    def test_matches_per_segment_search(self):
+        # A patch identical to the image is never chosen
+        self.pool[2][self.segments == 3] = self.image[self.segments == 3]
+        assert_array_equal(patch_wall(self.image, self.pool, self.segments,
+                                      chunk_mb=0.01),
+                           reference_patch_wall(self.image, self.pool,
+                                                self.segments))
+
+    def test_segment_without_candidate_keeps_its_pixels(self):
+        pool = [self.image.copy(), self.pool[0]]
+        pool[1][self.segments == 7] = self.image[self.segments == 7]
+        wall = patch_wall(self.image, pool, self.segments)
+        assert_array_equal(wall[self.segments == 7],
+                           self.image[self.segments == 7])
+        assert_array_equal(wall[self.segments != 7],
+                           pool[1][self.segments != 7])
+
+    def test_index_matches_pool_scan(self):
+        # The explained image is part of the pool, as in run_experiments.py
+        pool = self.pool + [self.image, self.image.copy()]
+        expected = patch_wall(self.image, pool, self.segments)
+        index = PatchIndex(pool, self.segments)
+        assert_array_equal(index.patch_wall(self.image), expected)
+        coarse = PatchIndex(pool, self.segments, dims=2, candidates=1)
+        assert_array_equal(coarse.patch_wall(self.image), expected)
+        self.assertEqual(coarse.trees[0].data.shape, (len(pool), 2))
+
+    def test_index_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'index.pkl')
+            PatchIndex(self.pool, self.segments).save(path)
+            index = PatchIndex.load(path, self.pool)
+            assert_array_equal(index.patch_wall(self.image),
+                               patch_wall(self.image, self.pool,
+                                          self.segments))
+            self.assertTrue(index.matches(self.segments.copy()))
+            self.assertFalse(index.matches(self.segments.T))
+            self.assertRaises(ValueError, PatchIndex.load, path,
+                              self.pool[:3])
+            # Same size, different images
+            self.assertRaises(ValueError, PatchIndex.load, path,
+                              self.pool[1:] + self.pool[:1])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_explainer_uses_index(self):
+        segments = gridSegmentation(4, self.image)
+        index = PatchIndex(self.pool, segments)
+        segmentation_fn = lambda img: segments
+        explanations = []
+        for patch_index in (None, index):
+            explainer = LimeImageEnhancedPatchworkExplainer(
+                self.pool, random_state=3, patch_index=patch_index)
+            explanations.append(explainer.explain_instance(
+                self.image, lambda imgs: np.asarray(imgs).reshape(
+                    len(imgs), -1)[:, :3], top_labels=1, num_samples=20,
+                segmentation_fn=segmentation_fn))
+        self.assertEqual(explanations[0].local_exp, explanations[1].local_exp)
+
+    def test_explainer_stacks_pool_once(self):
+        explainer = LimeImageEnhancedPatchworkExplainer(self.pool,
+                                                        random_state=3)
+        stacked = []
+        stack_pool = patch_search.stack_pool
+
+        def traced_stack_pool(pool):
+            if isinstance(pool, list):
+                stacked.append(pool)
+            return stack_pool(pool)
+
+        def explain():
+            return explainer.explain_instance(
+                self.image, lambda imgs: np.asarray(imgs).reshape(
+                    len(imgs), -1)[:, :3], top_labels=1, num_samples=10,
+                segmentation_fn=lambda img: self.segments,
+                return_sample_neighborhood_images=True)[1]
+
+        patch_search.stack_pool = traced_stack_pool
+        try:
+            explain()
+            explain()
+            self.assertEqual(len(stacked), 1)
+            # A pool assigned later is the one searched
+            explainer.image_pool = [np.full(self.image.shape, 7.)
+                                    for _ in range(3)]
+            samples = explain()
+            self.assertEqual(len(stacked), 2)
+        finally:
+            patch_search.stack_pool = stack_pool
+        self.assertTrue((samples == 7.).any())
+        # An empty pool is accepted until used, as before
+        LimeImageEnhancedPatchworkExplainer([])
+
+if __name__ == '__main__':
+    unittest.main()
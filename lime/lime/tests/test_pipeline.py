@@ -0,0 +1,37 @@
+import unittest
+
+import numpy as np
+
+from lime.pipeline import predict_batches
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_predict_batches_keeps_row_order(self):
+        data = np.arange(23).reshape(-1, 1)
+
+        def compose(rows, index):
+            return rows * 2
+
+        for pipelined in (False, True):
+            labels, samples, timings = predict_batches(
+                compose, lambda imgs: imgs + 1, data, 4, pipelined=pipelined,
+                depth=1, keep_samples=True)
+            self.assertEqual([int(l[0]) for l in labels],
+                             list(range(1, 46, 2)))
+            self.assertEqual(len(samples), 23)
+            self.assertEqual(timings['batches'], 6)
+
+    def test_pipelined_compose_error_is_raised(self):
+        def compose(rows, index):
+            if index[0] >= 8:
+                raise ValueError('bad batch')
+            return rows
+
+        with self.assertRaises(ValueError):
+            predict_batches(compose, lambda imgs: imgs, np.zeros((20, 1)), 4,
+                            pipelined=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import gc
+import unittest
+
+from lime.prediction_cache import PredictionCache, callable_key, lookup_rows
+
+
+class Model(object):
+    def predict(self, imgs):
+        return imgs
+
+
+class TestPredictionCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = PredictionCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lookup_rows_counts_repeats_as_hits(self):
+        cache = PredictionCache()
+        cache.put('x', 0)
+        todo, known = lookup_rows(cache, ['a', 'x', 'a', 'b', 'x'])
+        self.assertEqual(todo, [0, 3])
+        self.assertEqual(known, {'x': 0})
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+        self.assertAlmostEqual(cache.hit_rate, 0.6)
+
+    def test_callable_key_outlives_classifier_ids(self):
+        cache = PredictionCache()
+        ids = set()
+        for _ in range(20):
+            model = Model()
+            key = callable_key(model.predict)
+            ids.add(id(model))
+            self.assertIsNone(cache.get(key))
+            cache.put(key, 1)
+            self.assertEqual(cache.get(callable_key(model.predict)), 1)
+            del model
+            gc.collect()
+        # The cached keys keep their models alive, so no id is reused
+        self.assertEqual(len(ids), 20)
+        self.assertEqual(cache.misses, 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import random
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from lime.lime_image import (LimeImageExplainer,
+                             LimeImageMixedPatchworkExplainer,
+                             LimeImagePatchworkExplainer)
+from lime.random_streams import DONORS, RandomStreams
+
+
+def classifier(imgs):
+    flat = np.asarray(imgs, dtype=float).reshape(len(imgs), -1)
+    return np.stack([flat.mean(1), flat[:, :50].mean(1)], 1)
+
+
+class TestRandomStreams(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.images = [rs.rand(16, 16, 3) for _ in range(3)]
+        self.pool = [rs.rand(16, 16, 3) for _ in range(5)]
+        self.segments = np.arange(16).reshape(4, 4).repeat(4, 0).repeat(4, 1)
+
+    def test_shards_match_serial_draws(self):
+        streams = RandomStreams(3, chunk_size=7)
+        rows = streams.binary_rows(2, 10, 0, 40)
+        shards = [streams.binary_rows(2, 10, a, b)
+                  for a, b in ((0, 5), (5, 23), (23, 40))]
+        assert_array_equal(np.concatenate(shards), rows)
+        u = streams.uniform(2, DONORS, (10, 2), 0, 40)
+        assert_array_equal(streams.uniform(2, DONORS, (10, 2), 9, 30),
+                           u[9:30])
+        self.assertFalse((streams.binary_rows(3, 10, 0, 40) == rows).all())
+
+    def test_explainer_draws_do_not_use_global_random(self):
+        explainer = LimeImagePatchworkExplainer(self.pool, rng_seed=4)
+        explainer.random_streams.chunk_size = 8
+        explainer._start_image()
+        data = explainer._draw_data(30, 16)
+        donors = explainer._draw_donors(data, len(self.pool))
+        self.assertTrue((data[0] == 1).all())
+        assert_array_equal(explainer._draw_data(30, 16, 12, 30), data[12:])
+        assert_array_equal(explainer._draw_donors(data[12:], len(self.pool),
+                                                  start=12), donors[12:])
+
+        mixed = LimeImageMixedPatchworkExplainer(self.pool[:2],
+                                                 self.pool[2:], 0.5,
+                                                 rng_seed=4)
+        mixed._start_image()
+        donors = mixed._draw_mixed_donors(data)
+        self.assertTrue((donors[data == 1] == 0).all())
+        self.assertTrue((donors < len(self.pool)).all())
+        self.assertTrue((donors[data == 0] >= 3).any())
+
+    def test_explanations_only_depend_on_seed_and_image_number(self):
+        kwargs = dict(top_labels=2, num_samples=30,
+                      segmentation_fn=lambda img: self.segments)
+        explainers = [
+            lambda: LimeImageExplainer(rng_seed=11),
+            lambda: LimeImagePatchworkExplainer(self.pool, rng_seed=11),
+            lambda: LimeImageMixedPatchworkExplainer(
+                self.pool[:2], self.pool[2:], 0.5, rng_seed=11)]
+        for make_explainer in explainers:
+            random.seed(0)
+            np.random.seed(0)
+            explainer = make_explainer()
+            expected = [explainer.explain_instance(img, classifier, **kwargs)
+                        for img in self.images]
+            random.seed(1)
+            np.random.seed(1)
+            batched = make_explainer().explain_instances(
+                self.images, classifier, batch_size=7, **kwargs)
+            for exp, ref in zip(batched, expected):
+                self.assertEqual(exp.local_exp, ref.local_exp)
+            self.assertNotEqual(expected[0].local_exp, expected[1].local_exp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from lime.lime_image import LimeImageExplainer
+from lime.sampling_designs import (AntitheticDesign, BalancedDesign,
+                                   KernelDesign, SamplingDesign, SobolDesign,
+                                   get_design)
+
+
+def image_kernel(d):
+    return np.sqrt(np.exp(-(d ** 2) / .25 ** 2))
+
+
+class TestSamplingDesigns(unittest.TestCase):
+
+    def setUp(self):
+        self.rs = np.random.RandomState(0)
+
+    def test_designs_draw_binary_rows(self):
+        for name in ('uniform', 'antithetic', 'balanced', 'sobol', 'kernel'):
+            rows = get_design(name, image_kernel).rows(31, 20, self.rs)
+            self.assertEqual(rows.shape, (31, 20))
+            self.assertEqual(rows.dtype, np.uint8)
+            self.assertTrue(((rows == 0) | (rows == 1)).all())
+        self.assertRaises(ValueError, get_design, 'latin')
+        # A design has to define rows
+        self.assertRaises(TypeError, SamplingDesign)
+
+    def test_antithetic_rows_come_in_complementary_pairs(self):
+        rows = AntitheticDesign().rows(10, 15, self.rs)
+        assert_array_equal(rows[0::2] + rows[1::2], 1)
+
+    def test_balanced_columns(self):
+        assert_array_equal(BalancedDesign().rows(40, 12, self.rs).sum(0), 20)
+        sums = BalancedDesign().rows(41, 500, self.rs).sum(0)
+        self.assertEqual(set(sums), {20, 21})
+        self.assertGreater((sums == 20).sum(), 200)
+        self.assertGreater((sums == 21).sum(), 200)
+
+    def test_sobol_is_balanced_for_powers_of_two(self):
+        assert_array_equal(SobolDesign().rows(64, 30, self.rs).sum(0), 32)
+
+    def test_kernel_design_importance_weights(self):
+        design = KernelDesign(image_kernel)
+        p = design.ones_distribution(16)
+        self.assertAlmostEqual(p.sum(), 1.)
+        rows = design.rows(20000, 16, self.rs)
+        assert_allclose(np.bincount(rows.sum(1), minlength=17) / 20000., p,
+                        atol=.01)
+        data = np.concatenate((np.ones((1, 16)), rows))
+        weights = design.sample_weights(data)
+        self.assertEqual(weights[0], 1.)
+        # Kernel weight times importance weight is the same for every row
+        ones = data.sum(1)
+        assert_allclose(weights * image_kernel(1 - np.sqrt(ones / 16.)),
+                        image_kernel(0.))
+
+    def test_image_explainer_uses_design(self):
+        image = self.rs.randint(0, 256, (16, 16, 3)).astype(np.uint8)
+        segments = np.arange(16).reshape(4, 4).repeat(4, 0).repeat(4, 1)
+        for name in ('antithetic', 'kernel'):
+            explainer = LimeImageExplainer(random_state=1,
+                                           sampling_design=name)
+            data, _ = explainer.data_labels(
+                image, np.zeros(image.shape), segments,
+                lambda imgs: np.ones((len(imgs), 2)), 11)
+            self.assertEqual(data.shape, (11, 16))
+            self.assertTrue((data[0] == 1).all())
+            if name == 'antithetic':
+                assert_array_equal(data[1::2] + data[2::2], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+
+from lime.segment_stats import SegmentStatistics
+
+
+class TestSegmentStatistics(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.image = rs.rand(20, 30, 3)
+        self.segments = rs.randint(0, 12, (20, 30)) * 3 + 1
+
+    def test_per_segment_statistics(self):
+        stats = SegmentStatistics(self.segments, self.image)
+        assert_array_equal(stats.labels, np.unique(self.segments))
+        for pos, label in enumerate(stats.labels):
+            sel = self.segments == label
+            self.assertEqual(stats.counts[pos], sel.sum())
+            assert_allclose(stats.channel_means[pos],
+                            self.image[sel].mean(axis=0))
+            rows, cols = np.where(sel)
+            assert_array_equal(stats.bounding_boxes[pos],
+                               [rows.min(), cols.min(), rows.max(),
+                                cols.max()])
+            assert_array_equal(np.sort(stats.pixels(label)),
+                               np.flatnonzero(sel))
+        self.assertEqual(len(stats.pixels(2)), 0)
+
+    def test_mean_image_and_label_mask(self):
+        stats = SegmentStatistics(self.segments, self.image)
+        expected = self.image.copy()
+        for x in np.unique(self.segments):
+            expected[self.segments == x] = self.image[self.segments == x].mean(0)
+        assert_allclose(stats.mean_image(), expected)
+        assert_array_equal(stats.label_mask([4, 7, 100]),
+                           np.isin(self.segments, [4, 7]))
+
+    def test_negative_labels(self):
+        stats = SegmentStatistics(self.segments - 20)
+        assert_array_equal(stats.labels, np.unique(self.segments - 20))
+        assert_array_equal(stats.label_mask([-19]), self.segments == 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from lime.segmentation_cache import SegmentationCache
+from lime.wrappers.scikit_image import SegmentationAlgorithm
+
+
+class CountingSegmenter(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, image):
+        self.calls += 1
+        return (image[:, :, 0] > 0.5).astype(int)
+
+
+class TestSegmentationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image = np.random.RandomState(0).rand(16, 16, 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hit_and_miss(self):
+        cache = SegmentationCache(self.directory)
+        fn = CountingSegmenter()
+        first = cache.segment(self.image, 'counting', {'a': 1}, fn)
+        second = cache.segment(self.image, 'counting', {'a': 1}, fn)
+        assert_array_equal(first, second)
+        self.assertEqual(fn.calls, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Another process sees the same files
+        other = SegmentationCache(self.directory)
+        assert_array_equal(other.segment(self.image, 'counting', {'a': 1}, fn),
+                           first)
+        self.assertEqual(fn.calls, 1)
+
+    def test_key_depends_on_image_and_params(self):
+        key = SegmentationCache.key(self.image, 'quickshift', {'random_seed': 0})
+        self.assertEqual(key, SegmentationCache.key(self.image.copy(),
+                                                    'quickshift',
+                                                    {'random_seed': 0}))
+        self.assertNotEqual(key, SegmentationCache.key(
+            self.image, 'quickshift', {'random_seed': 1}))
+        self.assertNotEqual(key, SegmentationCache.key(
+            self.image, 'slic', {'random_seed': 0}))
+        self.assertNotEqual(key, SegmentationCache.key(
+            self.image[::-1], 'quickshift', {'random_seed': 0}))
+
+    def test_evicts_least_recently_used(self):
+        cache = SegmentationCache(self.directory, max_size_mb=None)
+        rs = np.random.RandomState(1)
+        for i in range(3):
+            cache.put(str(i), rs.randint(0, 1000, (64, 64)))
+            os.utime(cache.path(str(i)), (i, i))
+        cache.get('0')
+        entry = os.path.getsize(cache.path('0'))
+        cache.max_size_mb = 2.5 * entry / 2. ** 20
+        cache.evict()
+        self.assertEqual(['0' in cache, '1' in cache, '2' in cache],
+                         [True, False, True])
+
+    def test_put_scans_directory_only_over_budget(self):
+        rs = np.random.RandomState(2)
+        cache = SegmentationCache(self.directory, max_size_mb=1)
+        scans = []
+        entries = cache._entries
+        cache._entries = lambda: scans.append(1) or entries()
+        for i in range(3):
+            cache.put(str(i), rs.randint(0, 1000, (64, 64)))
+            os.utime(cache.path(str(i)), (i, i))
+        self.assertEqual(scans, [])
+        self.assertEqual(cache.size, sum(os.path.getsize(cache.path(str(i)))
+                                         for i in range(3)))
+        # Overwriting an entry does not count it twice
+        cache.put('0', rs.randint(0, 1000, (64, 64)))
+        os.utime(cache.path('0'), (0, 0))
+        self.assertEqual(cache.size, sum(os.path.getsize(cache.path(str(i)))
+                                         for i in range(3)))
+        self.assertEqual(SegmentationCache(self.directory).size, cache.size)
+
+        cache.max_size_mb = 1.5 * os.path.getsize(cache.path('0')) / 2. ** 20
+        cache.put('3', rs.randint(0, 1000, (64, 64)))
+        self.assertEqual(len(scans), 1)
+        self.assertEqual(cache.size, os.path.getsize(cache.path('3')))
+
+    def test_explainer_with_fixed_seed_hits_cache(self):
+        from lime.lime_image import LimeImageExplainer
+
+        cache = SegmentationCache(self.directory)
+        explainer = LimeImageExplainer(segmentation_cache=cache)
+        image = np.random.RandomState(1).rand(24, 24, 3)
+        for _ in range(2):
+            explainer.explain_instance(
+                image, lambda imgs: np.ones((len(imgs), 2)), num_samples=5,
+                random_seed=0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_segmentation_algorithm_uses_cache(self):
+        cache = SegmentationCache(self.directory)
+        fn = SegmentationAlgorithm('slic', n_segments=10, cache=cache)
+        segments = fn(self.image)
+        assert_array_equal(fn(self.image), segments)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        assert_array_equal(SegmentationAlgorithm('slic', n_segments=10)(
+            self.image), segments)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
+import hashlib
 import sys
 import inspect
 import types
 
+import numpy as np
+
 
 def has_arg(fn, arg_name):
     """Checks if a callable accepts a given keyword argument.
@@ -37,3 +40,18 @@ def has_arg(fn, arg_name):
             return False
         return (parameter.kind in (inspect.Parameter.POSITIONAL_OR_KEYWORD,
                                    inspect.Parameter.KEYWORD_ONLY))
+
+
+def array_digest(array):
+    """Returns a hex digest of the content, shape and dtype of an array.
+
+    Args:
+        array: numpy array (or anything numpy.asarray accepts)
+
+    Returns:
+        string, equal for arrays with the same shape, dtype and values.
+    """
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(str((array.shape, array.dtype.str)).encode('utf-8'))
+    digest.update(array.view(np.uint8).ravel() if array.size else b'')
+    return digest.hexdigest()
@@ -97,12 +97,16 @@ class SegmentationAlgorithm(BaseWrapper):
         Args:
             algo_type: string, segmentation algorithm among the following:
                 'quickshift', 'slic', 'felzenszwalb'
+            cache: optional SegmentationCache (see segmentation_cache.py).
+                If given, segmentations are looked up in it before being
+                computed, and stored in it afterwards.
             target_params: dict, algorithm parameters (valid model paramters
                 as define in Scikit-Image documentation)
     """
 
-    def __init__(self, algo_type, **target_params):
+    def __init__(self, algo_type, cache=None, **target_params):
         self.algo_type = algo_type
+        self.cache = cache
         if (self.algo_type == 'quickshift'):
             BaseWrapper.__init__(self, quickshift, **target_params)
             kwargs = self.filter_params(quickshift)
@@ -117,4 +121,10 @@ class SegmentationAlgorithm(BaseWrapper):
             self.set_params(**kwargs)
 
     def __call__(self, *args):
-            return self.target_fn(args[0], **self.target_params)
+            if self.cache is not None:
+                return self.cache.segment(args[0], self.algo_type,
+                                          self.target_params, self._segment)
+            return self._segment(args[0])
+
+    def _segment(self, image):
+        return self.target_fn(image, **self.target_params)